@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    A small, thread safe, in-process LRU cache.
+
+    This sits in front of memcache for hot objects that are read many times
+    per request. Every process has its own copy so keep timeouts short.
+
+    :param maxsize: the number of entries to keep before evicting the least
+                    recently used one.
+    :param timeout: default number of seconds before an entry expires.
+    """
+
+    def __init__(self, maxsize=1000, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, max_age=None):
+        """
+        Return the value for `key` or `default` if it has expired.
+
+        :param max_age: optional number of seconds. An entry older than this
+                        is not returned but is kept in the cache.
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                value, stored, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires <= now:
+                return default
+            self._data[key] = (value, stored, expires)
+        if max_age is not None and now - stored > max_age:
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        now = time.time()
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, now, now + timeout)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,128 @@
+"""
+Circuit breakers for the upstream APIs.
+
+There is a breaker for each upstream host and endpoint class, such as
+``solitude:2602.generic.buyer``. When too many recent calls through a
+breaker fail or are too slow, it opens. While open, calls fail straight away
+with :class:`CircuitOpen` instead of tying up a worker. After
+``reset_timeout`` seconds a single probe call is let through: if it works
+the breaker closes again, if not it stays open. See
+``settings.CIRCUIT_BREAKER``.
+"""
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+from requests.exceptions import ConnectionError
+
+from webpay.base.logger import getLogger
+
+log = getLogger('lib.circuit')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpen(ConnectionError):
+    """The upstream is failing so the call was not made."""
+
+
+class Breaker(object):
+    """
+    The circuit breaker for one upstream host and endpoint class.
+
+    :param name: a statsd safe name for the breaker.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.calls = deque()
+        self.opened = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raises CircuitOpen unless a call can be made now.
+        """
+        config = settings.CIRCUIT_BREAKER
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if (self.state == OPEN and
+                    time.time() - self.opened >= config['reset_timeout']):
+                self._change(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.probing:
+                # Only one probe at a time.
+                self.probing = True
+                return
+        statsd.incr('slumber.circuit.{0}.rejected'.format(self.name))
+        raise CircuitOpen('Circuit {0} is {1}'.format(self.name, self.state))
+
+    def record(self, failed):
+        """
+        Record the outcome of a call that was allowed.
+
+        :param failed: True if the call failed or was too slow.
+        """
+        config = settings.CIRCUIT_BREAKER
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                self._change(OPEN if failed else CLOSED)
+                return
+            if self.state == OPEN:
+                # A call that started before the circuit opened.
+                return
+            self.calls.append(bool(failed))
+            while len(self.calls) > config['window']:
+                self.calls.popleft()
+            if (len(self.calls) >= config['min_calls'] and
+                    sum(self.calls) >= config['error_rate'] * len(self.calls)):
+                self._change(OPEN)
+
+    def release(self):
+        """
+        Forget a call that was allowed but tells nothing about the upstream,
+        such as one cut short by a deadline.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                # Let the next call probe.
+                self.probing = False
+
+    def _change(self, state):
+        log.warning('circuit {0}: {1} -> {2}'
+                    .format(self.name, self.state, state))
+        self.state = state
+        self.calls.clear()
+        if state == OPEN:
+            self.opened = time.time()
+        statsd.incr('slumber.circuit.{0}.{1}'.format(self.name, state))
+
+
+def get_breaker(name):
+    """
+    Returns the breaker called `name`, creating it if needed.
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, Breaker(name))
+    return breaker
+
+
+def states():
+    """
+    Returns a dict of the state of every breaker in this process.
+    """
+    return dict((name, breaker.state)
+                for name, breaker in _breakers.items())
@@ -0,0 +1,111 @@
+"""
+Deadlines for the upstream calls made while handling a request or a task.
+
+A deadline is set at the start of each web request (by
+:class:`webpay.base.middleware.DeadlineMiddleware`) and each celery task (by
+:func:`with_deadline`). Every upstream call then gets the time left as its
+timeout, or less if its endpoint has a shorter timeout. See
+``settings.UPSTREAM_TIMEOUTS``.
+
+The deadline is kept with the logging context so that calls made in
+:mod:`lib.parallel` threads share it.
+"""
+import functools
+import time
+
+from django.conf import settings
+
+from requests.exceptions import Timeout
+
+from webpay.base import logger
+
+
+class DeadlineExceeded(Timeout):
+    """There is no time left to make an upstream call."""
+
+
+def set_deadline(seconds):
+    """
+    Give the upstream calls made from now on `seconds` in total.
+    """
+    logger._local.DEADLINE = time.time() + seconds
+
+
+def clear_deadline():
+    logger._local.__dict__.pop('DEADLINE', None)
+
+
+def remaining():
+    """
+    Returns the seconds left before the deadline, or None if there is none.
+    """
+    deadline = getattr(logger._local, 'DEADLINE', None)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def endpoint_timeout(endpoint):
+    """
+    Returns the timeout for an endpoint class such as ``generic.buyer``.
+
+    The most specific override in ``UPSTREAM_TIMEOUTS['endpoints']`` wins,
+    so ``bango.billing`` is used before ``bango``.
+    """
+    config = settings.UPSTREAM_TIMEOUTS
+    overrides = config.get('endpoints', {})
+    parts = endpoint.split('.')
+    while parts:
+        name = '.'.join(parts)
+        if name in overrides:
+            return overrides[name]
+        parts.pop()
+    return config.get('default')
+
+
+def timeout_for(endpoint, timeout=None):
+    """
+    Returns the timeout for an upstream call to `endpoint`.
+
+    :param timeout: a timeout asked for by the caller, if any.
+
+    Raises DeadlineExceeded if the deadline has passed.
+    """
+    timeouts = [t for t in (timeout, endpoint_timeout(endpoint))
+                if t is not None]
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded('Deadline passed {0:.3f}s ago, not calling '
+                                   '{1}'.format(-left, endpoint))
+        timeouts.append(left)
+    return min(timeouts) if timeouts else None
+
+
+def with_deadline(seconds=None):
+    """
+    Decorate a celery task so that its upstream calls share a deadline.
+
+    A task run eagerly inside a web request keeps the deadline of the
+    request if that is sooner.
+
+    :param seconds: the time allowed, defaults to
+                    ``settings.UPSTREAM_TIMEOUTS['task']``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            previous = getattr(logger._local, 'DEADLINE', None)
+            set_deadline(seconds or settings.UPSTREAM_TIMEOUTS['task'])
+            if previous is not None and previous < logger._local.DEADLINE:
+                # The request can't wait for longer than its own deadline.
+                logger._local.DEADLINE = previous
+            try:
+                return func(*args, **kw)
+            finally:
+                if previous is None:
+                    clear_deadline()
+                else:
+                    logger._local.DEADLINE = previous
+        return wrapper
+    return decorator
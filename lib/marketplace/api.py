@@ -1,3 +1,7 @@
+import os
+import threading
+import time
+
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.decorators import method_decorator
@@ -6,6 +10,8 @@ from cache_nuggets.lib import memoize
 from requests.exceptions import ConnectionError
 
 from constants import COUNTRIES
+from ..circuit import CircuitOpen
+from ..retry import RetryPolicy
 from ..utils import SlumberWrapper
 
 from lib.solitude.constants import PROVIDER_BANGO, PROVIDERS_INVERTED
@@ -25,38 +31,189 @@ class ConnectionFailed(ConnectionError):
     pass
 
 
+class Prices(object):
+    """
+    A snapshot of the price index. It is never changed once built, a
+    refresh swaps in a new one.
+    """
+
+    def __init__(self, tiers=None, regions=None, loaded=()):
+        self.tiers = tiers or {}
+        self.regions = regions or {}
+        self.loaded = frozenset(loaded)
+
+
+class PriceIndex(object):
+    """
+    All the price tiers of each payment provider, kept in memory.
+
+    The tiers are fetched from zamboni in bulk by a background thread every
+    ``settings.PRICE_INDEX['refresh']`` seconds. A refresh builds a new
+    :class:`Prices` snapshot and swaps it in, so lookups never see a half
+    built one and never make a network call. See ``settings.PRICE_INDEX``.
+
+    :param fetch: a callable that takes a provider name and returns a list
+                  of all its tiers.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.snapshot = Prices()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the refresh thread if it is not running in this process.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            # The thread is only started once per process, it must outlive
+            # any error.
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Failed to refresh the price index')
+            time.sleep(settings.PRICE_INDEX['refresh'])
+
+    def refresh(self):
+        """
+        Fetch the tiers of every provider and swap in a new index.
+
+        A provider that fails keeps the tiers from the last refresh.
+        """
+        prices = self.snapshot
+        tiers, regions = dict(prices.tiers), dict(prices.regions)
+        loaded = set(prices.loaded)
+        for provider in settings.PAYMENT_PROVIDERS:
+            try:
+                found, found_regions = self.index(provider)
+            except Exception:
+                log.exception('Failed to fetch price tiers for {0}'
+                              .format(provider))
+                continue
+            for key in [k for k in tiers if k[1] == provider]:
+                del tiers[key]
+            for key in [k for k in regions if k[1] == provider]:
+                del regions[key]
+            tiers.update(found)
+            regions.update(found_regions)
+            loaded.add(provider)
+            log.info('Indexed {0} price tiers for {1}'
+                     .format(len(found), provider))
+        self.snapshot = Prices(tiers, regions, loaded)
+
+    def index(self, provider):
+        """
+        Fetch the tiers of a provider and returns them as the dicts of tiers
+        and of regions for the index.
+        """
+        tiers, regions = {}, {}
+        for tier in self.fetch(provider):
+            point = unicode(tier['pricePoint'])
+            tiers[(point, provider)] = tier
+            for price in tier['prices']:
+                regions.setdefault((point, provider, price.get('region')),
+                                   (price['amount'], price['currency']))
+        return tiers, regions
+
+    def get_tier(self, point, provider):
+        """
+        Returns the tier or None if it is not in the index.
+        """
+        return self.snapshot.tiers.get((unicode(point), provider))
+
+    def get_region(self, point, provider, region):
+        """
+        Returns the (amount, currency) for a region, or None if the tier is
+        not in the index.
+
+        Raises UnknownPricePoint if the tier has no price for the region.
+        """
+        prices = self.snapshot
+        if (unicode(point), provider) not in prices.tiers:
+            return None
+        try:
+            return prices.regions[(unicode(point), provider, region)]
+        except KeyError:
+            raise UnknownPricePoint(
+                'Point: {p}, provider: {v}, region: {r}'
+                .format(p=point, v=provider, r=region))
+
+
 class MarketplaceAPI(SlumberWrapper):
     errors = {}
+    name = 'marketplace'
+    # https://bugzilla.mozilla.org/show_bug.cgi?id=1024065
+    # Getting prices seems to fail more often than it should.
+    price_retry = RetryPolicy('marketplace.get_price',
+                              attempts=NUMBER_ATTEMPTS)
+
+    def __init__(self, *args, **kw):
+        super(MarketplaceAPI, self).__init__(*args, **kw)
+        self.prices = PriceIndex(self.get_all_prices)
 
-    @method_decorator(memoize('marketplace:api:get_price'))
     def get_price(self, point, provider=PROVIDERS_INVERTED[PROVIDER_BANGO]):
         """
         Get the price points from zamboni for a provider.
 
+        Tiers are looked up in the price index first, see
+        settings.PRICE_INDEX.
+
         :param point: the name of the price tier.
         :param provider: the payment provider. Defaults to 'bango'.
         """
-        # https://bugzilla.mozilla.org/show_bug.cgi?id=1024065
-        # This seems to fail more often than it should, so we'll retry
-        # it a few times.
-        #
-        # This is a filthy terrible hack.
-        for x in range(1, NUMBER_ATTEMPTS + 1):
-            log.info('Attempting to get prices: attempt: {0}'.format(x))
-            try:
-                res = (self.api.webpay.prices()
-                       .get_object(provider=provider, pricePoint=point))
-                log.info('Successfully got prices')
-                return res
-            except ObjectDoesNotExist:
-                raise UnknownPricePoint(point)
-            except ConnectionError:
-                log.error('Failed to get prices, attempt: {0}'.format(x))
-
-        # Re-raise the connection error.
-        log.error('Failed to get prices after {0} attempts'
-                  .format(NUMBER_ATTEMPTS))
-        raise ConnectionFailed(point)
+        if settings.PRICE_INDEX['enabled']:
+            self.prices.start()
+            tier = self.prices.get_tier(point, provider)
+            if tier is not None:
+                return tier
+        return self.fetch_price(point, provider)
+
+    @method_decorator(memoize('marketplace:api:get_price'))
+    def fetch_price(self, point, provider):
+        """
+        Get the price points from zamboni for a provider, without using the
+        price index.
+        """
+        try:
+            res = self.price_retry.run(
+                lambda: (self.api.webpay.prices()
+                         .get_object(provider=provider, pricePoint=point)),
+                idempotent=True)
+        except ObjectDoesNotExist:
+            raise UnknownPricePoint(point)
+        except CircuitOpen:
+            raise
+        except ConnectionError:
+            log.error('Failed to get prices for {0}'.format(point))
+            raise ConnectionFailed(point)
+        log.info('Successfully got prices')
+        return res
+
+    def get_all_prices(self, provider):
+        """
+        Returns all the price tiers for a provider.
+        """
+        tiers = []
+        offset = 0
+        while True:
+            res = self.retry.run(self.api.webpay.prices.get,
+                                 provider=provider, offset=offset)
+            tiers.extend(res['objects'])
+            if not res['meta'].get('next'):
+                return tiers
+            offset += len(res['objects'])
 
     def get_price_country(self, point, provider, country):
         """
@@ -67,9 +224,15 @@ class MarketplaceAPI(SlumberWrapper):
         :param provider: the payment provider.
         :param country: the country MCC code.
         """
-        tier = self.get_price(point, provider)
         # This assumes you've already validated the MCC is correct.
         country_id = COUNTRIES[country]
+        if settings.PRICE_INDEX['enabled']:
+            self.prices.start()
+            found = self.prices.get_region(point, provider, country_id)
+            if found is not None:
+                return found
+
+        tier = self.get_price(point, provider)
         for price in tier['prices']:
             if price.get('region', None) == country_id:
                 return price['amount'], price['currency']
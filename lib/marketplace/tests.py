@@ -1,13 +1,15 @@
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
+from django.test.utils import override_settings
 
 import mock
 from curling.lib import HttpServerError
-from nose.tools import eq_, raises
+from nose.tools import eq_, ok_, raises
 from requests.exceptions import ConnectionError
 
-from lib.marketplace.api import client, NUMBER_ATTEMPTS, UnknownPricePoint
+from lib.marketplace.api import (client, NUMBER_ATTEMPTS, PriceIndex, Prices,
+                                 UnknownPricePoint)
 from lib.solitude.constants import PROVIDER_BOKU
 
 
@@ -90,3 +92,88 @@ class SolitudeAPITest(TestCase):
         slumber.webpay.prices.side_effect = failure
         client.get_price(1)
         eq_(slumber.webpay.prices.call_count, 3)
+
+
+@override_settings(PAYMENT_PROVIDERS=['boku'])
+class TestPriceIndex(TestCase):
+
+    def setUp(self):
+        self.fetch = mock.Mock(return_value=[sample_price])
+        self.index = PriceIndex(self.fetch)
+        self.index.refresh()
+
+    def test_tier(self):
+        eq_(self.index.get_tier(0, 'boku'), sample_price)
+        eq_(self.index.get_tier('0', 'boku'), sample_price)
+        eq_(self.index.get_tier('1', 'boku'), None)
+        eq_(self.index.get_tier('0', 'bango'), None)
+
+    def test_region(self):
+        eq_(self.index.get_region('0', 'boku', 12), (u'3.00', u'MXN'))
+        eq_(self.index.get_region('1', 'boku', 12), None)
+
+    @raises(UnknownPricePoint)
+    def test_no_region(self):
+        self.index.get_region('0', 'boku', 999)
+
+    def test_failed_refresh_keeps_tiers(self):
+        self.fetch.side_effect = ConnectionError
+        self.index.refresh()
+        eq_(self.index.get_tier('0', 'boku'), sample_price)
+
+    def test_bad_tier_keeps_tiers(self):
+        self.fetch.return_value = [{'pricePoint': '1'}]
+        self.index.refresh()
+        eq_(self.index.get_tier('0', 'boku'), sample_price)
+        eq_(self.index.get_tier('1', 'boku'), None)
+
+    @mock.patch('lib.marketplace.api.time.sleep')
+    def test_run_survives_errors(self, sleep):
+        sleep.side_effect = [None, StopIteration]
+        with mock.patch.object(self.index, 'refresh') as refresh:
+            refresh.side_effect = KeyError
+            with self.assertRaises(StopIteration):
+                self.index.run()
+        eq_(refresh.call_count, 2)
+
+    def test_refresh_drops_old_tiers(self):
+        self.fetch.return_value = []
+        self.index.refresh()
+        eq_(self.index.get_tier('0', 'boku'), None)
+
+
+@override_settings(PRICE_INDEX={'enabled': True, 'refresh': 300})
+@mock.patch('lib.marketplace.api.client.api')
+class TestIndexedPrices(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.prices = PriceIndex(mock.Mock())
+        self.prices.snapshot = Prices({(u'0', 'boku'): sample_price},
+                                      {(u'0', 'boku', 12): (u'3.00', u'MXN')})
+        p = mock.patch.object(client, 'prices', self.prices)
+        p.start()
+        self.addCleanup(p.stop)
+        # Don't start the refresh thread.
+        self.prices.start = mock.Mock()
+
+    def test_no_network(self, slumber):
+        eq_(client.get_price('0', 'boku'), sample_price)
+        eq_(client.get_price_country('0', 'boku', '334'),
+            (u'3.00', u'MXN'))
+        ok_(not slumber.webpay.prices.called)
+
+    def test_fallback(self, slumber):
+        sample = mock.Mock()
+        sample.get_object.return_value = sample_price
+        slumber.webpay.prices.return_value = sample
+        eq_(client.get_price('0', 'bango'), sample_price)
+        eq_(slumber.webpay.prices.call_count, 1)
+
+    def test_get_all_prices(self, slumber):
+        slumber.webpay.prices.get.side_effect = [
+            {'meta': {'next': '/next'}, 'objects': [sample_price]},
+            {'meta': {'next': None}, 'objects': [sample_price]}]
+        eq_(len(client.get_all_prices('boku')), 2)
+        slumber.webpay.prices.get.assert_called_with(provider='boku',
+                                                     offset=1)
@@ -0,0 +1,161 @@
+"""
+Run independent upstream calls at the same time.
+
+Calls run in a small thread pool shared by the whole process. The logging
+context of the caller (transaction ID, remote address) is copied into the
+thread so that log lines and the Transaction-Id header stay the same.
+"""
+import functools
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+
+from webpay.base import logger
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the thread pool for this process, creating it if needed.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ThreadPool(settings.PARALLEL_WORKERS)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+class Failure(object):
+    """An exception raised in a pool thread, with its traceback."""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+class Pending(object):
+    """
+    The result of a call started with :func:`submit`.
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def ready(self):
+        return self.result.ready()
+
+    def get(self, timeout=None):
+        """
+        Wait for the call and return its result or raise its exception.
+        """
+        value = self.result.get(timeout)
+        if isinstance(value, Failure):
+            value.reraise()
+        return value
+
+
+class Done(object):
+    """The result of a call that was run straight away."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        if isinstance(self.value, Failure):
+            self.value.reraise()
+        return self.value
+
+
+def _run(context, stat, func, args, kwargs):
+    # Put back the thread's own context afterwards, so that nothing else
+    # run on it gets the caller's context or deadline.
+    previous = dict(logger._local.__dict__)
+    logger._local.__dict__.clear()
+    logger._local.__dict__.update(context)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        return Failure(sys.exc_info())
+    finally:
+        if stat:
+            statsd.timing(stat, int((time.time() - start) * 1000))
+        logger._local.__dict__.clear()
+        logger._local.__dict__.update(previous)
+
+
+def capture(func, args=(), kwargs=None, stat=None, deadline=True):
+    """
+    Returns a callable that calls `func` with the logging context of the
+    caller, for running on threads other than the pool's.
+
+    :param deadline: False to leave out the caller's deadline, for calls
+                     that can run after the caller has finished.
+
+    The callable returns the result of `func` or a :class:`Failure`.
+    """
+    context = dict(logger._local.__dict__)
+    if not deadline:
+        context.pop('DEADLINE', None)
+    return functools.partial(_run, context, stat, func, args, kwargs or {})
+
+
+def submit(func, args=(), kwargs=None, stat=None):
+    """
+    Start calling `func` in the thread pool.
+
+    :param stat: optional statsd key to time the call with.
+    :rtype: an object with a ``get()`` method that returns the result.
+
+    When ``settings.PARALLEL_WORKERS`` is 0 the call is made straight away.
+    """
+    call = capture(func, args, kwargs, stat)
+    if not settings.PARALLEL_WORKERS:
+        return Done(call())
+    return Pending(get_pool().apply_async(call))
+
+
+def fan_out(calls, stat=None):
+    """
+    Run independent calls at the same time and wait for all of them.
+
+    :param calls: a list of ``(name, callable)`` tuples.
+    :param stat: optional statsd prefix, each call is timed as
+                 ``<stat>.<name>``.
+    :rtype: a dict of name to result.
+
+    If any call raises an exception, the exception of the first failing
+    call in the list is raised once all calls have finished.
+    """
+    pending = []
+    for name, func in calls:
+        key = '{0}.{1}'.format(stat, name) if stat else None
+        pending.append((name, submit(func, stat=key)))
+
+    results = {}
+    error = None
+    for name, result in pending:
+        try:
+            results[name] = result.get()
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    if error:
+        raise error[0], error[1], error[2]
+    return results
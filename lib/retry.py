@@ -0,0 +1,104 @@
+"""
+Retrying upstream reads that failed to connect or timed out.
+"""
+import random
+import time
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+from requests.exceptions import ConnectionError, Timeout
+
+from webpay.base.logger import getLogger
+
+from .circuit import CircuitOpen
+from .deadline import DeadlineExceeded, remaining
+
+log = getLogger('lib.retry')
+
+# Slumber and curling methods that never change anything.
+IDEMPOTENT = ('get', 'get_object', 'get_object_or_404', 'head', 'options')
+
+
+class RetryPolicy(object):
+    """
+    Retries a call with exponential backoff and jitter.
+
+    The options default to ``settings.UPSTREAM_RETRY``:
+
+    :param attempts: the most attempts, including the first one.
+    :param base: seconds to back off after the first failure, doubled after
+                 each failure after that.
+    :param cap: the most seconds to back off.
+    :param budget: the most seconds to spend on all the attempts. There is
+                   no retry if it would go over.
+
+    Each back off is a random time up to the exponential one so that
+    callers that failed together don't retry together.
+
+    :param name: the statsd name, e.g. ``marketplace.get_price``.
+    """
+    retry_on = (ConnectionError, Timeout)
+    # The upstream is known to be failing or there is no time left.
+    fail_fast = (CircuitOpen, DeadlineExceeded)
+    # The setting with the default options.
+    setting = 'UPSTREAM_RETRY'
+
+    def __init__(self, name, **options):
+        self.name = name
+        self.options = options
+
+    def config(self):
+        config = dict(getattr(settings, self.setting))
+        config.update(self.options)
+        return config
+
+    def backoff(self, attempt, config=None):
+        """
+        Returns the seconds to back off after attempt number `attempt`
+        failed.
+        """
+        config = config or self.config()
+        return random.uniform(
+            0, min(config['cap'], config['base'] * 2 ** (attempt - 1)))
+
+    def run(self, command, *args, **kw):
+        """
+        Call ``command(*args, **kw)``, retrying it if it is idempotent.
+
+        A command is idempotent if it is one of the slumber read methods,
+        like ``get_object``. Pass ``idempotent=True`` for others.
+        """
+        idempotent = kw.pop('idempotent', None)
+        if idempotent is None:
+            idempotent = getattr(command, '__name__', None) in IDEMPOTENT
+        if not idempotent:
+            return command(*args, **kw)
+
+        config = self.config()
+        start = time.time()
+        attempt = 1
+        while True:
+            try:
+                result = command(*args, **kw)
+            except self.fail_fast:
+                raise
+            except self.retry_on, err:
+                delay = self.backoff(attempt, config)
+                left = remaining()
+                if (attempt >= config['attempts'] or
+                        time.time() - start + delay > config['budget'] or
+                        (left is not None and delay >= left)):
+                    log.error('{0}: giving up after {1} attempts: {2}'
+                              .format(self.name, attempt, err))
+                    statsd.incr('retry.{0}.exhausted'.format(self.name))
+                    raise
+                log.warning('{0}: attempt {1} failed, retrying in {2:.2f}s: '
+                            '{3}'.format(self.name, attempt, delay, err))
+                statsd.incr('retry.{0}.retry'.format(self.name))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if attempt > 1:
+                statsd.incr('retry.{0}.recovered'.format(self.name))
+            return result
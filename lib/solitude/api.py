@@ -1,6 +1,7 @@
 import json
 import logging
 import sys
+import threading
 import uuid
 import warnings
 
@@ -10,6 +11,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 
 import mobile_codes
+from django_statsd.clients import statsd
 from mpconstants import countries
 from slumber.exceptions import HttpClientError
 
@@ -19,6 +21,9 @@ from webpay.base.helpers import absolutify
 
 from . import constants as solitude_const
 from .exceptions import ProviderTransactionError, ResourceNotModified
+from .. import parallel
+from ..cache import LocalCache
+from ..transport import Hedger
 from ..utils import SlumberWrapper
 
 
@@ -36,6 +41,58 @@ class SellerNotConfigured(Exception):
     error_code = 'SELLER_NOT_CONFIGURED'
 
 
+class ResourceIndex(object):
+    """
+    Remembers where solitude objects live.
+
+    Solitude objects are usually found by filtering a list on their uuid
+    (or public_id for products) but writes and later reads need the
+    resource_pk. This maps the lookup value to the resource_pk and
+    resource_uri of every object seen so that they can go straight to the
+    detail URI. See settings.SOLITUDE_INDEX_TIMEOUT.
+    """
+
+    def _key(self, resource, lookup):
+        return 'solitude:{0}:{1}'.format(resource, lookup)
+
+    def add(self, resource, lookup, obj):
+        """
+        Index a solitude object, objects without a resource_pk are ignored.
+
+        :param resource: the generic resource name, e.g. ``buyer``.
+        :param lookup: the uuid or public_id the object is found by.
+        :param obj: the object as returned by solitude.
+        """
+        timeout = settings.SOLITUDE_INDEX_TIMEOUT
+        if not timeout or not lookup or not obj or 'resource_pk' not in obj:
+            return
+        cache.set(self._key(resource, lookup),
+                  {'resource_pk': obj['resource_pk'],
+                   'resource_uri': obj.get('resource_uri')},
+                  timeout)
+
+    def get(self, resource, lookup):
+        """
+        Returns a dict of resource_pk and resource_uri or None.
+        """
+        if not settings.SOLITUDE_INDEX_TIMEOUT or not lookup:
+            return None
+        found = cache.get(self._key(resource, lookup))
+        statsd.incr('solitude.index.{0}.{1}'
+                    .format(resource, 'hit' if found else 'miss'))
+        return found
+
+    def pk(self, resource, lookup):
+        found = self.get(resource, lookup)
+        return found['resource_pk'] if found else None
+
+    def delete(self, resource, lookup):
+        cache.delete(self._key(resource, lookup))
+
+
+resources = ResourceIndex()
+
+
 class SolitudeAPI(SlumberWrapper):
     """
     A Solitude facade that works with a payment provider or the
@@ -43,9 +100,17 @@ class SolitudeAPI(SlumberWrapper):
 
     :param url: URL of the solitude endpoint.
     """
+    name = 'solitude'
 
     def __init__(self, *args, **kw):
         super(SolitudeAPI, self).__init__(*args, **kw)
+        # Buyers read recently by this process, see settings.BUYER_CACHE.
+        self.buyers = LocalCache(
+            maxsize=settings.BUYER_CACHE.get('local_size', 1000))
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        # Slow reads can be hedged, see settings.SOLITUDE_HEDGING.
+        self.adapter.hedger = Hedger()
 
     def create_buyer(self, uuid, email, pin=None, pin_confirmed=False):
         """Creates a buyer with an optional PIN in solitude.
@@ -64,17 +129,38 @@ class SolitudeAPI(SlumberWrapper):
         }
 
         obj = self.safe_run(self.slumber.generic.buyer.post, pin_data)
+        resources.add('buyer', uuid, obj)
 
         if 'etag' in obj:
             etag = obj['etag']
             cache.set('etag:%s' % uuid, etag)
             cache.set('buyer:%s' % etag, obj)
+            self.cache_buyer(uuid, obj)
         return obj
 
     def get_buyer(self, uuid, use_etags=True):
         """Retrieves a buyer by their uuid.
 
+        Recently read buyers are returned from the buyer cache without
+        asking solitude, see settings.BUYER_CACHE.
+
+        :param uuid: String to identify the buyer by.
+        :param use_etags: When False, skip all caches and always fetch the
+                          buyer from solitude.
+        :rtype: dictionary
+        """
+        if use_etags:
+            obj = self.get_cached_buyer(uuid)
+            if obj is not None:
+                return obj
+        return self.fetch_buyer(uuid, use_etags=use_etags)
+
+    def fetch_buyer(self, uuid, use_etags=True):
+        """Retrieves a buyer from solitude and stores it in the buyer cache.
+
         :param uuid: String to identify the buyer by.
+        :param use_etags: When True, send a conditional request using the
+                          last etag seen for this buyer.
         :rtype: dictionary
         """
         cache_key = 'etag:%s' % uuid
@@ -84,26 +170,111 @@ class SolitudeAPI(SlumberWrapper):
             obj = self.safe_run(self.slumber.generic.buyer.get_object_or_404,
                                 headers=headers, uuid=uuid)
         except ResourceNotModified:
-            return (cache.get('buyer:%s' % etag)
-                    or self.get_buyer(uuid, use_etags=False))
+            obj = cache.get('buyer:%s' % etag)
+            if not obj:
+                return self.fetch_buyer(uuid, use_etags=False)
+            self.cache_buyer(uuid, obj)
+            return obj
         except ObjectDoesNotExist:
             obj = {}
+        resources.add('buyer', uuid, obj)
         if 'etag' in obj:
             etag = obj['etag']
             cache.set(cache_key, etag)
             cache.set('buyer:%s' % etag, obj)
+            self.cache_buyer(uuid, obj)
         return obj
 
+    def get_cached_buyer(self, uuid):
+        """Returns a buyer from the buyer cache or None on a miss.
+
+        The in-process cache is tried first, then memcache. With
+        stale_while_revalidate on, an expired in-process entry is still
+        returned and the buyer is refreshed in a background thread.
+        """
+        config = settings.BUYER_CACHE
+        obj = self.buyers.get(uuid, max_age=config.get('local_timeout', 0))
+        if obj is not None:
+            statsd.incr('solitude.buyer_cache.hit.local')
+            return obj
+
+        if config.get('stale_while_revalidate'):
+            obj = self.buyers.get(uuid)
+            if obj is not None:
+                statsd.incr('solitude.buyer_cache.hit.stale')
+                self.refresh_buyer(uuid)
+                return obj
+
+        if config.get('timeout'):
+            obj = cache.get('buyer:uuid:%s' % uuid)
+            if obj is not None:
+                statsd.incr('solitude.buyer_cache.hit.shared')
+                self.buyers.set(uuid, obj, timeout=self._local_timeout())
+                return obj
+
+        statsd.incr('solitude.buyer_cache.miss')
+        return None
+
+    def cache_buyer(self, uuid, obj):
+        config = settings.BUYER_CACHE
+        if config.get('timeout'):
+            cache.set('buyer:uuid:%s' % uuid, obj, config['timeout'])
+        if self._local_timeout():
+            self.buyers.set(uuid, obj, timeout=self._local_timeout())
+
+    def invalidate_buyer(self, uuid):
+        """Removes a buyer from the buyer cache after a change in solitude.
+        """
+        self.buyers.delete(uuid)
+        cache.delete('buyer:uuid:%s' % uuid)
+
+    def refresh_buyer(self, uuid):
+        """Fetches a buyer from solitude in a background thread.
+
+        Only one refresh per buyer runs at a time in each process.
+        """
+        with self._refreshing_lock:
+            if uuid in self._refreshing:
+                return
+            self._refreshing.add(uuid)
+
+        def refresh():
+            try:
+                self.fetch_buyer(uuid)
+            except Exception:
+                log.exception('refreshing cached buyer {0}'.format(uuid))
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(uuid)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _local_timeout(self):
+        # Entries are kept for the stale window but only served as fresh
+        # for local_timeout seconds.
+        config = settings.BUYER_CACHE
+        timeout = config.get('local_timeout', 0)
+        if timeout and config.get('stale_while_revalidate'):
+            timeout = max(timeout, config.get('stale_timeout', 0))
+        return timeout
+
     def update_buyer(self, uuid, etag='', **kwargs):
         """Updates a buyer identified by their uuid.
 
         :param uuid: String to identify the buyer by.
         :rtype: dictionary
         """
-        id_ = self.get_buyer(uuid).get('resource_pk')
-        res = self.safe_run(self.slumber.generic.buyer(id=id_).patch,
-                            kwargs,
-                            headers={'If-Match': etag})
+        id_ = resources.pk('buyer', uuid)
+        if id_ is None:
+            id_ = self.get_buyer(uuid).get('resource_pk')
+        try:
+            res = self.safe_run(self.slumber.generic.buyer(id=id_).patch,
+                                kwargs,
+                                headers={'If-Match': etag})
+        finally:
+            self.invalidate_buyer(uuid)
         if 'errors' in res:
             return res
         return {}
@@ -145,8 +316,11 @@ class SolitudeAPI(SlumberWrapper):
         :param public_id: Product public_id.
         :rtype: dictionary
         """
-        return self.slumber.generic.product.get_object_or_404(
+        product = self.retry.run(
+            self.slumber.generic.product.get_object_or_404,
             seller__active=True, public_id=public_id)
+        resources.add('product', public_id, product)
+        return product
 
     def confirm_pin(self, uuid, pin):
         """Confirms the buyer's pin, marking it at confirmed in solitude
@@ -156,8 +330,11 @@ class SolitudeAPI(SlumberWrapper):
         :rtype: boolean
         """
 
-        res = self.safe_run(self.slumber.generic.confirm_pin.post,
-                            {'uuid': uuid, 'pin': pin})
+        try:
+            res = self.safe_run(self.slumber.generic.confirm_pin.post,
+                                {'uuid': uuid, 'pin': pin})
+        finally:
+            self.invalidate_buyer(uuid)
         return res.get('confirmed', False)
 
     def reset_confirm_pin(self, uuid, pin):
@@ -168,8 +345,11 @@ class SolitudeAPI(SlumberWrapper):
         :rtype: boolean
         """
 
-        res = self.safe_run(self.slumber.generic.reset_confirm_pin.post,
-                            {'uuid': uuid, 'pin': pin})
+        try:
+            res = self.safe_run(self.slumber.generic.reset_confirm_pin.post,
+                                {'uuid': uuid, 'pin': pin})
+        finally:
+            self.invalidate_buyer(uuid)
         return res.get('confirmed', False)
 
     def verify_pin(self, uuid, pin):
@@ -180,12 +360,23 @@ class SolitudeAPI(SlumberWrapper):
         :rtype: dictionary
         """
 
-        res = self.safe_run(self.slumber.generic.verify_pin.post,
-                            {'uuid': uuid, 'pin': pin})
+        try:
+            res = self.safe_run(self.slumber.generic.verify_pin.post,
+                                {'uuid': uuid, 'pin': pin})
+        finally:
+            # Solitude counts failed attempts and locks the buyer out.
+            self.invalidate_buyer(uuid)
         return res
 
     def get_transaction(self, uuid):
-        transaction = self.slumber.generic.transaction.get_object(uuid=uuid)
+        pk = resources.pk('transaction', uuid)
+        if pk is not None:
+            transaction = self.retry.run(
+                self.slumber.generic.transaction(pk).get_object_or_404)
+        else:
+            transaction = self.retry.run(
+                self.slumber.generic.transaction.get_object, uuid=uuid)
+            resources.add('transaction', uuid, transaction)
         # Notes may contain some JSON, including the original pay request.
         notes = transaction['notes']
         if notes:
@@ -244,22 +435,16 @@ class ProviderHelper:
                           mcc=None, mnc=None):
         """
         Start a payment provider transaction to begin the purchase flow.
-        """
-        try:
-            generic_buyer = self.slumber.generic.buyer.get_object_or_404(
-                uuid=user_uuid)
-        except ObjectDoesNotExist:
-            raise BuyerNotConfigured(
-                '{pr}: Buyer with uuid {u} does not exist'
-                .format(u=user_uuid, pr=self.provider.name))
 
-        try:
-            generic_seller = self.slumber.generic.seller.get_object_or_404(
-                uuid=generic_seller_uuid)
-        except ObjectDoesNotExist:
-            raise SellerNotConfigured(
-                '{pr}: Seller with uuid {u} does not exist'
-                .format(u=generic_seller_uuid, pr=self.provider.name))
+        The buyer and seller lookups do not depend on each other so they
+        are made at the same time.
+        """
+        found = parallel.fan_out(
+            [('buyer', lambda: self.get_generic_buyer(user_uuid)),
+             ('seller', lambda: self.get_generic_seller(generic_seller_uuid))],
+            stat='solitude.start_transaction')
+        generic_buyer = found['buyer']
+        generic_seller = found['seller']
         generic_seller_id = generic_seller['resource_pk']
         log.info('{pr}: starting transaction {tr}: generic seller: {sel}'
                  .format(tr=transaction_uuid, sel=generic_seller_id,
@@ -270,14 +455,16 @@ class ProviderHelper:
 
         product = None
         try:
-            product = self.slumber.generic.product.get_object_or_404(
-                external_id=product_id,
-                seller=generic_seller_id,
-            )
+            with statsd.timer('solitude.start_transaction.product'):
+                product = self.slumber.generic.product.get_object_or_404(
+                    external_id=product_id,
+                    seller=generic_seller_id,
+                )
             log.info('{pr}: found generic product {prod}'
                      .format(pr=self.provider.name, prod=product))
-            provider_product = self.provider.get_product(generic_seller,
-                                                         product)
+            with statsd.timer('solitude.start_transaction.provider_product'):
+                provider_product = self.provider.get_product(generic_seller,
+                                                             product)
             log.info('{pr}: found provider product {prod}'
                      .format(prod=provider_product, pr=self.provider.name))
         except ObjectDoesNotExist:
@@ -307,6 +494,46 @@ class ProviderHelper:
 
         return trans_token, pay_url, generic_seller_id
 
+    def get_generic_buyer(self, user_uuid):
+        """
+        Returns the generic buyer or raises BuyerNotConfigured.
+        """
+        try:
+            return self.get_generic('buyer', user_uuid)
+        except ObjectDoesNotExist:
+            raise BuyerNotConfigured(
+                '{pr}: Buyer with uuid {u} does not exist'
+                .format(u=user_uuid, pr=self.provider.name))
+
+    def get_generic_seller(self, generic_seller_uuid):
+        """
+        Returns the generic seller or raises SellerNotConfigured.
+        """
+        try:
+            return self.get_generic('seller', generic_seller_uuid)
+        except ObjectDoesNotExist:
+            raise SellerNotConfigured(
+                '{pr}: Seller with uuid {u} does not exist'
+                .format(u=generic_seller_uuid, pr=self.provider.name))
+
+    def get_generic(self, resource, uuid, lookup='uuid'):
+        """
+        Returns a generic object by uuid, from its detail URI when the
+        object is in the resource index.
+
+        :param lookup: the field `uuid` is for, such as ``public_id`` for
+                       products.
+
+        Raises ObjectDoesNotExist if the object is not found.
+        """
+        api = getattr(self.slumber.generic, resource)
+        pk = resources.pk(resource, uuid)
+        if pk is not None:
+            return api(pk).get_object_or_404()
+        obj = api.get_object_or_404(**{lookup: uuid})
+        resources.add(resource, uuid, obj)
+        return obj
+
     def create_product(self, external_id, product_name, generic_seller,
                        provider_seller_uuid, generic_product=None):
         """
@@ -623,6 +850,7 @@ class ReferenceProvider(PayProvider):
             'amount': price,
             'currency': currency,
         })
+        resources.add('transaction', transaction_uuid, trans)
         log.info('made solitude trans {trans}'.format(trans=trans))
 
         token = provider_trans['token']
@@ -725,6 +953,7 @@ class BokuProvider(PayProvider):
             'type': solitude_const.TYPE_PAYMENT,
             'uuid': transaction_uuid,
         })
+        resources.add('transaction', transaction_uuid, trans)
         log.info('{pr}: made solitude trans {trans}'
                  .format(pr=self.name, trans=trans))
 
@@ -865,6 +1094,7 @@ class BangoProvider(PayProvider):
             'uuid': transaction_uuid,
             'uid_pay': bill_id
         })
+        resources.add('transaction', transaction_uuid, trans)
         log.info('{pr}: made solitude trans {trans}'
                  .format(pr=self.name, trans=trans))
 
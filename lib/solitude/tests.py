@@ -1,9 +1,12 @@
 import json
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
+from django.test.utils import override_settings
 
 import mobile_codes
 import mock
@@ -11,8 +14,8 @@ from mpconstants import countries
 from nose.tools import eq_, raises
 from slumber.exceptions import HttpClientError
 
-from lib.solitude.api import (BokuProvider, client,
-                              ProviderHelper, SellerNotConfigured)
+from lib.solitude.api import (BokuProvider, BuyerNotConfigured, client,
+                              ProviderHelper, resources, SellerNotConfigured)
 from lib.solitude import constants
 from lib.solitude.exceptions import ResourceModified, ResourceNotModified
 from webpay.base import dev_messages as msg
@@ -301,6 +304,140 @@ class SolitudeAPITest(TestCase):
                                        headers={'If-Match': ''})
 
 
+@override_settings(BUYER_CACHE={'timeout': 30, 'local_timeout': 5,
+                                'stale_while_revalidate': False,
+                                'stale_timeout': 60})
+@mock.patch('lib.solitude.api.client.slumber')
+class BuyerCacheTest(TestCase):
+
+    def setUp(self):
+        super(BuyerCacheTest, self).setUp()
+        self.uuid = 'cached:uuid'
+        self.buyer_data = {'uuid': self.uuid, 'resource_pk': '5678',
+                           'etag': 'etag:cached'}
+        client.buyers.clear()
+        cache.clear()
+
+    def lookup(self, slumber):
+        return slumber.generic.buyer.get_object_or_404
+
+    def test_local_hit_skips_solitude(self, slumber):
+        self.lookup(slumber).return_value = self.buyer_data
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        eq_(self.lookup(slumber).call_count, 1)
+
+    def test_shared_hit_skips_solitude(self, slumber):
+        self.lookup(slumber).return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        # Simulate another process with an empty local cache.
+        client.buyers.clear()
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        eq_(self.lookup(slumber).call_count, 1)
+
+    def test_no_etags_skips_cache(self, slumber):
+        self.lookup(slumber).return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        client.get_buyer(self.uuid, use_etags=False)
+        eq_(self.lookup(slumber).call_count, 2)
+
+    def test_missing_buyer_not_cached(self, slumber):
+        self.lookup(slumber).side_effect = ObjectDoesNotExist
+        eq_(client.get_buyer(self.uuid), {})
+        eq_(client.get_buyer(self.uuid), {})
+        eq_(self.lookup(slumber).call_count, 2)
+
+    def test_update_invalidates(self, slumber):
+        self.lookup(slumber).return_value = self.buyer_data
+        slumber.generic.buyer.return_value.patch.return_value = {}
+        client.get_buyer(self.uuid)
+        client.change_pin(self.uuid, '1234')
+        client.get_buyer(self.uuid)
+        eq_(self.lookup(slumber).call_count, 2)
+
+    def test_verify_pin_invalidates(self, slumber):
+        self.lookup(slumber).return_value = self.buyer_data
+        slumber.generic.verify_pin.post.return_value = {'valid': False}
+        client.get_buyer(self.uuid)
+        client.verify_pin(self.uuid, '1234')
+        client.get_buyer(self.uuid)
+        eq_(self.lookup(slumber).call_count, 2)
+
+    def test_create_fills_cache(self, slumber):
+        slumber.generic.buyer.post.return_value = self.buyer_data
+        client.create_buyer(self.uuid, 'buyer@buying.com')
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        assert not self.lookup(slumber).called
+
+    @mock.patch.object(client, 'refresh_buyer')
+    def test_stale_while_revalidate(self, refresh_buyer, slumber):
+        self.lookup(slumber).return_value = self.buyer_data
+        with self.settings(BUYER_CACHE={'timeout': 0, 'local_timeout': 5,
+                                        'stale_while_revalidate': True,
+                                        'stale_timeout': 60}):
+            client.get_buyer(self.uuid)
+            later = time.time() + 10
+            with mock.patch('lib.cache.time.time') as now:
+                now.return_value = later
+                eq_(client.get_buyer(self.uuid), self.buyer_data)
+        refresh_buyer.assert_called_with(self.uuid)
+        eq_(self.lookup(slumber).call_count, 1)
+
+
+@override_settings(SOLITUDE_INDEX_TIMEOUT=60)
+@mock.patch('lib.solitude.api.client.slumber')
+class ResourceIndexTest(TestCase):
+
+    def setUp(self):
+        super(ResourceIndexTest, self).setUp()
+        cache.clear()
+        self.uuid = 'indexed:uuid'
+        self.trans = {'uuid': self.uuid, 'resource_pk': 7,
+                      'resource_uri': '/generic/transaction/7/', 'notes': ''}
+
+    def test_add(self, slumber):
+        resources.add('transaction', self.uuid, self.trans)
+        eq_(resources.get('transaction', self.uuid),
+            {'resource_pk': 7, 'resource_uri': '/generic/transaction/7/'})
+        eq_(resources.pk('transaction', self.uuid), 7)
+
+    def test_ignore_empty(self, slumber):
+        resources.add('transaction', self.uuid, {})
+        eq_(resources.get('transaction', self.uuid), None)
+
+    def test_disabled(self, slumber):
+        with self.settings(SOLITUDE_INDEX_TIMEOUT=0):
+            resources.add('transaction', self.uuid, self.trans)
+        eq_(resources.get('transaction', self.uuid), None)
+
+    def test_get_transaction_uses_detail(self, slumber):
+        api = slumber.generic.transaction
+        api.get_object.return_value = self.trans
+        api.return_value.get_object_or_404.return_value = self.trans
+        client.get_transaction(self.uuid)
+        client.get_transaction(self.uuid)
+        eq_(api.get_object.call_count, 1)
+        api.assert_called_with(7)
+
+    def test_update_buyer_skips_lookup(self, slumber):
+        resources.add('buyer', self.uuid, {'resource_pk': 5})
+        slumber.generic.buyer.return_value.patch.return_value = {}
+        client.change_pin(self.uuid, '1234')
+        slumber.generic.buyer.assert_called_with(id=5)
+        assert not slumber.generic.buyer.get_object_or_404.called
+
+    def test_get_product_uses_detail(self, slumber):
+        api = slumber.generic.product
+        api.get_object_or_404.return_value = {
+            'public_id': 'app:id', 'resource_pk': 3,
+            'resource_uri': '/generic/product/3/'}
+        client.get_generic('product', 'app:id', lookup='public_id')
+        api.get_object_or_404.assert_called_with(public_id='app:id')
+        client.get_generic('product', 'app:id', lookup='public_id')
+        eq_(api.get_object_or_404.call_count, 1)
+        api.assert_called_with(3)
+
+
 class TestBango(TestCase):
     uuid = 'some:pin'
     seller = {'bango': {'seller': 's', 'resource_uri': 'r',
@@ -352,6 +489,21 @@ class TestBango(TestCase):
         with self.assertRaises(SellerNotConfigured):
             self.start()
 
+    def test_no_buyer(self):
+        self.slumber.generic.buyer.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        with self.assertRaises(BuyerNotConfigured):
+            self.start()
+
+    def test_no_buyer_or_seller(self):
+        # The buyer lookup comes first so its error wins.
+        self.slumber.generic.buyer.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        self.slumber.generic.seller.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        with self.assertRaises(BuyerNotConfigured):
+            self.start()
+
     def test_no_bango_product(self):
         slumber = self.slumber
         slumber.generic.seller.get_object_or_404.return_value = self.seller
@@ -0,0 +1,589 @@
+import threading
+import time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, ok_
+import requests
+
+from webpay.base import logger
+from lib import circuit, deadline, parallel
+from lib.cache import LocalCache
+from lib.retry import RetryPolicy
+from lib.transport import (end_rollup, endpoint_class, Hedger, mount_pool,
+                           PooledAdapter, PoolMetrics, record_call,
+                           SingleFlight, start_rollup, stat_key)
+
+
+class TestPooledAdapter(TestCase):
+
+    def setUp(self):
+        self.adapter = PooledAdapter(hosts=2, connections=3, timeout=1)
+
+    def test_pool_size(self):
+        pool = self.adapter.get_connection('http://solitude:2602/generic/')
+        eq_(pool.pool.maxsize, 3)
+        ok_(pool.block)
+
+    def test_pool_instrumented_once(self):
+        url = 'http://solitude:2602/generic/'
+        pool = self.adapter.get_connection(url)
+        metrics = pool.webpay_metrics
+        eq_(self.adapter.get_connection(url).webpay_metrics, metrics)
+
+    @mock.patch('lib.transport.os.getpid')
+    def test_new_pools_after_fork(self, getpid):
+        getpid.return_value = 1
+        adapter = PooledAdapter()
+        manager = adapter.poolmanager
+        adapter.get_connection('http://solitude:2602/')
+        eq_(adapter.poolmanager, manager)
+
+        getpid.return_value = 2
+        adapter.get_connection('http://solitude:2602/')
+        ok_(adapter.poolmanager is not manager)
+
+
+@mock.patch('lib.transport.statsd')
+class TestPoolMetrics(TestCase):
+
+    def setUp(self):
+        adapter = PooledAdapter(connections=2, timeout=1)
+        self.pool = adapter.get_connection('http://solitude.local:2602/')
+        self.metrics = self.pool.webpay_metrics
+
+    def test_checkout(self, statsd):
+        conn = self.pool._get_conn()
+        eq_(self.metrics.active, 1)
+        statsd.timing.assert_called_with(
+            'slumber.pool.solitude_local.checkout_wait', mock.ANY)
+        statsd.gauge.assert_any_call('slumber.pool.solitude_local.active', 1)
+
+        self.pool._put_conn(conn)
+        eq_(self.metrics.active, 0)
+        statsd.gauge.assert_any_call('slumber.pool.solitude_local.idle', 1)
+
+    def test_default_timeout(self, statsd):
+        get_conn = mock.Mock()
+        metrics = PoolMetrics(mock.Mock(host='h', _get_conn=get_conn),
+                              timeout=5)
+        metrics.get_conn()
+        get_conn.assert_called_with(timeout=5)
+
+
+class TestMountPool(TestCase):
+
+    def test_mount(self):
+        session = requests.session()
+        adapter = mount_pool(session, {'connections': 4})
+        eq_(session.get_adapter('https://solitude/'), adapter)
+        eq_(session.get_adapter('http://solitude/'), adapter)
+        ok_('Connection' not in session.headers)
+
+    def test_no_keep_alive(self):
+        session = requests.session()
+        mount_pool(session, {'keep_alive': False})
+        eq_(session.headers['Connection'], 'close')
+
+
+@mock.patch('lib.transport.statsd')
+class TestSingleFlight(TestCase):
+
+    def request(self, method='GET', **headers):
+        return requests.Request(method, 'http://solitude/generic/product/',
+                                headers=headers).prepare()
+
+    def test_key(self, statsd):
+        flight = SingleFlight()
+        eq_(flight.key(self.request(Authorization='a',
+                                    **{'Transaction-Id': 'x'})),
+            flight.key(self.request(Authorization='b')))
+        ok_(flight.key(self.request(**{'If-None-Match': 'etag'})) !=
+            flight.key(self.request()))
+
+    def test_coalesced(self, statsd):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def send():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return mock.Mock(content='{}')
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flight.call(self.request(), send)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(
+            target=lambda: results.append(flight.call(self.request(), send)))
+        follower.start()
+        # Wait for the follower to join the flight.
+        while not flight.flights[flight.key(self.request())].waiting:
+            time.sleep(0.01)
+        release.set()
+        leader.join()
+        follower.join()
+        eq_(len(calls), 1)
+        eq_(len(results), 2)
+        statsd.incr.assert_called_with('slumber.coalesced.solitude')
+
+    def test_error_shared(self, statsd):
+        flight = SingleFlight()
+
+        def send():
+            raise requests.exceptions.ConnectionError()
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            flight.call(self.request(), send)
+        eq_(flight.flights, {})
+
+    def test_post_not_coalesced(self, statsd):
+        adapter = PooledAdapter(single_flight=True)
+        with mock.patch.object(adapter.single_flight, 'call') as call:
+            with mock.patch('requests.adapters.HTTPAdapter.send'):
+                adapter.send(self.request('POST'))
+                ok_(not call.called)
+                adapter.send(self.request('GET'))
+                ok_(call.called)
+
+
+def test_stat_key():
+    eq_(stat_key('solitude.allizom.org:443'), 'solitude_allizom_org_443')
+
+
+def test_endpoint_class():
+    eq_(endpoint_class('http://solitude/generic/buyer/5/?uuid=x'),
+        'generic.buyer')
+    eq_(endpoint_class('http://mkt/api/v1/webpay/prices/12/'),
+        'webpay.prices')
+    eq_(endpoint_class('http://solitude/'), 'root')
+
+
+@override_settings(CIRCUIT_BREAKER={'enabled': True, 'window': 4,
+                                    'min_calls': 2, 'error_rate': 0.5,
+                                    'slow': 0.5, 'reset_timeout': 30})
+@mock.patch('lib.circuit.statsd')
+class TestBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = circuit.Breaker('solitude.generic_buyer')
+
+    def test_opens(self, statsd):
+        self.breaker.record(False)
+        eq_(self.breaker.state, circuit.CLOSED)
+        self.breaker.record(True)
+        eq_(self.breaker.state, circuit.OPEN)
+        statsd.incr.assert_called_with(
+            'slumber.circuit.solitude.generic_buyer.open')
+        with self.assertRaises(circuit.CircuitOpen):
+            self.breaker.allow()
+
+    def test_stays_closed(self, statsd):
+        for x in range(10):
+            self.breaker.allow()
+            self.breaker.record(x % 4 == 0)
+        eq_(self.breaker.state, circuit.CLOSED)
+
+    @mock.patch('lib.circuit.time.time')
+    def test_probe(self, now, statsd):
+        now.return_value = 100
+        self.breaker.record(True)
+        self.breaker.record(True)
+        now.return_value = 131
+        self.breaker.allow()
+        eq_(self.breaker.state, circuit.HALF_OPEN)
+        # Only one probe at a time.
+        with self.assertRaises(circuit.CircuitOpen):
+            self.breaker.allow()
+        self.breaker.record(False)
+        eq_(self.breaker.state, circuit.CLOSED)
+
+    @mock.patch('lib.circuit.time.time')
+    def test_failed_probe(self, now, statsd):
+        now.return_value = 100
+        self.breaker.record(True)
+        self.breaker.record(True)
+        now.return_value = 131
+        self.breaker.allow()
+        self.breaker.record(True)
+        eq_(self.breaker.state, circuit.OPEN)
+        with self.assertRaises(circuit.CircuitOpen):
+            self.breaker.allow()
+
+    def test_adapter(self, statsd):
+        adapter = PooledAdapter()
+        request = requests.Request(
+            'GET', 'http://solitude.circuit/generic/buyer/').prepare()
+        with mock.patch('requests.adapters.HTTPAdapter.send') as send:
+            send.return_value = mock.Mock(status_code=500, headers={},
+                                          content='')
+            adapter.send(request)
+            adapter.send(request)
+            with self.assertRaises(circuit.CircuitOpen):
+                adapter.send(request)
+        eq_(circuit.states()['solitude_circuit.generic.buyer'],
+            circuit.OPEN)
+
+    @override_settings(UPSTREAM_TIMEOUTS={'default': 10, 'endpoints': {
+        'bango.billing': 20}})
+    @mock.patch('lib.transport.time.time')
+    def test_slow(self, now, statsd):
+        now.return_value = 0
+
+        def send(*args, **kw):
+            now.return_value += 8
+            return mock.Mock(status_code=200, headers={}, content='')
+
+        adapter = PooledAdapter()
+        with mock.patch('requests.adapters.HTTPAdapter.send', send):
+            for path in ('bango/billing/', 'generic/seller/'):
+                request = requests.Request(
+                    'GET', 'http://solitude.slow/' + path).prepare()
+                adapter.send(request)
+                adapter.send(request)
+        # 8 seconds is slow for the default timeout, not for bango.billing.
+        eq_(circuit.states()['solitude_slow.bango.billing'], circuit.CLOSED)
+        eq_(circuit.states()['solitude_slow.generic.seller'], circuit.OPEN)
+
+    @override_settings(UPSTREAM_TIMEOUTS={'default': 10})
+    def test_cut_short(self, statsd):
+        adapter = PooledAdapter()
+        request = requests.Request(
+            'GET', 'http://solitude.short/generic/buyer/').prepare()
+        deadline.set_deadline(1)
+        try:
+            with mock.patch('requests.adapters.HTTPAdapter.send') as send:
+                send.side_effect = requests.exceptions.Timeout
+                for x in range(2):
+                    with self.assertRaises(requests.exceptions.Timeout):
+                        adapter.send(request)
+        finally:
+            deadline.clear_deadline()
+        # The calls timed out on the request's deadline, not the upstream's.
+        eq_(circuit.states()['solitude_short.generic.buyer'], circuit.CLOSED)
+
+    @mock.patch('lib.circuit.time.time')
+    def test_release_probe(self, now, statsd):
+        now.return_value = 100
+        self.breaker.record(True)
+        self.breaker.record(True)
+        now.return_value = 131
+        self.breaker.allow()
+        self.breaker.release()
+        eq_(self.breaker.state, circuit.HALF_OPEN)
+        # The next call probes instead.
+        self.breaker.allow()
+
+
+@mock.patch('lib.transport.statsd')
+class TestRecordCall(TestCase):
+
+    def setUp(self):
+        self.request = requests.Request(
+            'GET', 'http://solitude/generic/buyer/5/').prepare()
+        self.response = mock.Mock(status_code=200, content='{"a": 1}',
+                                  headers={})
+
+    def tearDown(self):
+        end_rollup()
+
+    def test_stats(self, statsd):
+        record_call(self.request, self.response, 0.25)
+        prefix = 'slumber.call.solitude.generic.buyer.GET'
+        statsd.timing.assert_any_call(prefix, 250)
+        statsd.timing.assert_any_call(prefix + '.size', 8)
+        statsd.incr.assert_called_with(prefix + '.status.200')
+
+    def test_error(self, statsd):
+        record_call(self.request, None, 0.25)
+        statsd.incr.assert_called_with(
+            'slumber.call.solitude.generic.buyer.GET.status.error')
+
+    def test_rollup(self, statsd):
+        rollup = start_rollup()
+        record_call(self.request, self.response, 0.25)
+        parallel.submit(record_call,
+                        args=(self.request, self.response, 0.1)).get()
+        eq_(rollup.calls, 2)
+        eq_(rollup.time, 350)
+        eq_(end_rollup(), rollup)
+
+
+@override_settings(UPSTREAM_TIMEOUTS={'request': 25, 'task': 60,
+                                      'default': 10,
+                                      'endpoints': {'bango': 15,
+                                                    'bango.billing': 20}})
+class TestDeadline(TestCase):
+
+    def tearDown(self):
+        deadline.clear_deadline()
+
+    def test_endpoint_timeout(self):
+        eq_(deadline.endpoint_timeout('generic.buyer'), 10)
+        eq_(deadline.endpoint_timeout('bango.product'), 15)
+        eq_(deadline.endpoint_timeout('bango.billing'), 20)
+
+    def test_no_deadline(self):
+        eq_(deadline.remaining(), None)
+        eq_(deadline.timeout_for('generic.buyer'), 10)
+        eq_(deadline.timeout_for('generic.buyer', timeout=3), 3)
+
+    def test_remaining(self):
+        deadline.set_deadline(2)
+        ok_(deadline.timeout_for('generic.buyer') <= 2)
+
+    def test_passed(self):
+        deadline.set_deadline(-1)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            deadline.timeout_for('generic.buyer')
+
+    def test_parallel(self):
+        deadline.set_deadline(2)
+        ok_(parallel.submit(deadline.remaining).get() <= 2)
+
+    def test_with_deadline(self):
+        task = deadline.with_deadline(5)(deadline.remaining)
+        ok_(4 < task() <= 5)
+        eq_(deadline.remaining(), None)
+
+    def test_with_deadline_keeps_request(self):
+        deadline.set_deadline(2)
+        ok_(deadline.with_deadline(5)(deadline.remaining)() <= 2)
+        ok_(deadline.remaining() <= 2)
+
+    def test_with_deadline_sooner_than_request(self):
+        deadline.set_deadline(10)
+        ok_(deadline.with_deadline(5)(deadline.remaining)() <= 5)
+        ok_(5 < deadline.remaining() <= 10)
+
+    @mock.patch('requests.adapters.HTTPAdapter.send')
+    def test_adapter_timeout(self, send):
+        send.return_value = mock.MagicMock(status_code=200)
+        request = requests.Request(
+            'POST', 'http://solitude/bango/billing/').prepare()
+        PooledAdapter().send(request)
+        eq_(send.call_args[1]['timeout'], 20)
+
+    @mock.patch('lib.transport.record_call')
+    @mock.patch('requests.adapters.HTTPAdapter.send')
+    def test_adapter_out_of_time(self, send, record_call):
+        deadline.set_deadline(-1)
+        request = requests.Request(
+            'GET', 'http://solitude/generic/buyer/').prepare()
+        with self.assertRaises(deadline.DeadlineExceeded):
+            PooledAdapter().send(request)
+        # Nothing was sent, so nothing is recorded against the upstream.
+        ok_(not send.called)
+        ok_(not record_call.called)
+
+
+@override_settings(SOLITUDE_HEDGING={'enabled': True,
+                                     'endpoints': ('generic.transaction',),
+                                     'percentile': 50, 'min_delay': 0.05,
+                                     'window': 10, 'min_samples': 2,
+                                     'budget': 1, 'max_allowance': 1})
+@mock.patch('lib.transport.statsd')
+class TestHedger(TestCase):
+    endpoint = 'generic.transaction'
+
+    def setUp(self):
+        self.hedger = Hedger()
+
+    def test_applies(self, statsd):
+        ok_(self.hedger.applies(self.endpoint))
+        ok_(not self.hedger.applies('generic.buyer'))
+
+    def test_delay(self, statsd):
+        eq_(self.hedger.delay(self.endpoint), None)
+        for elapsed in (0.1, 0.2, 0.3):
+            self.hedger.record(self.endpoint, elapsed)
+        eq_(self.hedger.delay(self.endpoint), 0.2)
+
+    def test_not_enough_samples(self, statsd):
+        send = mock.Mock(return_value=mock.Mock(content=''))
+        self.hedger.call(self.endpoint, send)
+        eq_(send.call_count, 1)
+        eq_(len(self.hedger.latency[self.endpoint]), 1)
+
+    def test_hedged(self, statsd):
+        self.hedger.record(self.endpoint, 0.05)
+        self.hedger.record(self.endpoint, 0.05)
+        release = threading.Event()
+        slow, fast = mock.Mock(content='slow'), mock.Mock(content='fast')
+        responses = [slow, fast]
+
+        def send():
+            response = responses.pop(0)
+            if response is slow:
+                release.wait()
+            return response
+
+        try:
+            eq_(self.hedger.call(self.endpoint, send), fast)
+        finally:
+            release.set()
+        statsd.incr.assert_any_call('slumber.hedge.generic.transaction.sent')
+        statsd.incr.assert_any_call('slumber.hedge.generic.transaction.won')
+
+    def test_budget(self, statsd):
+        self.hedger.allowance = 0
+        ok_(not self.hedger.spend())
+        self.hedger.allowance = 1
+        ok_(self.hedger.spend())
+
+    def test_all_failed(self, statsd):
+        send = mock.Mock(side_effect=requests.exceptions.ConnectionError)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.hedger.call(self.endpoint, send)
+
+
+@override_settings(UPSTREAM_RETRY={'attempts': 3, 'base': 0.1, 'cap': 1,
+                                   'budget': 5})
+@mock.patch('lib.retry.time.sleep')
+@mock.patch('lib.retry.statsd')
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy('solitude')
+        self.command = mock.Mock(__name__='get_object',
+                                 side_effect=requests.exceptions.Timeout)
+
+    def test_exhausted(self, statsd, sleep):
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.policy.run(self.command, uuid='x')
+        eq_(self.command.call_count, 3)
+        self.command.assert_called_with(uuid='x')
+        eq_(sleep.call_count, 2)
+        statsd.incr.assert_called_with('retry.solitude.exhausted')
+
+    def test_recovered(self, statsd, sleep):
+        self.command.side_effect = [requests.exceptions.ConnectionError, 1]
+        eq_(self.policy.run(self.command), 1)
+        statsd.incr.assert_called_with('retry.solitude.recovered')
+
+    @mock.patch('lib.retry.random.uniform')
+    def test_backoff(self, uniform, statsd, sleep):
+        uniform.side_effect = lambda low, high: high
+        with self.assertRaises(requests.exceptions.Timeout):
+            RetryPolicy('solitude', attempts=5).run(self.command)
+        eq_([c[0][0] for c in sleep.call_args_list], [0.1, 0.2, 0.4, 0.8])
+
+    @mock.patch('lib.retry.random.uniform')
+    def test_budget(self, uniform, statsd, sleep):
+        uniform.return_value = 3
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.policy.run(self.command)
+        eq_(self.command.call_count, 2)
+
+    def test_not_idempotent(self, statsd, sleep):
+        self.command.__name__ = 'post'
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.policy.run(self.command)
+        eq_(self.command.call_count, 1)
+
+    def test_idempotent(self, statsd, sleep):
+        self.command.__name__ = 'post'
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.policy.run(self.command, idempotent=True)
+        eq_(self.command.call_count, 3)
+
+    def test_fail_fast(self, statsd, sleep):
+        self.command.side_effect = circuit.CircuitOpen
+        with self.assertRaises(circuit.CircuitOpen):
+            self.policy.run(self.command)
+        eq_(self.command.call_count, 1)
+
+
+class TestLocalCache(TestCase):
+
+    def test_get_set(self):
+        cache = LocalCache()
+        cache.set('a', 1)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('b', 'default'), 'default')
+
+    def test_expired(self):
+        cache = LocalCache(timeout=0)
+        cache.set('a', 1)
+        eq_(cache.get('a'), None)
+
+    def test_max_age(self):
+        cache = LocalCache()
+        with mock.patch('lib.cache.time.time') as now:
+            now.return_value = 100
+            cache.set('a', 1)
+            now.return_value = 110
+            eq_(cache.get('a', max_age=5), None)
+            eq_(cache.get('a'), 1)
+
+    def test_least_recently_used_evicted(self):
+        cache = LocalCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 1)
+        eq_(len(cache), 2)
+
+
+class TestParallel(TestCase):
+
+    def test_fan_out(self):
+        eq_(parallel.fan_out([('a', lambda: 1), ('b', lambda: 2)]),
+            {'a': 1, 'b': 2})
+
+    def test_first_error_raised(self):
+        def fail(exc):
+            raise exc
+
+        with self.assertRaises(KeyError):
+            parallel.fan_out([('a', lambda: 1),
+                              ('b', lambda: fail(KeyError)),
+                              ('c', lambda: fail(ValueError))])
+
+    def test_logging_context(self):
+        logger._local.TRANSACTION_ID = 'webpay:xyz'
+        try:
+            res = parallel.submit(logger.get_transaction_id).get()
+        finally:
+            del logger._local.TRANSACTION_ID
+        eq_(res, 'webpay:xyz')
+
+    def test_context_restored(self):
+        logger._local.TRANSACTION_ID = 'webpay:xyz'
+        try:
+            call = parallel.capture(logger.get_transaction_id)
+        finally:
+            del logger._local.TRANSACTION_ID
+        logger._local.TRANSACTION_ID = 'webpay:abc'
+        try:
+            eq_(call(), 'webpay:xyz')
+            eq_(logger.get_transaction_id(), 'webpay:abc')
+        finally:
+            del logger._local.TRANSACTION_ID
+
+    def test_capture_without_deadline(self):
+        deadline.set_deadline(2)
+        try:
+            call = parallel.capture(deadline.remaining, deadline=False)
+        finally:
+            deadline.clear_deadline()
+        eq_(call(), None)
+
+    @mock.patch('lib.parallel.statsd')
+    def test_timing(self, statsd):
+        parallel.fan_out([('a', lambda: 1)], stat='some.lookup')
+        statsd.timing.assert_called_with('some.lookup.a', mock.ANY)
+
+    @override_settings(PARALLEL_WORKERS=0)
+    @mock.patch('lib.parallel.get_pool')
+    def test_no_workers(self, get_pool):
+        eq_(parallel.fan_out([('a', lambda: 1)]), {'a': 1})
+        assert not get_pool.called
@@ -0,0 +1,484 @@
+"""
+The HTTP transport used by the Solitude and Marketplace API clients.
+
+Every slumber call ends up in the requests session that curling creates for
+each API. This module mounts a pooled adapter on that session so that
+connections to an upstream host are kept alive and re-used between calls,
+and so that every call is measured.
+"""
+import copy
+import os
+import Queue
+import re
+import sys
+import threading
+import time
+from collections import deque
+from urlparse import urlparse
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
+
+from webpay.base import logger
+
+from . import circuit, deadline
+
+log = logger.getLogger('lib.transport')
+
+
+def stat_key(value):
+    """
+    Make a value, such as a host name, safe to use in a statsd key.
+    """
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', value)
+
+
+def endpoint_class(url, depth=2):
+    """
+    Returns the class of endpoint a URL is for, e.g. ``generic.buyer`` for
+    ``/generic/buyer/1/`` or ``webpay.prices`` for ``/api/v1/webpay/prices/``.
+
+    Object ids, API prefixes and versions are dropped from the path.
+    """
+    parts = [part for part in urlparse(url).path.split('/')
+             if part and part != 'api' and
+             not re.match(r'^(v\d+|[0-9a-fA-F:-]*\d[0-9a-fA-F:-]*)$', part)]
+    return '.'.join(stat_key(part) for part in parts[:depth]) or 'root'
+
+
+class Rollup(object):
+    """
+    Adds up the upstream calls made while handling one request.
+
+    Calls made in :mod:`lib.parallel` threads are counted in the rollup of
+    the request that started them.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0
+        self.lock = threading.Lock()
+
+    def add(self, ms):
+        with self.lock:
+            self.calls += 1
+            self.time += ms
+
+
+def start_rollup():
+    """
+    Start counting the upstream calls made by this thread.
+    """
+    logger._local.OUTBOUND = Rollup()
+    return logger._local.OUTBOUND
+
+
+def get_rollup():
+    return getattr(logger._local, 'OUTBOUND', None)
+
+
+def end_rollup():
+    """
+    Stop counting and return the :class:`Rollup`, or None.
+    """
+    return logger._local.__dict__.pop('OUTBOUND', None)
+
+
+def record_call(request, response, elapsed, stream=False):
+    """
+    Send the latency, status and size of an upstream call to statsd.
+
+    Stats are keyed by host, endpoint and method, for example
+    ``slumber.call.solitude.generic.buyer.GET``.
+    """
+    ms = int(elapsed * 1000)
+    prefix = 'slumber.call.{host}.{endpoint}.{method}'.format(
+        host=stat_key(urlparse(request.url).netloc),
+        endpoint=endpoint_class(request.url, depth=3),
+        method=request.method)
+    statsd.timing(prefix, ms)
+    if response is None:
+        statsd.incr(prefix + '.status.error')
+    else:
+        statsd.incr('{0}.status.{1}'.format(prefix, response.status_code))
+        size = response.headers.get('content-length')
+        if size is None and not stream:
+            size = len(response.content or '')
+        if size is not None:
+            # A timer gives us the distribution of sizes.
+            statsd.timing(prefix + '.size', int(size))
+
+    rollup = get_rollup()
+    if rollup:
+        rollup.add(ms)
+
+
+class PoolMetrics(object):
+    """
+    Reports connection checkouts from a single urllib3 connection pool.
+
+    Three stats are sent for each host:
+
+    * ``checkout_wait``: time spent waiting for a connection (timer).
+    * ``active``: connections currently checked out (gauge).
+    * ``idle``: open connections waiting in the pool (gauge).
+    """
+
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        self.timeout = timeout
+        self.active = 0
+        self.lock = threading.Lock()
+        self.prefix = 'slumber.pool.{host}'.format(host=stat_key(pool.host))
+        # Wrap the pool so that every checkout and return goes through us.
+        self._get_conn = pool._get_conn
+        self._put_conn = pool._put_conn
+        pool._get_conn = self.get_conn
+        pool._put_conn = self.put_conn
+        pool.webpay_metrics = self
+
+    def get_conn(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        conn = self._get_conn(timeout=timeout)
+        statsd.timing(self.prefix + '.checkout_wait',
+                      int((time.time() - start) * 1000))
+        with self.lock:
+            self.active += 1
+        self.report()
+        return conn
+
+    def put_conn(self, conn):
+        self._put_conn(conn)
+        with self.lock:
+            self.active = max(self.active - 1, 0)
+        self.report()
+
+    def idle(self):
+        # The pool queue is padded with None for each free slot.
+        queue = getattr(self.pool.pool, 'queue', None) or []
+        return len([conn for conn in queue if conn])
+
+    def report(self):
+        statsd.gauge(self.prefix + '.active', self.active)
+        statsd.gauge(self.prefix + '.idle', self.idle())
+
+
+class Flight(object):
+    """A request in flight and the callers waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.exc_info = None
+        self.waiting = 0
+
+
+class SingleFlight(object):
+    """
+    Shares one in-flight request between concurrent identical requests.
+
+    The first caller makes the request, callers that ask for the same thing
+    while it is in flight wait for it and get a copy of its response (or its
+    exception). Nothing is kept once the request has finished.
+    """
+    # Headers that differ on every call but don't change the response.
+    ignore_headers = ('authorization', 'transaction-id')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def key(self, request):
+        headers = sorted((k.lower(), v) for k, v in request.headers.items()
+                         if k.lower() not in self.ignore_headers)
+        return (request.method, request.url, tuple(headers))
+
+    def call(self, request, send, timeout=None):
+        """
+        Call `send` unless the same request is already in flight.
+
+        :param timeout: seconds to wait for a request that is in flight.
+        """
+        key = self.key(request)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.waiting += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise Timeout('Timed out waiting for {0} {1}'
+                              .format(request.method, request.url))
+            statsd.incr('slumber.coalesced.{host}'.format(
+                host=stat_key(urlparse(request.url).netloc)))
+            if flight.exc_info:
+                raise flight.exc_info[0], flight.exc_info[1], \
+                    flight.exc_info[2]
+            return copy.copy(flight.response)
+
+        try:
+            flight.response = send()
+            # Read the body now so that every caller can share it.
+            flight.response.content
+            return flight.response
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+class Hedger(object):
+    """
+    Sends a second, hedged, copy of a slow GET and uses whichever answers
+    first.
+
+    A GET is hedged when it has not answered within a percentile of the
+    recent latency of its endpoint. Each request adds ``budget`` to a
+    small allowance and each hedge uses 1 of it, so hedges stay under that
+    share of traffic. See ``settings.SOLITUDE_HEDGING``.
+    """
+
+    def __init__(self):
+        self.latency = {}
+        self.allowance = 0
+        self.lock = threading.Lock()
+
+    def applies(self, endpoint):
+        config = settings.SOLITUDE_HEDGING
+        return config.get('enabled') and endpoint in config['endpoints']
+
+    def delay(self, endpoint):
+        """
+        Returns the seconds to wait before hedging, or None if there are
+        not enough samples yet.
+        """
+        config = settings.SOLITUDE_HEDGING
+        samples = sorted(self.latency.get(endpoint, ()))
+        if len(samples) < config['min_samples']:
+            return None
+        index = int(len(samples) * config['percentile'] / 100.0)
+        return max(samples[min(index, len(samples) - 1)], config['min_delay'])
+
+    def record(self, endpoint, elapsed):
+        with self.lock:
+            samples = self.latency.setdefault(
+                endpoint, deque(maxlen=settings.SOLITUDE_HEDGING['window']))
+            samples.append(elapsed)
+
+    def spend(self):
+        # Returns True if there is enough allowance for a hedge.
+        with self.lock:
+            if self.allowance >= 1:
+                self.allowance -= 1
+                return True
+        return False
+
+    def call(self, endpoint, send):
+        """
+        Call `send`, and call it again if the first call is slow.
+        """
+        config = settings.SOLITUDE_HEDGING
+        with self.lock:
+            self.allowance = min(self.allowance + config['budget'],
+                                 config['max_allowance'])
+        delay = self.delay(endpoint)
+        results = Queue.Queue()
+
+        def run(hedged):
+            start = time.time()
+            try:
+                response = send()
+                # Read the body so the connection goes back to the pool
+                # even if this response is not used.
+                response.content
+                if not hedged:
+                    self.record(endpoint, time.time() - start)
+                results.put((response, None, hedged))
+            except Exception:
+                results.put((None, sys.exc_info(), hedged))
+
+        def start(hedged):
+            thread = threading.Thread(target=run, args=(hedged,))
+            thread.daemon = True
+            thread.start()
+
+        if delay is None:
+            run(False)
+        else:
+            start(False)
+        pending = 1
+        exc_info = None
+        while pending:
+            try:
+                response, error, hedged = results.get(timeout=delay)
+            except Queue.Empty:
+                # Only hedge once.
+                delay = None
+                if self.spend():
+                    statsd.incr('slumber.hedge.{0}.sent'.format(endpoint))
+                    start(True)
+                    pending += 1
+                continue
+            pending -= 1
+            if response is not None:
+                if hedged:
+                    statsd.incr('slumber.hedge.{0}.won'.format(endpoint))
+                return response
+            exc_info = error
+        # Every call failed.
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    A requests adapter with a pool of keep-alive connections per host.
+
+    :param hosts: the number of hosts to keep a pool for.
+    :param connections: the number of connections to keep for each host.
+    :param block: when True, never open more than `connections` to a host
+                  and wait for a free one instead.
+    :param timeout: seconds to wait for a free connection when blocking.
+    :param single_flight: when True, identical GET and HEAD requests made at
+                          the same time share one request to the upstream.
+
+    The pools are created again, without closing the old sockets, the first
+    time the adapter is used in a new process. This keeps a gunicorn or
+    celery child from sharing a connection with its parent.
+    """
+
+    single_flight_methods = ('GET', 'HEAD')
+    # Set to a Hedger to hedge slow GETs.
+    hedger = None
+
+    def __init__(self, hosts=10, connections=10, block=True, timeout=None,
+                 single_flight=False):
+        self.pool_timeout = timeout
+        self.single_flight = SingleFlight() if single_flight else None
+        self._fork_lock = threading.Lock()
+        super(PooledAdapter, self).__init__(pool_connections=hosts,
+                                            pool_maxsize=connections,
+                                            pool_block=block)
+
+    def init_poolmanager(self, connections, maxsize, block=False):
+        super(PooledAdapter, self).init_poolmanager(connections, maxsize,
+                                                    block=block)
+        self._pid = os.getpid()
+
+    def check_fork(self):
+        if self._pid == os.getpid():
+            return
+        with self._fork_lock:
+            if self._pid != os.getpid():
+                log.info('process {pid} was forked, creating new connection '
+                         'pools'.format(pid=os.getpid()))
+                self.init_poolmanager(self._pool_connections,
+                                      self._pool_maxsize,
+                                      block=self._pool_block)
+
+    def get_connection(self, url, proxies=None):
+        self.check_fork()
+        pool = super(PooledAdapter, self).get_connection(url, proxies=proxies)
+        if not getattr(pool, 'webpay_metrics', None):
+            PoolMetrics(pool, timeout=self.pool_timeout)
+        return pool
+
+    def send(self, request, **kw):
+        # A request that is out of time is not sent, so it is not counted
+        # against the upstream.
+        kw['timeout'] = deadline.timeout_for(
+            endpoint_class(request.url, depth=3), kw.get('timeout'))
+        start = time.time()
+        response = None
+        try:
+            if (self.single_flight and
+                    request.method in self.single_flight_methods):
+                response = self.single_flight.call(
+                    request, lambda: self.send_hedged(request, **kw),
+                    timeout=kw['timeout'])
+            else:
+                response = self.send_hedged(request, **kw)
+            return response
+        finally:
+            record_call(request, response, time.time() - start,
+                        stream=kw.get('stream', False))
+
+    def send_hedged(self, request, **kw):
+        """
+        Send the request, hedging it if it is a slow GET and a hedger is
+        set.
+        """
+        endpoint = endpoint_class(request.url)
+        if (self.hedger and request.method == 'GET' and
+                not kw.get('stream') and self.hedger.applies(endpoint)):
+            return self.hedger.call(
+                endpoint, lambda: self.send_through_breaker(request, **kw))
+        return self.send_through_breaker(request, **kw)
+
+    def send_through_breaker(self, request, **kw):
+        """
+        Send the request unless the circuit for its endpoint is open.
+
+        Raises CircuitOpen when it is.
+        """
+        config = settings.CIRCUIT_BREAKER
+        send = super(PooledAdapter, self).send
+        if not config.get('enabled'):
+            return send(request, **kw)
+
+        endpoint = endpoint_class(request.url)
+        breaker = circuit.get_breaker('{host}.{endpoint}'.format(
+            host=stat_key(urlparse(request.url).netloc), endpoint=endpoint))
+        # Slow is relative to the time the endpoint is allowed to take.
+        timeout = deadline.endpoint_timeout(endpoint)
+        slow = config['slow'] * timeout if timeout else None
+        # A call given less than that by the deadline can time out without
+        # the upstream being at fault.
+        cut_short = bool(timeout and kw.get('timeout') is not None and
+                         kw['timeout'] < timeout)
+        breaker.allow()
+        failed = True
+        start = time.time()
+        try:
+            response = send(request, **kw)
+            failed = (response.status_code >= 500 or
+                      (slow is not None and time.time() - start > slow))
+            return response
+        except Timeout:
+            if cut_short:
+                failed = None
+            raise
+        finally:
+            if failed is None:
+                breaker.release()
+            else:
+                breaker.record(failed)
+
+
+def mount_pool(session, config):
+    """
+    Mount a :class:`PooledAdapter` on a requests session.
+
+    :param session: the requests session to mount on.
+    :param config: a dict like ``settings.SLUMBER_POOL``.
+    """
+    adapter = PooledAdapter(hosts=config.get('hosts', 10),
+                            connections=config.get('connections', 10),
+                            block=config.get('block', True),
+                            timeout=config.get('timeout'),
+                            single_flight=config.get('single_flight', False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not config.get('keep_alive', True):
+        session.headers['Connection'] = 'close'
+    return adapter
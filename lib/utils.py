@@ -1,11 +1,16 @@
 import json
 
+from django.conf import settings
+
 from curling.lib import API
 from slumber.exceptions import HttpClientError
 
 from solitude.exceptions import ResourceModified, ResourceNotModified
 from webpay.base.logger import getLogger, get_transaction_id
 
+from .retry import RetryPolicy
+from .transport import mount_pool
+
 log = getLogger('lib.utils')
 
 
@@ -16,13 +21,26 @@ def add_transaction_id(slumber, headers=None, **kwargs):
 class SlumberWrapper(object):
     """
     A wrapper around the Slumber API.
+
+    :param url: URL of the API.
+    :param oauth: dict of the OAuth key and secret.
+    :param pool: optional dict of connection pool options. Defaults to
+                 ``settings.SLUMBER_POOL``.
+
+    Reads can be retried with ``self.retry.run(command, *args, **kw)``,
+    see :class:`lib.retry.RetryPolicy`.
     """
+    # The statsd name for retries.
+    name = 'slumber'
 
-    def __init__(self, url, oauth):
+    def __init__(self, url, oauth, pool=None):
         self.slumber = API(url)
         self.slumber.activate_oauth(oauth.get('key'), oauth.get('secret'))
         self.slumber._add_callback({'method': add_transaction_id})
+        self.adapter = mount_pool(self.slumber._store['session'],
+                                  pool or settings.SLUMBER_POOL)
         self.api = self.slumber.api.v1
+        self.retry = RetryPolicy(self.name)
 
     def parse_res(self, res):
         if res == '':
@@ -55,6 +55,45 @@ CACHES = {
 
 CACHE_PREFIX = 'webpay:test'
 
+# Buyers are mocked differently in each test, don't cache them by default.
+BUYER_CACHE = {
+    'timeout': 0,
+    'local_timeout': 0,
+}
+
+# The same goes for issuers.
+ISSUER_CACHE = {
+    'timeout': 0,
+    'negative_timeout': 0,
+    'refresh': 0,
+}
+
+# And for verified JWTs.
+JWT_CACHE = {
+    'timeout': 0,
+}
+
+# And for solitude objects.
+SOLITUDE_INDEX_TIMEOUT = 0
+
+# Don't fetch price tiers in the background.
+PRICE_INDEX = {'enabled': False, 'refresh': 5 * 60}
+
+# Send payment notices from the notify task.
+POSTBACK_WORKERS = 0
+
+# Don't keep notices.
+POSTBACK_OUTBOX = {'enabled': False}
+
+# Don't wait between notice retries.
+POSTBACK_RETRY = {'attempts': 5, 'base': 0, 'cap': 0, 'budget': 5}
+
+# Product icons are mocked in each test.
+ICON_CACHE = {'timeout': 0, 'pending_timeout': 0}
+
+# Retry straight away.
+UPSTREAM_RETRY = {'attempts': 3, 'base': 0, 'cap': 0, 'budget': 5}
+
 SPARTACUS_BUILD_ID_KEY = 'spartacus-build-id'
 SPARTACUS_STATIC = '/mozpay/media'
 
@@ -3,8 +3,11 @@ from django import http
 from rest_framework import response, viewsets
 
 from webpay.api.base import BuyerIsLoggedIn
+from webpay.base import dev_messages as msg
 from webpay.base.logger import getLogger
+from webpay.base.utils import system_error
 from webpay.pay import tasks
+from webpay.pay.notes import delay, get_notes, notes_ref, NotesMissing
 
 log = getLogger('w.api')
 
@@ -17,7 +20,11 @@ class SimulateViewSet(viewsets.ViewSet):
             log.info('Request to simulate without a valid session')
             return http.HttpResponseForbidden()
 
-        tasks.simulate_notify.delay(request.session['notes']['issuer_key'],
-                                    request.session['notes']['pay_request'])
+        try:
+            notes = get_notes(request)
+        except NotesMissing:
+            return system_error(request, code=msg.TRANS_EXPIRED)
+        delay(tasks.simulate_notify, notes['issuer_key'],
+              notes_ref(notes['pay_request'], request.session.get('trans_id')))
 
         return response.Response(status=204)
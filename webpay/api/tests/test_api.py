@@ -4,7 +4,7 @@ from django.core.urlresolvers import reverse
 from django.test.client import Client
 
 import mock
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
 from .base import BaseAPICase
 
@@ -65,3 +65,11 @@ class TestSimulate(BaseAPICase):
         eq_(res.status_code, 204)
         self.simulate_task.assert_called_with(self.issuer,
                                               self.pay_request)
+
+    def test_notes_expired(self):
+        self.set_session(is_simulation=True, notes_ref='gone')
+        res = self.client.post(reverse('api:simulate'),
+                               HTTP_ACCEPT='application/json')
+        eq_(res.status_code, 400)
+        eq_(json.loads(res.content)['error_code'], 'TRANS_EXPIRED')
+        ok_(not self.simulate_task.called)
@@ -0,0 +1,88 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+import encrypted_cookies
+
+from webpay.base import session
+from webpay.base.utils import gmtime
+
+
+def typical_session():
+    iat = gmtime()
+    pay_request = {
+        'iss': 'app-key',
+        'aud': 'marketplace.firefox.com',
+        'typ': 'mozilla/payments/pay/v1',
+        'iat': iat,
+        'exp': iat + 3600,
+        'request': {
+            'pricePoint': 1,
+            'id': 'some-generated-unique-id',
+            'name': 'My bands latest album',
+            'description': '320kbps MP3 download, DRM free!',
+            'productData': 'my_product_id=1234',
+            'postbackURL': 'https://app.example.com/post',
+            'chargebackURL': 'https://app.example.com/charge',
+            'defaultLocale': 'en',
+            'locales': dict(
+                (lang, {'name': 'Album ' + lang, 'description': 'DRM free!'})
+                for lang in ('de', 'es', 'fr', 'it', 'pl', 'pt-BR', 'ru')),
+        },
+    }
+    return {
+        'uuid': 'some:buyer-uuid-3bb3ba1a6a2b4f5c',
+        'logged_in_user': 'someone@example.com',
+        'fxa-state': '9c0f4d8b4a2f4e51a4e0a58b1d7e3c2f',
+        'trans_id': 'webpay:4c1e9c1f-ee19-4a3f-8bd9-2f8a3c5d7a21',
+        'configured_trans': 'webpay:4c1e9c1f-ee19-4a3f-8bd9-2f8a3c5d7a21',
+        'is_simulation': False,
+        'super_powers': False,
+        'uuid_has_confirmed_pin': True,
+        'uuid_has_new_pin': False,
+        'uuid_has_pin': True,
+        'uuid_needs_pin_reset': False,
+        'uuid_pin_is_locked': False,
+        'uuid_pin_was_locked': False,
+        'was_reverified': True,
+        'last_pin_success': None,
+        'notes': {'pay_request': pay_request, 'issuer_key': 'app-key',
+                  'network': {'mcc': '334', 'mnc': '020'}},
+    }
+
+
+class Command(BaseCommand):
+    help = ('Compare the size and speed of the session engine with plain '
+            'encrypted_cookies.')
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=1000,
+                    help='Requests to time. Default: %default'),
+    )
+
+    def handle(self, *args, **options):
+        data = typical_session()
+        for name, engine in (('encrypted_cookies', encrypted_cookies),
+                             ('webpay.base.session', session)):
+            store = engine.SessionStore()
+            store.update(data)
+            store.save()
+            cookie = store.session_key
+            self.stdout.write('{0}: {1} byte cookie'
+                              .format(name, len(cookie)))
+            for label, touch in (
+                    ('unchanged', lambda s: s.__setitem__('uuid', s['uuid'])),
+                    ('changed', lambda s: s.__setitem__('payment_start',
+                                                        time.time()))):
+                saves = 0
+                start = time.time()
+                for x in xrange(options['requests']):
+                    # What SessionMiddleware does for each request.
+                    store = engine.SessionStore(cookie)
+                    touch(store)
+                    if store.modified:
+                        store.save()
+                        saves += 1
+                took = (time.time() - start) / options['requests']
+                self.stdout.write('  {0}: {1:.3f}ms per request, {2} saves'
+                                  .format(label, took * 1000, saves))
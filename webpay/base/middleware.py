@@ -10,8 +10,14 @@ from django.utils.translation.trans_real import parse_accept_lang_header
 import tower
 from csp.middleware import CSPMiddleware as BaseCSPMiddleware
 
+from django_statsd.clients import statsd
+
+from lib.circuit import CircuitOpen
+from lib.deadline import clear_deadline, DeadlineExceeded, set_deadline
+from lib.transport import end_rollup, start_rollup
+from webpay.base import dev_messages as msg
 from webpay.base.logger import getLogger
-from webpay.base.utils import log_cef
+from webpay.base.utils import log_cef, system_error
 
 log = getLogger('w.middleware')
 
@@ -37,6 +43,53 @@ class LogJSONerror:
                              str(exception.content)[0:50]))
 
 
+class CircuitOpenMiddleware(object):
+    """
+    Fail fast with a timeout error when an upstream circuit is open or the
+    request has run out of time, instead of a server error.
+    """
+    def process_exception(self, request, exception):
+        if isinstance(exception, (CircuitOpen, DeadlineExceeded)):
+            log.warning('Failing fast: {0}'.format(exception))
+            return system_error(request, code=msg.INTERNAL_TIMEOUT,
+                                status=503)
+
+
+class DeadlineMiddleware(object):
+    """
+    Give the upstream calls made for each request a shared deadline,
+    see settings.UPSTREAM_TIMEOUTS.
+    """
+    def process_request(self, request):
+        set_deadline(settings.UPSTREAM_TIMEOUTS['request'])
+
+    def process_response(self, request, response):
+        clear_deadline()
+        return response
+
+
+class OutboundTimingMiddleware(object):
+    """
+    Adds up the time spent calling Solitude and the Marketplace for each
+    request and logs it. With settings.SERVER_TIMING_HEADER it is also
+    added to the response in a Server-Timing header.
+    """
+    def process_request(self, request):
+        start_rollup()
+
+    def process_response(self, request, response):
+        rollup = end_rollup()
+        if not rollup or not rollup.calls:
+            return response
+        log.info('{0} upstream calls took {1}ms'
+                 .format(rollup.calls, rollup.time))
+        statsd.timing('slumber.request_time', rollup.time)
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = ('upstream;dur={0};desc="{1} calls"'
+                                         .format(rollup.time, rollup.calls))
+        return response
+
+
 class LogExceptionsMiddleware:
     """
     Logs any exception to the console.
@@ -0,0 +1,147 @@
+"""
+The session engine, see ``settings.SESSION_ENGINE``.
+
+This is the encrypted cookie session with two changes:
+
+* The boolean flags that webpay keeps in the session, such as
+  ``uuid_has_pin``, are packed into a single integer before the session is
+  pickled, compressed and encrypted.
+* A session is only saved, and the cookie only set, if its data really
+  changed. Setting a key to the value it already has does not count. So
+  that an active session does not expire, the cookie is still refreshed
+  once it is older than half of ``SESSION_COOKIE_AGE``.
+"""
+import copy
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.utils import baseconv
+from django.utils.six.moves import cPickle as pickle
+
+import encrypted_cookies
+from encrypted_cookies import EncryptingPickleSerializer
+
+from webpay.base.logger import getLogger
+
+log = getLogger('w.session')
+
+# Only ever add to the end of this, the position of each flag is its bit in
+# cookies that have already been sent.
+FLAGS = (
+    'is_simulation',
+    'super_powers',
+    'uuid_has_confirmed_pin',
+    'uuid_has_new_pin',
+    'uuid_has_pin',
+    'uuid_needs_pin_reset',
+    'uuid_pin_is_locked',
+    'uuid_pin_was_locked',
+    'was_reverified',
+)
+FLAGS_KEY = '~flags'
+SALT = 'encrypted_cookies'
+
+
+def pack(data):
+    """
+    Returns a copy of the session data with the boolean flags packed.
+
+    Each flag has two bits: one that is set if the flag is in the session
+    and one for its value.
+    """
+    packed = {}
+    bits = 0
+    for key, value in data.items():
+        if key in FLAGS and isinstance(value, bool):
+            bits |= (1 | value << 1) << (FLAGS.index(key) * 2)
+        else:
+            packed[key] = value
+    if bits:
+        packed[FLAGS_KEY] = bits
+    return packed
+
+
+def unpack(packed):
+    """
+    Returns the session data with the flags unpacked, see :func:`pack`.
+    """
+    bits = packed.pop(FLAGS_KEY, 0)
+    for position, key in enumerate(FLAGS):
+        if bits >> (position * 2) & 1:
+            packed[key] = bool(bits >> (position * 2 + 1) & 1)
+    return packed
+
+
+class CompactSerializer(EncryptingPickleSerializer):
+    """
+    Packs the flags before pickling, compressing and encrypting the session.
+    """
+
+    def dumps(self, obj):
+        return super(CompactSerializer, self).dumps(pack(obj))
+
+    def loads(self, data):
+        return unpack(super(CompactSerializer, self).loads(data))
+
+
+class SessionStore(encrypted_cookies.SessionStore):
+
+    def __init__(self, *args, **kw):
+        # The data as it was loaded or last saved.
+        self._saved = {}
+        self._changed = False
+        super(SessionStore, self).__init__(*args, **kw)
+
+    @property
+    def modified(self):
+        if not self._changed:
+            return False
+        return self._saved != self._session or self.needs_refresh()
+
+    @modified.setter
+    def modified(self, value):
+        self._changed = value
+
+    def needs_refresh(self):
+        """
+        Returns True if the cookie should be sent again even if the session
+        did not change.
+        """
+        if not self._session_key:
+            return True
+        try:
+            # The cookie is signed with a TimestampSigner: data:time:sig
+            signed = baseconv.base62.decode(
+                self._session_key.rsplit(':', 2)[-2])
+        except (IndexError, ValueError):
+            return True
+        return time.time() - signed > settings.SESSION_COOKIE_AGE / 2
+
+    def load(self):
+        try:
+            data = signing.loads(self.session_key,
+                                 serializer=CompactSerializer,
+                                 max_age=settings.SESSION_COOKIE_AGE,
+                                 salt=SALT)
+        except (signing.BadSignature, pickle.UnpicklingError,
+                encrypted_cookies.M2DecryptionError, ValueError):
+            # Send a good cookie in place of the bad one.
+            self._saved = None
+            self.create()
+            return {}
+        self._saved = copy.deepcopy(data)
+        return data
+
+    def save(self, must_create=False):
+        super(SessionStore, self).save(must_create=must_create)
+        self._saved = copy.deepcopy(self._session)
+
+    def _get_session_key(self):
+        # Encrypted data does not compress so unlike encrypted_cookies this
+        # does not ask signing to try. The session is compressed before it
+        # is encrypted, see COMPRESS_ENCRYPTED_COOKIE.
+        data = signing.dumps(getattr(self, '_session_cache', {}), salt=SALT,
+                             serializer=CompactSerializer)
+        log.info('encrypted session cookie is %s bytes' % len(data))
+        return data
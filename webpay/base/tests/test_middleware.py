@@ -10,8 +10,14 @@ import fudge
 import mock
 from nose.tools import eq_, ok_
 
-from webpay.base.middleware import (CEFMiddleware, CSPMiddleware,
-                                    LocaleMiddleware, LogJSONerror)
+from lib.circuit import CircuitOpen
+from webpay.base import dev_messages as msg
+from lib import deadline
+from lib.transport import get_rollup
+from webpay.base.middleware import (CEFMiddleware, CircuitOpenMiddleware,
+                                    CSPMiddleware, DeadlineMiddleware,
+                                    LocaleMiddleware, LogJSONerror,
+                                    OutboundTimingMiddleware)
 
 
 class TestLocaleMiddleware(TestCase):
@@ -94,6 +100,60 @@ class TestLogJSONerror(TestCase):
         err.process_exception(None, ExcWithContent('msg', '}]not valid JSON'))
 
 
+class TestCircuitOpenMiddleware(TestCase):
+
+    def process(self, exception):
+        req = RequestFactory().get('/', HTTP_ACCEPT='application/json')
+        return CircuitOpenMiddleware().process_exception(req, exception)
+
+    def test_circuit_open(self):
+        res = self.process(CircuitOpen('Circuit solitude.generic is open'))
+        eq_(res.status_code, 503)
+        eq_(json.loads(res.content)['error_code'], msg.INTERNAL_TIMEOUT)
+
+    def test_deadline_exceeded(self):
+        res = self.process(deadline.DeadlineExceeded('too late'))
+        eq_(res.status_code, 503)
+
+    def test_other_error(self):
+        eq_(self.process(ValueError()), None)
+
+
+class TestDeadlineMiddleware(TestCase):
+
+    def test_deadline(self):
+        middleware = DeadlineMiddleware()
+        req = RequestFactory().get('/')
+        with self.settings(UPSTREAM_TIMEOUTS={'request': 5}):
+            middleware.process_request(req)
+        ok_(4 < deadline.remaining() <= 5)
+        middleware.process_response(req, http.HttpResponse())
+        eq_(deadline.remaining(), None)
+
+
+class TestOutboundTimingMiddleware(TestCase):
+
+    def process(self, calls=()):
+        middleware = OutboundTimingMiddleware()
+        req = RequestFactory().get('/')
+        middleware.process_request(req)
+        for ms in calls:
+            get_rollup().add(ms)
+        return middleware.process_response(req, http.HttpResponse())
+
+    def test_no_calls(self):
+        ok_('Server-Timing' not in self.process())
+        eq_(get_rollup(), None)
+
+    def test_no_header(self):
+        ok_('Server-Timing' not in self.process([10, 20]))
+
+    @override_settings(SERVER_TIMING_HEADER=True)
+    def test_header(self):
+        eq_(self.process([10, 20])['Server-Timing'],
+            'upstream;dur=30;desc="2 calls"')
+
+
 @mock.patch('webpay.base.middleware.log_cef')
 class TestCEFMiddleware(TestCase):
 
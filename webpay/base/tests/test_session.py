@@ -0,0 +1,92 @@
+import time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import encrypted_cookies
+import mock
+from nose.tools import eq_, ok_
+
+from webpay.base.session import FLAGS_KEY, pack, SessionStore, unpack
+
+
+class TestPack(TestCase):
+
+    def test_round_trip(self):
+        data = {'uuid': 'some:uuid', 'uuid_has_pin': True,
+                'was_reverified': False, 'is_simulation': True}
+        packed = pack(data)
+        eq_(sorted(packed.keys()), [FLAGS_KEY, 'uuid'])
+        eq_(unpack(packed), data)
+
+    def test_not_bool(self):
+        data = {'super_powers': 1, 'uuid_has_pin': None}
+        eq_(pack(data), data)
+
+    def test_old_cookie(self):
+        eq_(unpack({'uuid_has_pin': True}), {'uuid_has_pin': True})
+
+
+class TestSessionStore(TestCase):
+
+    def saved(self, **data):
+        store = SessionStore()
+        store.update(data)
+        store.save()
+        return SessionStore(store.session_key)
+
+    def test_load(self):
+        store = self.saved(uuid='some:uuid', uuid_has_pin=True)
+        eq_(store['uuid'], 'some:uuid')
+        eq_(store['uuid_has_pin'], True)
+
+    def test_unchanged(self):
+        store = self.saved(uuid='some:uuid')
+        store['uuid'] = 'some:uuid'
+        ok_(not store.modified)
+
+    def test_changed(self):
+        store = self.saved(uuid='some:uuid')
+        store['uuid'] = 'another:uuid'
+        ok_(store.modified)
+
+    def test_nested_change(self):
+        store = self.saved(notes={'network': {}})
+        store['notes']['network']['mcc'] = '334'
+        store['notes'] = store['notes']
+        ok_(store.modified)
+
+    def test_saved_once(self):
+        store = SessionStore()
+        store['uuid'] = 'some:uuid'
+        store.save()
+        # The second session middleware does not save it again.
+        ok_(not store.modified)
+
+    @override_settings(SESSION_COOKIE_AGE=60)
+    def test_refresh(self):
+        with mock.patch('time.time') as now:
+            now.return_value = time.time() - 40
+            store = self.saved(uuid='some:uuid')
+        store['uuid'] = 'some:uuid'
+        ok_(store.modified)
+
+    def test_bad_cookie(self):
+        store = SessionStore('nonsense')
+        eq_(store.get('uuid'), None)
+        ok_(store.modified)
+
+    def test_old_engine_cookie(self):
+        old = encrypted_cookies.SessionStore()
+        old['uuid'] = 'some:uuid'
+        old.save()
+        eq_(SessionStore(old.session_key)['uuid'], 'some:uuid')
+
+    def test_smaller(self):
+        data = dict((key, True) for key in ('uuid_has_pin', 'uuid_has_new_pin',
+                                            'uuid_pin_is_locked',
+                                            'was_reverified'))
+        old = encrypted_cookies.SessionStore()
+        old.update(data)
+        old.save()
+        ok_(len(self.saved(**data).session_key) < len(old.session_key))
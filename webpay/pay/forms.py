@@ -2,7 +2,7 @@ from django import forms
 from django.conf import settings
 
 from django_paranoia.forms import ParanoidForm
-import jwt
+from mozpay.exc import InvalidJWT
 
 from lib.solitude.constants import ACCESS_SIMULATE
 from tower import ugettext_lazy as _
@@ -10,6 +10,7 @@ from tower import ugettext_lazy as _
 from webpay.base import dev_messages as msg
 from webpay.base.logger import getLogger
 
+from .tokens import get_verified, ParsedJWT
 from .utils import lookup_issuer, UnknownIssuer
 
 log = getLogger('w.pay')
@@ -29,6 +30,12 @@ class VerifyForm(ParanoidForm):
     key = settings.KEY
     secret = settings.SECRET
     is_simulation = False
+    # The access flag of an in-app issuer, None for the Marketplace.
+    access = None
+    # The ParsedJWT of req, once it is cleaned.
+    parsed = None
+    # The payload of req if it was verified for an earlier request.
+    verified = None
 
     def clean(self):
         cleaned_data = super(VerifyForm, self).clean()
@@ -40,13 +47,19 @@ class VerifyForm(ParanoidForm):
 
     def clean_req(self):
         data = self.cleaned_data['req']
-        jwt_data = data.encode('ascii', 'ignore')
-        log.debug('incoming JWT data: %r' % jwt_data)
-        try:
-            payload = jwt.decode(jwt_data, verify=False)
-        except jwt.InvalidTokenError, exc:
-            log.debug('Error decoding JWT: {0}'.format(exc))
-            raise forms.ValidationError(msg.JWT_DECODE_ERR)
+        log.debug('incoming JWT data: %r' % data)
+        cached = get_verified('pay', data)
+        if cached:
+            # The page was reloaded, skip the issuer lookup and the
+            # signature check.
+            payload = cached['payload']
+        else:
+            try:
+                self.parsed = ParsedJWT(data)
+            except InvalidJWT, exc:
+                log.debug('Error decoding JWT: {0}'.format(exc))
+                raise forms.ValidationError(msg.JWT_DECODE_ERR)
+            payload = self.parsed.payload
         log.debug('Received JWT: %r' % payload)
         if not isinstance(payload, dict):
             # It seems that some JWT libs are encoding strings of JSON
@@ -74,15 +87,20 @@ class VerifyForm(ParanoidForm):
                 raise forms.ValidationError(msg.NO_SIM_REASON)
 
         self.key = payload.get('iss', '')
-        try:
-            self.secret, active_product = lookup_issuer(self.key)
-        except UnknownIssuer:
-            log.info('No one registered for JWT issuer {0}'
-                     .format(repr(self.key)))
-            raise forms.ValidationError(msg.BAD_JWT_ISSUER)
-
-        if (active_product and active_product['access'] == ACCESS_SIMULATE
-                and not self.is_simulation):
+        if cached:
+            self.verified = payload
+            self.access = cached['access']
+        else:
+            try:
+                self.secret, active_product = lookup_issuer(self.key)
+            except UnknownIssuer:
+                log.info('No one registered for JWT issuer {0}'
+                         .format(repr(self.key)))
+                raise forms.ValidationError(msg.BAD_JWT_ISSUER)
+            if active_product:
+                self.access = active_product['access']
+
+        if self.access == ACCESS_SIMULATE and not self.is_simulation:
             log.info('payment key {0} can only simulate, tried to purchase'
                      .format(repr(self.key)))
             raise forms.ValidationError(msg.SIM_ONLY_KEY)
@@ -0,0 +1,115 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_statsd.clients import statsd
+import jwt
+
+from webpay.base.logger import getLogger
+from webpay.base.utils import gmtime
+from webpay.pay import outbox
+from webpay.pay.postback import get_session
+from webpay.pay.tasks import get_secret
+from webpay.pay.utils import (format_exception, NOTICE_NAMES, NoticeRetry,
+                              post_notice)
+
+log = getLogger('w.pay.replay')
+
+
+def resign(notice):
+    """
+    Returns the notice signed again with a new expiry time.
+    """
+    payload = jwt.decode(notice, verify=False)
+    issued_at = gmtime()
+    payload.update(iat=issued_at, exp=issued_at + 3600)
+    return jwt.encode(payload, get_secret(payload['aud']), algorithm='HS256')
+
+
+def replay(record):
+    """
+    Send a notice from the outbox again. Returns True if it was delivered.
+    """
+    try:
+        notice = resign(record.notice)
+        outbox.write(record.trans_id, record.type, record.url, notice,
+                     record.simulated, record.attempts + 1)
+        post_notice(record.url, notice, record.trans_id,
+                    session=get_session(record.url))
+    except Exception, exc:
+        log.error('Replaying {0} {1} to {2} failed'.format(
+            record.type, record.trans_id, record.url), exc_info=True)
+        outbox.sent(record.trans_id, record.type, False,
+                    format_exception(exc))
+        statsd.incr('purchase.outbox.replay.failure')
+        return False
+    outbox.sent(record.trans_id, record.type, True)
+    statsd.incr('purchase.outbox.replay.delivered')
+    return True
+
+
+class Command(BaseCommand):
+    help = 'Send again the notices in the outbox that were not delivered.'
+    option_list = BaseCommand.option_list + (
+        make_option('--host',
+                    help='Only notices to this host, such as app.com:8443.'),
+        make_option('--type', choices=['postback', 'chargeback'],
+                    help='Only notices of this type.'),
+        make_option('--min-age', type='int',
+                    help='Only notices first sent at least this many '
+                         'minutes ago. Defaults to the retry budget of each '
+                         'type of notice, so that notices that may still be '
+                         'retried are not sent twice.'),
+        make_option('--max-age', type='int',
+                    help='Only notices first sent at most this many '
+                         'minutes ago.'),
+        make_option('--limit', type='int',
+                    help='The most notices to send.'),
+        make_option('--concurrency', type='int', default=10,
+                    help='The most notices to send at the same time. '
+                         'Default: %default'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='List the notices instead of sending them.'),
+    )
+
+    def handle(self, *args, **options):
+        box = outbox.get_outbox()
+        if box is None:
+            raise CommandError('The outbox is not enabled, see '
+                               'settings.POSTBACK_OUTBOX.')
+        now = time.time()
+        records = []
+        for name in ([options['type']] if options['type'] else
+                     sorted(set(NOTICE_NAMES.values()))):
+            if options['min_age'] is not None:
+                min_age = options['min_age'] * 60
+            else:
+                min_age = NoticeRetry(name=name).config()['budget']
+            records.extend(box.undelivered(
+                host=options['host'] and options['host'].lower(),
+                notice_type=name,
+                older_than=now - min_age,
+                newer_than=(now - options['max_age'] * 60
+                            if options['max_age'] is not None else None),
+                limit=options['limit']))
+        records.sort(key=lambda record: record.created)
+        records = records[:options['limit']]
+
+        if options['dry_run']:
+            for record in records:
+                self.stdout.write('{0} {1} {2} attempts: {3} error: {4}'
+                                  .format(record.type, record.trans_id,
+                                          record.url, record.attempts,
+                                          record.last_error))
+            self.stdout.write('{0} notices to send.'.format(len(records)))
+            return
+
+        pool = ThreadPool(max(options['concurrency'], 1))
+        try:
+            delivered = sum(pool.map(replay, records))
+        finally:
+            pool.close()
+        self.stdout.write('Delivered {0} of {1} notices.'
+                          .format(delivered, len(records)))
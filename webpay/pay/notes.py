@@ -0,0 +1,134 @@
+"""
+The notes about the transaction being paid for: the verified pay request,
+the issuer key and the network.
+
+Notes are kept in the session. When ``settings.PAY_NOTES_STORE`` is enabled
+they are kept in the cache instead, keyed by the transaction ID they were
+first saved for, and the session only holds that key. This keeps the pay
+request out of the encrypted session cookie.
+
+When the store is enabled, celery tasks are given a small reference to the
+notes instead of the notes themselves, see :func:`notes_ref`.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_statsd.clients import statsd
+
+from webpay.base.logger import getLogger
+
+log = getLogger('w.pay.notes')
+
+
+def _key(ref):
+    return 'pay_notes:{0}'.format(ref)
+
+
+def get_notes(request, required=True):
+    """
+    Returns the notes for the request, or an empty dict if there are none.
+
+    Stored notes are only fetched once for each request, and are kept for
+    another ``PAY_NOTES_STORE['timeout']`` each time, like the session.
+
+    :param required: if the session refers to stored notes that have expired,
+                     raise NotesMissing when True, return an empty dict when
+                     False.
+    """
+    if 'notes' in request.session:
+        return request.session['notes']
+    ref = request.session.get('notes_ref')
+    if not ref:
+        return {}
+    notes = getattr(request, '_pay_notes', None)
+    if notes is None:
+        notes = cache.get(_key(ref))
+        if notes is None:
+            statsd.incr('pay.notes.missing')
+            if required:
+                log.error('notes {0} not found, they have expired'
+                          .format(ref))
+                raise NotesMissing('Notes {0} not found'.format(ref))
+            log.info('notes {0} not found, starting new ones'.format(ref))
+            notes = {}
+        else:
+            cache.set(_key(ref), notes, settings.PAY_NOTES_STORE['timeout'])
+        request._pay_notes = notes
+    return notes
+
+
+def set_notes(request, notes, ref=None):
+    """
+    Save the notes for the request.
+
+    :param ref: the transaction ID to keep the notes under, if they are
+                stored. Defaults to the one they were first saved for.
+    """
+    config = settings.PAY_NOTES_STORE
+    ref = (ref or request.session.get('notes_ref') or
+           request.session.get('trans_id'))
+    if not config['enabled'] or not ref:
+        request.session['notes'] = notes
+        return
+    cache.set(_key(ref), notes, config['timeout'])
+    request._pay_notes = notes
+    request.session['notes_ref'] = ref
+    request.session.pop('notes', None)
+
+
+class NotesMissing(Exception):
+    """The stored notes of a session or a task have expired."""
+
+
+def notes_ref(notes, trans_id):
+    """
+    Returns what to pass a celery task in place of some notes.
+
+    If the store is enabled, this is a reference to a copy of the notes
+    that is kept under their transaction ID and a hash of their content, so
+    that later changes to the notes don't affect the task. The copy is kept
+    for ``PAY_NOTES_STORE['task_timeout']``, since a task can run long after
+    the session has ended. Otherwise it is
+    the notes themselves. Tasks get the notes back with
+    :func:`resolve_notes`.
+    """
+    config = settings.PAY_NOTES_STORE
+    if not config['enabled'] or not trans_id:
+        return notes
+    digest = hashlib.sha256(json.dumps(notes, sort_keys=True)).hexdigest()
+    ref = {'notes_ref': trans_id, 'notes_hash': digest}
+    cache.set(_key('{0}:{1}'.format(trans_id, digest)), notes,
+              config['task_timeout'])
+    return ref
+
+
+def resolve_notes(value):
+    """
+    Returns the notes for a task argument made by :func:`notes_ref`.
+
+    Raises NotesMissing if they have expired.
+    """
+    if not (isinstance(value, dict) and 'notes_hash' in value):
+        # The notes were passed inline.
+        return value
+    notes = cache.get(_key('{notes_ref}:{notes_hash}'.format(**value)))
+    if notes is None:
+        raise NotesMissing('Notes {notes_ref}:{notes_hash} not found'
+                           .format(**value))
+    return notes
+
+
+def delay(task, *args, **kw):
+    """
+    Start a celery task, recording the size of its arguments in statsd.
+    """
+    try:
+        size = len(json.dumps([args, kw]))
+    except TypeError:
+        size = None
+    if size is not None:
+        statsd.gauge('celery.payload.{0}'.format(task.name), size)
+    return task.delay(*args, **kw)
@@ -0,0 +1,244 @@
+"""
+A durable record of the notices sent to app servers.
+
+Each signed notice is written to the outbox before it is posted and marked
+as delivered when the app responds with its transaction ID. A notice that
+is never delivered, because the broker lost its retry or a worker died while
+sending it, stays in the outbox and can be sent again with::
+
+    ./manage.py replay_notices
+
+The store is set by ``settings.POSTBACK_OUTBOX``. :class:`SQLiteOutbox`
+keeps a SQLite file on each celery host, other stores implement
+:class:`Outbox`.
+
+The outbox must not stop notices from being sent, so errors writing to it
+are logged and counted in statsd but not raised.
+"""
+from contextlib import closing
+import sqlite3
+import threading
+import time
+from urlparse import urlparse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from django_statsd.clients import statsd
+
+from webpay.base.logger import getLogger
+
+log = getLogger('w.pay.outbox')
+
+_outbox = None
+_outbox_lock = threading.Lock()
+_pruned = 0
+
+# Seconds between deleting delivered notices in each process.
+PRUNE_INTERVAL = 3600
+
+
+class Record(object):
+    """A notice in the outbox."""
+    fields = ('trans_id', 'type', 'url', 'host', 'notice', 'simulated',
+              'created', 'attempts', 'last_error', 'delivered')
+
+    def __init__(self, **kw):
+        for field in self.fields:
+            setattr(self, field, kw.get(field))
+
+    def __repr__(self):
+        return '<Record {0} {1}>'.format(self.type, self.trans_id)
+
+
+class Outbox(object):
+    """
+    The interface of a store for notices. A notice is keyed by its
+    transaction ID and type, so a retry replaces the notice written by the
+    attempt before it.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def add(self, trans_id, notice_type, url, notice, simulated, attempt):
+        """Write a notice that is about to be sent."""
+        raise NotImplementedError
+
+    def update(self, trans_id, notice_type, delivered=False, error=None):
+        """Record the outcome of sending a notice."""
+        raise NotImplementedError
+
+    def undelivered(self, host=None, notice_type=None, older_than=None,
+                    newer_than=None, limit=None):
+        """
+        Returns the notices that were not delivered, oldest first.
+
+        :param host: only notices to this host, such as ``app.com:8443``.
+        :param notice_type: only notices of this type, such as ``postback``.
+        :param older_than: only notices first written before this time.
+        :param newer_than: only notices first written after this time.
+        :param limit: the most notices to return.
+        """
+        raise NotImplementedError
+
+    def prune(self, before):
+        """Delete the notices that were delivered before this time."""
+        raise NotImplementedError
+
+
+class SQLiteOutbox(Outbox):
+    """
+    Keeps notices in the SQLite file at the ``path`` option.
+
+    A connection is opened for each call so that the outbox can be used
+    from the postback threads and by several celery processes at once.
+    """
+    schema = (
+        'CREATE TABLE IF NOT EXISTS notices ('
+        ' trans_id TEXT NOT NULL,'
+        ' type TEXT NOT NULL,'
+        ' url TEXT NOT NULL,'
+        ' host TEXT NOT NULL,'
+        ' notice TEXT NOT NULL,'
+        ' simulated INTEGER NOT NULL,'
+        ' created REAL NOT NULL,'
+        ' attempts INTEGER NOT NULL,'
+        ' last_error TEXT,'
+        ' delivered REAL,'
+        ' PRIMARY KEY (trans_id, type))',
+        'CREATE INDEX IF NOT EXISTS notices_undelivered'
+        ' ON notices (delivered, created)',
+    )
+
+    def __init__(self, **options):
+        super(SQLiteOutbox, self).__init__(**options)
+        self.path = options.get('path')
+        if not self.path:
+            raise ImproperlyConfigured(
+                "POSTBACK_OUTBOX['options'] needs the path of the SQLite "
+                "file, outside of the code checkout.")
+        with closing(self.connect()) as db:
+            # Readers don't block the writer.
+            db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                db.execute(statement)
+            db.commit()
+
+    def connect(self):
+        db = sqlite3.connect(self.path,
+                             timeout=self.options.get('timeout', 5))
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, trans_id, notice_type, url, notice, simulated, attempt):
+        with closing(self.connect()) as db:
+            db.execute('INSERT OR IGNORE INTO notices (trans_id, type, url,'
+                       ' host, notice, simulated, created, attempts)'
+                       ' VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                       (trans_id, notice_type, url, netloc(url), notice,
+                        simulated, time.time()))
+            db.execute('UPDATE notices SET url = ?, host = ?, notice = ?,'
+                       ' attempts = ?, delivered = NULL'
+                       ' WHERE trans_id = ? AND type = ?',
+                       (url, netloc(url), notice, attempt, trans_id,
+                        notice_type))
+            db.commit()
+
+    def update(self, trans_id, notice_type, delivered=False, error=None):
+        with closing(self.connect()) as db:
+            db.execute('UPDATE notices SET delivered = ?, last_error = ?'
+                       ' WHERE trans_id = ? AND type = ?',
+                       (time.time() if delivered else None, error,
+                        trans_id, notice_type))
+            db.commit()
+
+    def undelivered(self, host=None, notice_type=None, older_than=None,
+                    newer_than=None, limit=None):
+        query = ['SELECT * FROM notices WHERE delivered IS NULL']
+        params = []
+        for clause, value in (('host = ?', host),
+                              ('type = ?', notice_type),
+                              ('created < ?', older_than),
+                              ('created > ?', newer_than)):
+            if value is not None:
+                query.append(clause)
+                params.append(value)
+        query = ' AND '.join(query) + ' ORDER BY created'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with closing(self.connect()) as db:
+            return [Record(**dict(zip(row.keys(), row)))
+                    for row in db.execute(query, params)]
+
+    def prune(self, before):
+        with closing(self.connect()) as db:
+            db.execute('DELETE FROM notices'
+                       ' WHERE delivered IS NOT NULL AND delivered < ?',
+                       (before,))
+            db.commit()
+
+
+def netloc(url):
+    return urlparse(url).netloc.lower()
+
+
+def get_outbox():
+    """
+    Returns the outbox set by ``settings.POSTBACK_OUTBOX``, or None if it
+    is not enabled.
+    """
+    global _outbox
+    config = settings.POSTBACK_OUTBOX
+    if not config['enabled']:
+        return None
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                module, name = config['backend'].rsplit('.', 1)
+                backend = getattr(import_module(module), name)
+                _outbox = backend(**config.get('options', {}))
+    return _outbox
+
+
+def _call(method, *args, **kw):
+    try:
+        outbox = get_outbox()
+        if outbox:
+            getattr(outbox, method)(*args, **kw)
+    except Exception:
+        log.exception('outbox {0} {1} failed'.format(method, args[0]))
+        statsd.incr('purchase.outbox.error')
+
+
+def write(trans_id, notice_type, url, notice, simulated, attempt):
+    """
+    Write a notice to the outbox before it is sent.
+    """
+    _call('add', trans_id, notice_type, url, notice, simulated, attempt)
+
+
+def sent(trans_id, notice_type, success, error=None):
+    """
+    Record whether a notice was delivered.
+    """
+    _call('update', trans_id, notice_type, delivered=success,
+          error=error)
+    if success:
+        prune()
+
+
+def prune():
+    """
+    Delete the notices delivered more than ``POSTBACK_OUTBOX['keep']``
+    seconds ago, if that was not done in the last ``PRUNE_INTERVAL``.
+    """
+    global _pruned
+    keep = settings.POSTBACK_OUTBOX.get('keep')
+    now = time.time()
+    if not keep or now - _pruned < PRUNE_INTERVAL:
+        return
+    _pruned = now
+    _call('prune', now - keep)
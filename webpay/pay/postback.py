@@ -0,0 +1,455 @@
+"""
+Sending payment notices (postbacks and chargebacks) to app servers.
+
+A notice is posted by a worker thread in the celery process rather than by
+the notify task itself, so a slow app server does not tie up a celery
+worker: the task returns as soon as the notice is queued and one process can
+have ``settings.POSTBACK_WORKERS`` notices in flight. Each post has its own
+timeout, the app must still echo the transaction ID and a failed notice is
+retried like it was before, by sending the notify task again on the schedule
+of :class:`webpay.pay.utils.NoticeRetry`. Notices are kept in
+:mod:`webpay.pay.outbox` until they are delivered.
+
+Notices are queued by the host they are sent to. The worker threads take
+turns between hosts and never send more than
+``settings.POSTBACK_HOST_CONCURRENCY`` notices to one host at a time, so a
+burst of notices for one app neither holds up the others nor floods its
+server. Each host has a session that keeps that many connections open.
+
+After a number of failures in a row a host backs off, see
+``settings.POSTBACK_BACKOFF``. Its notices, new ones and ones that failed,
+are parked in its queue rather than each being retried on its own. When the
+back off is over a single notice is sent as a probe: if it works the parked
+notices are all released, if not the host backs off for longer and every
+parked notice counts that as one of its attempts. A notice that runs out of
+attempts is reported to the marketplace as before.
+
+When ``settings.POSTBACK_WORKERS`` is 0, notices are sent by the task.
+Otherwise ``settings.POSTBACK_OUTBOX`` must be enabled, since a notice the
+task has handed over to the threads is lost if the process stops.
+"""
+import collections
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from urlparse import urlparse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from django_statsd.clients import statsd
+import requests
+from requests.adapters import HTTPAdapter
+
+from lib import parallel
+from lib.deadline import clear_deadline
+from webpay.base.logger import getLogger
+
+from . import outbox
+from .constants import NOT_SIMULATED
+from .utils import (format_exception, notice_attempt, NOTICE_ERRORS,
+                    NoticeRetry, notify_failure, post_notice, record_attempt,
+                    retry_kwargs, send_pay_notice)
+
+log = getLogger('w.pay.postback')
+
+_scheduler = None
+_sessions = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def _reset():
+    # Threads and sockets are not shared with forked processes.
+    global _scheduler, _sessions, _pid
+    if _pid != os.getpid():
+        _scheduler = None
+        _sessions = {}
+        _pid = os.getpid()
+
+
+def host(url):
+    """
+    Returns the scheme and host that notices to `url` are queued by.
+    """
+    parsed = urlparse(url)
+    return '{0}://{1}'.format(parsed.scheme, parsed.netloc.lower())
+
+
+def get_scheduler():
+    """
+    Return the scheduler for this process, creating it if needed.
+
+    Raises ImproperlyConfigured if the outbox is not enabled.
+    """
+    global _scheduler
+    with _lock:
+        _reset()
+        if _scheduler is None:
+            if not settings.POSTBACK_OUTBOX['enabled']:
+                raise ImproperlyConfigured(
+                    'POSTBACK_WORKERS needs POSTBACK_OUTBOX to be enabled, '
+                    'or queued notices are lost when the process stops.')
+            _scheduler = Scheduler(settings.POSTBACK_WORKERS,
+                                   settings.POSTBACK_HOST_CONCURRENCY)
+    return _scheduler
+
+
+def get_session(url):
+    """
+    Return the session for the host of `url`, creating it if needed.
+    """
+    key = host(url)
+    with _lock:
+        _reset()
+        if key not in _sessions:
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.POSTBACK_HOST_CONCURRENCY)
+            session = requests.Session()
+            session.mount(key, adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+class Result(object):
+    """
+    The result of the first attempt to send a notice, see
+    :class:`lib.parallel.Pending`.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+    def set(self, value):
+        if not self.event.is_set():
+            self.value = value
+            self.event.set()
+
+    def ready(self):
+        return self.event.is_set()
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError()
+        return self.value
+
+
+class Notice(object):
+    """
+    A notice to send, with the arguments of :func:`dispatch`.
+
+    :param attempt: the number of the next attempt to send it.
+    :param started: the time of its first attempt.
+    :param scheduled: the time its next attempt is due.
+    """
+
+    def __init__(self, url, notice_type, signed_notice, trans_id,
+                 notifier_task, task_args, attempt=1, started=None,
+                 scheduled=None, simulated=NOT_SIMULATED):
+        self.url = url
+        self.host = host(url)
+        self.policy = NoticeRetry(notice_type)
+        self.signed_notice = signed_notice
+        self.trans_id = trans_id
+        self.notifier_task = notifier_task
+        self.task_args = task_args
+        self.attempt = attempt
+        self.started = started or time.time()
+        self.scheduled = scheduled or time.time()
+        self.simulated = simulated
+        # The attempt last written to the outbox.
+        self.written = None
+        self.result = Result()
+        # A notice can be sent long after its task has finished.
+        self.call = parallel.capture(
+            send, args=(self,), stat='purchase.send_pay_notice.dispatch',
+            deadline=False)
+
+    def write(self):
+        """
+        Write the notice to the outbox, once for each attempt.
+        """
+        if self.written != self.attempt:
+            outbox.write(self.trans_id, self.policy.name, self.url,
+                         self.signed_notice, self.simulated, self.attempt)
+            self.written = self.attempt
+
+
+class Health(object):
+    """The recent failures of one host."""
+
+    def __init__(self):
+        self.failures = 0
+        # While set, the host is backing off until this time or until a
+        # probe works.
+        self.until = 0
+        self.backoff = 0
+        self.probing = False
+
+
+class Scheduler(object):
+    """
+    Sends notices on worker threads, taking turns between hosts.
+
+    :param workers: the number of threads.
+    :param per_host: the most notices to send to one host at the same time.
+    """
+
+    def __init__(self, workers, per_host):
+        self.per_host = per_host
+        self.cond = threading.Condition()
+        # Hosts in the order they get their next turn, with their queues.
+        self.queues = collections.OrderedDict()
+        self.active = collections.defaultdict(int)
+        self.health = {}
+        for number in range(workers):
+            thread = threading.Thread(target=self.work,
+                                      name='postback-%s' % number)
+            thread.daemon = True
+            thread.start()
+
+    def put(self, notice):
+        """
+        Queue a notice.
+
+        :rtype: a :class:`lib.parallel.Pending` for its first attempt.
+        """
+        with self.cond:
+            self.park(notice)
+            self.cond.notify()
+        return parallel.Pending(notice.result)
+
+    def park(self, notice):
+        self.queues.setdefault(notice.host,
+                               collections.deque()).append(notice)
+
+    def take(self):
+        """
+        Returns the next notice to send, or None if there is nothing to
+        send. Must be called with the condition held.
+        """
+        now = time.time()
+        for key in self.queues.keys():
+            health = self.health.get(key)
+            if health and health.until:
+                if (now < health.until or health.probing or
+                        self.active.get(key)):
+                    continue
+                log.info('probing {0}'.format(key))
+                health.probing = True
+            elif self.active.get(key, 0) >= self.per_host:
+                continue
+            queue = self.queues.pop(key)
+            notice = queue.popleft()
+            if queue:
+                # To the back of the line.
+                self.queues[key] = queue
+            self.active[key] += 1
+            return notice
+        return None
+
+    def wait_time(self):
+        """
+        Returns the seconds until the next host can be probed, or None.
+
+        A host that is being probed, or still has notices being sent, is
+        left out: :meth:`done` wakes the workers when those finish.
+        """
+        untils = [self.health[key].until for key in self.queues
+                  if key in self.health and self.health[key].until and
+                  not self.health[key].probing and not self.active.get(key)]
+        if untils:
+            return max(min(untils) - time.time(), 0.01)
+        return None
+
+    def done(self, notice, success, error=''):
+        """
+        Record the outcome of sending a notice.
+
+        :param success: True if it was sent, False if it failed or None if
+                        it raised an unexpected exception, which is retried
+                        like a failure.
+        :param error: the last error, for the result.
+        """
+        config = settings.POSTBACK_BACKOFF
+        retry, failed = [], []
+        with self.cond:
+            key = notice.host
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+            health = self.health.get(key)
+            probe = bool(health and health.probing)
+            if probe:
+                health.probing = False
+
+            if success:
+                if health and health.until:
+                    log.info('{0} is back, releasing {1} notices'.format(
+                        key, len(self.queues.get(key, ()))))
+                    statsd.incr('purchase.postback.host.recovered')
+                self.health.pop(key, None)
+            else:
+                health = self.health.setdefault(key, Health())
+                health.failures += 1
+                if probe or (not health.until and
+                             health.failures >= config['failures']):
+                    health.backoff = min(config['cap'],
+                                         health.backoff * 2 or config['base'])
+                    health.until = time.time() + health.backoff
+                    log.warning('{0} failed {1} times in a row, backing off '
+                                'for {2}s'.format(key, health.failures,
+                                                  health.backoff))
+                    statsd.incr('purchase.postback.host.backoff')
+                if probe:
+                    # The probe was an attempt for every parked notice.
+                    failed.extend(self._count_attempt(key))
+                delay = notice.policy.next_delay(notice.attempt,
+                                                 notice.started)
+                if delay is None:
+                    failed.append(notice)
+                elif health.until:
+                    self._next_attempt(notice, health)
+                    self.park(notice)
+                    statsd.incr('purchase.postback.parked')
+                else:
+                    retry.append((notice, delay))
+            self.cond.notify_all()
+
+        # These can run long after the task that sent the notice, they must
+        # not be cut short by a deadline that is left on the thread.
+        clear_deadline()
+        try:
+            for each, delay in retry:
+                _safely(retry_later, each, delay)
+            for each in failed:
+                _safely(give_up, each)
+        finally:
+            for each in [notice] + failed:
+                each.result.set((bool(success), error))
+
+    def _count_attempt(self, key):
+        # Returns the parked notices that are out of attempts.
+        failed, kept = [], collections.deque()
+        for notice in self.queues.pop(key, ()):
+            if notice.policy.next_delay(notice.attempt,
+                                        notice.started) is None:
+                failed.append(notice)
+            else:
+                self._next_attempt(notice, self.health[key])
+                kept.append(notice)
+        if kept:
+            self.queues[key] = kept
+        return failed
+
+    def _next_attempt(self, notice, health):
+        # A parked notice is due when the host can be probed.
+        notice.attempt += 1
+        notice.scheduled = health.until
+
+    def work(self):
+        while True:
+            with self.cond:
+                notice = self.take()
+                while notice is None:
+                    self.cond.wait(self.wait_time())
+                    notice = self.take()
+            success, error = None, ''
+            value = notice.call()
+            if isinstance(value, parallel.Failure):
+                log.error('Notice for transaction %s failed'
+                          % notice.trans_id, exc_info=value.exc_info)
+                error = format_exception(value.exc_info[1])
+            else:
+                success, error = value
+            try:
+                self.done(notice, success, error)
+            except Exception:
+                log.exception('Could not record the outcome of notice for '
+                              'transaction %s' % notice.trans_id)
+                statsd.incr('purchase.postback.done.error')
+
+
+def dispatch(url, notice_type, signed_notice, trans_id, notifier_task,
+             task_args, simulated=NOT_SIMULATED):
+    """
+    Send a notice in the background.
+
+    Takes the same arguments as
+    :func:`webpay.pay.utils.send_pay_notice` and must be called from the
+    notify task. Returns an object with a ``get()`` method that waits for
+    the ``(success, last_error)`` of the first attempt.
+    """
+    if not settings.POSTBACK_WORKERS:
+        return parallel.Done(send_pay_notice(
+            url, notice_type, signed_notice, trans_id, notifier_task,
+            task_args, simulated=simulated))
+
+    log.info('queueing notice of type %s for %s' % (notice_type, url))
+    statsd.incr('purchase.send_pay_notice.queued')
+    attempt, started, scheduled = notice_attempt(notifier_task)
+    notice = Notice(url, notice_type, signed_notice, trans_id, notifier_task,
+                    task_args, attempt=attempt, started=started,
+                    scheduled=scheduled, simulated=simulated)
+    # The task is done with the notice once it is queued, so it must be in
+    # the outbox before then.
+    notice.write()
+    return get_scheduler().put(notice)
+
+
+def send(notice):
+    """
+    Post a notice. Returns a tuple of (success, last_error) like
+    send_pay_notice.
+    """
+    record_attempt(notice.policy, notice.attempt, notice.scheduled)
+    notice.write()
+    try:
+        post_notice(notice.url, notice.signed_notice, notice.trans_id,
+                    session=get_session(notice.url))
+    except NOTICE_ERRORS, exc:
+        log.error('Notice for transaction %s raised exception in URL %s'
+                  % (notice.trans_id, notice.url), exc_info=True)
+        outbox.sent(notice.trans_id, notice.policy.name, False,
+                    format_exception(exc))
+        return False, format_exception(exc)
+
+    outbox.sent(notice.trans_id, notice.policy.name, True)
+    log.debug('URL %s responded OK for transaction %s '
+              'notification' % (notice.url, notice.trans_id))
+    return True, ''
+
+
+def _safely(func, notice, *args):
+    # A worker thread must outlive any error from celery or the marketplace.
+    try:
+        func(notice, *args)
+    except Exception:
+        log.exception('{0} failed for transaction {1}'.format(
+            func.__name__, notice.trans_id))
+        statsd.incr('purchase.postback.{0}.error'.format(func.__name__))
+
+
+def retry_later(notice, delay):
+    """
+    Send the notify task again in `delay` seconds, which is what
+    notifier_task.retry() does but that only works in the task.
+    """
+    notice.notifier_task.apply_async(
+        args=notice.task_args, kwargs=retry_kwargs(notice.started, delay),
+        countdown=delay, retries=notice.attempt)
+    statsd.incr('purchase.send_pay_notice.retry')
+
+
+def give_up(notice):
+    """
+    Stop trying to send a notice that is out of attempts.
+    """
+    if notice.simulated == NOT_SIMULATED:
+        notify_failure(notice.url, notice.trans_id, notice.attempt)
+    else:
+        log.info('Not notifying anyone about simulated failure '
+                 'for %r' % notice.trans_id)
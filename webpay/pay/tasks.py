@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import sys
@@ -5,14 +6,17 @@ import urlparse
 import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 
 from celeryutils import task
 import jwt
+from lib import parallel
+from lib.deadline import with_deadline
 from lib.marketplace.api import client as mkt_client, UnknownPricePoint
 from lib.solitude import constants
-from lib.solitude.api import client, ProviderHelper
+from lib.solitude.api import client, ProviderHelper, resources
 from multidb.pinning import use_master
 
 from webpay.base import dev_messages
@@ -20,7 +24,10 @@ from webpay.base.utils import gmtime, uri_to_pk
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
 from webpay.pay.errors import InvalidPublicID, NoValidSeller
 from .constants import NOT_SIMULATED, SIMULATED_POSTBACK, SIMULATED_CHARGEBACK
-from .utils import send_pay_notice, trans_id
+from .notes import (delay, get_notes, notes_ref, NotesMissing,
+                    resolve_notes, set_notes)
+from . import postback
+from .utils import get_issuer, localize_pay_request, trans_id, UnknownIssuer
 
 log = logging.getLogger('w.pay.tasks')
 notify_kw = dict(default_retry_delay=15,  # seconds
@@ -44,13 +51,13 @@ def configure_transaction(request, trans=None, mcc=None, mnc=None):
         log.info('is_simulation: skipping configure payments step')
         return (False, None)
 
-    notes = request.session.get('notes', {})
+    notes = get_notes(request)
     if mcc and mnc:
         notes['network'] = {'mnc': mnc, 'mcc': mcc}
     else:
         # Reset network state to avoid leakage from previous states.
         notes['network'] = {}
-    request.session['notes'] = notes
+    set_notes(request, notes)
     log.info('Added mcc/mnc to session: '
              '{network}'.format(network=notes['network']))
 
@@ -84,23 +91,25 @@ def configure_transaction(request, trans=None, mcc=None, mnc=None):
         return (False, None)
 
     # Localize the product before sending it off to solitude/bango.
-    _localize_pay_request(request)
+    if _localize_pay_request(request):
+        set_notes(request, notes)
 
     log.info('configuring payment in background for trans {t} (status={s}); '
              'Last configured: {c}'.format(t=request.session['trans_id'],
                                            s=trans.get('status'),
                                            c=last_configured))
 
-    network = request.session['notes'].get('network', {})
+    network = notes.get('network', {})
     providers = ProviderHelper.supported_providers(
         mcc=network.get('mcc'),
         mnc=network.get('mnc'),
     )
 
-    start_pay.delay(request.session['trans_id'],
-                    request.session['notes'],
-                    request.session['uuid'],
-                    [p.name for p in providers])
+    delay(start_pay,
+          request.session['trans_id'],
+          notes_ref(notes, request.session['trans_id']),
+          request.session['uuid'],
+          [p.name for p in providers])
 
     # Now that the background task has been started successfully,
     # prevent configuration from running twice.
@@ -110,43 +119,40 @@ def configure_transaction(request, trans=None, mcc=None, mnc=None):
 
 
 def _localize_pay_request(request):
+    """
+    Localize the pay request in the notes to the locale of the request.
+
+    The pay request is normally localized when it is verified, this is for
+    when the locale has changed since then.
+
+    Returns True if the notes were changed.
+    """
     if hasattr(request, 'locale'):
+        notes = get_notes(request)
+        if notes.get('locale') == request.locale:
+            return False
         try:
-            pay_req = request.session['notes']['pay_request']
-            req = pay_req['request']
+            pay_req = notes['pay_request']
         except KeyError:
-            return
-
-        trans_id = request.session.get('trans_id')
-
-        locales = req.get('locales')
-        if locales:
-            fallback = request.locale.split('-')[0]
-            if request.locale in locales:
-                loc = locales[request.locale]
-            elif fallback in locales:
-                log.info('Fell back from {0} to {1} (iss: {2}, trans_id: {3})'
-                         .format(request.locale, fallback, pay_req.get('iss'),
-                                 trans_id))
-                loc = locales[fallback]
-            else:
-                log.info(('No localization found for {0} (iss: {1}, '
-                          'trans_id: {2})').format(request.locale,
-                                                   pay_req.get('iss'),
-                                                   trans_id))
-                return
-
-            req['name'] = loc.get('name') or req['name']
-            req['description'] = loc.get('description') or req['description']
+            return False
+        localize_pay_request(pay_req, request.locale,
+                             trans_id=request.session.get('trans_id'))
+        notes['locale'] = request.locale
+        return True
+    return False
 
 
 def get_secret(issuer_key):
     """Resolve the secret for this JWT."""
     if is_marketplace(issuer_key):
         return settings.SECRET
-    else:
-        return (client.slumber.generic.product
-                      .get_object_or_404(public_id=issuer_key))['secret']
+    try:
+        return get_issuer(issuer_key)['secret']
+    except UnknownIssuer:
+        # Notices are still sent for sellers that were deactivated
+        # after the purchase.
+        return client.get_generic('product', issuer_key,
+                                  lookup='public_id')['secret']
 
 
 def get_provider_seller_uuid(issuer_key, product_data, provider_names):
@@ -172,10 +178,10 @@ def get_provider_seller_uuid(issuer_key, product_data, provider_names):
         public_id = issuer_key
         log.info('Got public_id from in-app purchase')
 
-    product = client.slumber.generic.product.get_object_or_404(
-        public_id=public_id)
+    product = client.get_generic('product', public_id, lookup='public_id')
     seller = (client.slumber.generic.seller(uri_to_pk(product['seller']))
               .get_object_or_404())
+    resources.add('seller', seller.get('uuid'), seller)
     generic_seller_uuid = seller['uuid']
     return product, seller, generic_seller_uuid
 
@@ -212,6 +218,7 @@ def is_marketplace(issuer_key):
 
 @task
 @use_master
+@with_deadline()
 @transaction.commit_on_success
 def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
     """
@@ -226,7 +233,8 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
         Unique identifier for a new transaction.
 
     **notes**
-        Dict of notes about this transaction.
+        Dict of notes about this transaction, or a reference to them from
+        :func:`webpay.pay.notes.notes_ref`.
 
     **user_uuid**
         Unique identifier for the buyer user.
@@ -237,6 +245,14 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
         Example: ['bango', 'boku'].
 
     """
+    try:
+        notes = resolve_notes(notes)
+    except NotesMissing:
+        log.exception('while starting payment for transaction {t}'
+                      .format(t=transaction_uuid))
+        pay_error_handler(error_type=NotesMissing, provider_helper=None,
+                          source='other', transaction_uuid=transaction_uuid)
+        raise
     key = notes['issuer_key']
     source = 'marketplace' if is_marketplace(key) else 'other'
     pay = notes['pay_request']
@@ -245,6 +261,12 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
     provider_helper, provider_seller_uuid, generic_seller_uuid = (
         None, None, None)
 
+    # The icon doesn't depend on anything else so look it up while the
+    # seller and prices are found.
+    icon = (parallel.submit(get_icon_url, args=(pay['request'],),
+                            stat='purchase.start_pay.icon_url')
+            if settings.USE_PRODUCT_ICONS else None)
+
     try:
         product, seller, generic_seller_uuid = get_provider_seller_uuid(
             key, product_data, provider_names)
@@ -264,8 +286,7 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
                           provider=provider_helper.provider.name))
 
         try:
-            icon_url = (get_icon_url(pay['request'])
-                        if settings.USE_PRODUCT_ICONS else None)
+            icon_url = icon.get() if icon else None
         except:
             log.exception('Calling get_icon_url')
             icon_url = None
@@ -285,8 +306,11 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
             mcc=network.get('mcc'),
             mnc=network.get('mnc')
         )
-        trans_pk = client.slumber.generic.transaction.get_object(
-            uuid=transaction_uuid)['resource_pk']
+        # The transaction was just created and indexed by the provider.
+        trans_pk = resources.pk('transaction', transaction_uuid)
+        if trans_pk is None:
+            trans_pk = client.slumber.generic.transaction.get_object(
+                uuid=transaction_uuid)['resource_pk']
         client.slumber.generic.transaction(trans_pk).patch({
             'notes': json.dumps(notes),
             'uid_pay': bill_id,
@@ -326,12 +350,13 @@ def pay_error_handler(
     Unfortunately many things (buyer, seller, seller_product) are buried inside
     start_transaction, which might need its own wrapper.
     """
-    pk = None
     api = client.slumber.generic.transaction
-    try:
-        pk = api.get_object_or_404(uuid=transaction_uuid)['resource_pk']
-    except ObjectDoesNotExist:
-        pass
+    pk = resources.pk('transaction', transaction_uuid)
+    if pk is None:
+        try:
+            pk = api.get_object_or_404(uuid=transaction_uuid)['resource_pk']
+        except ObjectDoesNotExist:
+            pass
 
     # If the provider_helper is None, then no provider was found.
     provider = None
@@ -370,6 +395,7 @@ def pay_error_handler(
 
 @task(**notify_kw)
 @use_master
+@with_deadline()
 def payment_notify(transaction_uuid, **kw):
     """
     Notify the app of a successful payment by posting a JWT.
@@ -387,6 +413,7 @@ def payment_notify(transaction_uuid, **kw):
 
 @task(**notify_kw)
 @use_master
+@with_deadline()
 def chargeback_notify(transaction_uuid, **kw):
     """
     Notify the app of a chargeback by posting a JWT.
@@ -422,6 +449,7 @@ def _fake_amount(price_point):
 
 @task(**notify_kw)
 @use_master
+@with_deadline()
 def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
     """
     Post JWT notice to an app about a simulated payment.
@@ -429,6 +457,7 @@ def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
     This isn't really much different from a regular notice except
     that a fake transaction_uuid is created.
     """
+    pay_request = resolve_notes(pay_request)
     if not trans_uuid:
         trans_uuid = 'simulate:%s' % uuid.uuid4()
     trans = {'uuid': trans_uuid,
@@ -458,6 +487,7 @@ def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
 
 @task(**notify_kw)
 @use_master
+@with_deadline()
 def free_notify(notes, solitude_buyer_uuid, **kw):
     """
     Post JWT notice to an app about a pricePoint 0 product.
@@ -468,6 +498,7 @@ def free_notify(notes, solitude_buyer_uuid, **kw):
 
     """
 
+    notes = resolve_notes(notes)
     # No real transaction is created as this is a free product.
     trans = {
         'uuid': 'free:{u}'.format(u=uuid.uuid4()),
@@ -508,15 +539,30 @@ def get_icon_url(request):
         'ext_size': ext_size,
         'size': size
     }
+    config = settings.ICON_CACHE
+    key = 'icon:{0}:{1}'.format(hashlib.md5(url.encode('utf8')).hexdigest(),
+                                size)
+    found = cache.get(key)
+    if found:
+        return found
+    if cache.get(key + ':pending'):
+        # The marketplace is still fetching it.
+        return None
+
     try:
         res = mkt_client.api.webpay.product.icon.get_object(**data)
-        return res['url']
     except ObjectDoesNotExist:
-        # Queue the image to be fetched, resized and cached.
-        mkt_client.api.webpay.product.icon.post(data)
-        # The URL will be fetched on next purchase.
+        # Only queue the image once while it is fetched, resized and cached.
+        if (not config['pending_timeout'] or
+                cache.add(key + ':pending', True, config['pending_timeout'])):
+            mkt_client.api.webpay.product.icon.post(data)
+        # The URL will be fetched on a later purchase.
         return None
 
+    if config['timeout']:
+        cache.set(key, res['url'], config['timeout'])
+    return res['url']
+
 
 def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
             task_args=None):
@@ -549,8 +595,8 @@ def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
 
     signed_notice = jwt.encode(notice, get_secret(notes['issuer_key']),
                                algorithm='HS256')
-    send_pay_notice(url, trans['type'], signed_notice, trans['uuid'],
-                    notifier_task, task_args, simulated=simulated)
+    postback.dispatch(url, trans['type'], signed_notice, trans['uuid'],
+                      notifier_task, task_args, simulated=simulated)
 
 
 def _prepare_notice(trans):
@@ -3,6 +3,7 @@ import json
 import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
@@ -98,6 +99,17 @@ class TestPay(PayTester):
         eq_(data['status'], 'ok')
         eq_(data['simulation'], None)
 
+    @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
+    def test_reload_inapp_payment(self, get_active_product):
+        cache.clear()
+        self.set_secret(get_active_product)
+        req = self.request(iss=self.key, app_secret=self.secret)
+        with self.settings(JWT_CACHE={'timeout': 60}):
+            for x in range(2):
+                eq_(self.post(req=req).status_code, 200)
+        # The second request used the verified JWT.
+        eq_(get_active_product.call_count, 1)
+
     @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
     def test_inapp_wrong_secret(self, get_active_product):
         self.solitude.generic.product.get_object.return_value = {
@@ -107,6 +119,15 @@ class TestPay(PayTester):
                                             app_secret=self.secret + 'nope'))
         eq_(res.status_code, 400, res)
 
+    @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
+    def test_inapp_changed_secret(self, get_active_product):
+        get_active_product.side_effect = [
+            {'secret': 'old', 'access': constants.ACCESS_PURCHASE},
+            {'secret': self.secret, 'access': constants.ACCESS_PURCHASE}]
+        res = self.post(request_kwargs=dict(iss=self.key,
+                                            app_secret=self.secret))
+        eq_(res.status_code, 200, res)
+
     @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
     def test_inapp_wrong_key(self, get_active_product):
         get_active_product.side_effect = ObjectDoesNotExist
@@ -119,7 +140,7 @@ class TestPay(PayTester):
     @mock.patch.object(settings, 'PRODUCT_DESCRIPTION_LENGTH', 255)
     def test_truncate_long_locale_description(self):
         payjwt = self.payload()
-        payjwt['request']['defaultLocale'] = 'en'
+        payjwt['request']['defaultLocale'] = 'it'
         payjwt['request']['locales'] = {
             'it': {
                 'description': 'x' * 257
@@ -132,6 +153,24 @@ class TestPay(PayTester):
         req = self.client.session['notes']['pay_request']['request']
         eq_(len(req['locales']['it']['description']), 255)
 
+    def test_prune_locales(self):
+        payjwt = self.payload()
+        payjwt['request']['defaultLocale'] = 'it'
+        payjwt['request']['locales'] = {
+            'en': {'name': 'The album'},
+            'fr': {'name': "L'album"},
+            'it': {'name': "L'album"},
+            'pt-BR': {'name': 'O album'},
+        }
+        res = self.post(req=self.request(payload=payjwt),
+                        HTTP_ACCEPT_LANGUAGE='en-us')
+        eq_(res.status_code, 200)
+        notes = self.client.session['notes']
+        eq_(sorted(notes['pay_request']['request']['locales']), ['en', 'it'])
+        # It was localized once, when it was verified.
+        eq_(notes['pay_request']['request']['name'], 'The album')
+        eq_(notes['locale'], 'en-US')
+
     def test_handle_none_type_locale_description(self):
         payjwt = self.payload()
         payjwt['request']['defaultLocale'] = 'en'
@@ -292,7 +331,7 @@ class TestBadPayRequests(PayTester):
         res = self.post(request_kwargs=dict(payload=payjwt))
         self.assert_error_code(res, msg.MALFORMED_URL)
 
-    @mock.patch('webpay.pay.views.verify_jwt')
+    @mock.patch('webpay.pay.tokens.ParsedJWT.verify')
     def test_request_expired(self, verify):
         verify.side_effect = RequestExpired({})
         res = self.post()
@@ -0,0 +1,122 @@
+from django.core.cache import cache
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, ok_, raises
+
+from webpay.base.tests import TestCase
+from webpay.pay.notes import (delay, get_notes, notes_ref, NotesMissing,
+                              resolve_notes, set_notes)
+
+
+class NotesTest(TestCase):
+
+    def setUp(self):
+        super(NotesTest, self).setUp()
+        cache.clear()
+        self.request = self.new_request()
+
+    def new_request(self, session=None):
+        request = RequestFactory().get('/')
+        request.session = session if session is not None else {}
+        return request
+
+    def test_empty(self):
+        eq_(get_notes(self.request), {})
+
+    def test_in_session(self):
+        set_notes(self.request, {'issuer_key': 'k'}, ref='trans')
+        eq_(self.request.session['notes'], {'issuer_key': 'k'})
+        eq_(get_notes(self.request), {'issuer_key': 'k'})
+
+
+@override_settings(PAY_NOTES_STORE={'enabled': True, 'timeout': 60,
+                                    'task_timeout': 600})
+class StoredNotesTest(NotesTest):
+
+    def test_in_session(self):
+        set_notes(self.request, {'issuer_key': 'k'}, ref='trans')
+        eq_(self.request.session, {'notes_ref': 'trans'})
+        # A later request fetches them from the store.
+        request = self.new_request(dict(self.request.session))
+        eq_(get_notes(request), {'issuer_key': 'k'})
+
+    def test_keeps_ref(self):
+        self.request.session['trans_id'] = 'first'
+        set_notes(self.request, {})
+        self.request.session['trans_id'] = 'retried'
+        set_notes(self.request, {'network': {}})
+        eq_(self.request.session['notes_ref'], 'first')
+
+    def test_fetched_once(self):
+        set_notes(self.request, {'issuer_key': 'k'}, ref='trans')
+        request = self.new_request(dict(self.request.session))
+        get_notes(request)['network'] = {}
+        # The same dict is returned so changes can be saved with set_notes.
+        eq_(get_notes(request)['network'], {})
+
+    def test_inline_notes(self):
+        # Sessions from before the store was enabled.
+        self.request.session['notes'] = {'issuer_key': 'k'}
+        eq_(get_notes(self.request), {'issuer_key': 'k'})
+        set_notes(self.request, get_notes(self.request), ref='trans')
+        ok_('notes' not in self.request.session)
+
+    @raises(NotesMissing)
+    def test_expired(self):
+        self.request.session['notes_ref'] = 'gone'
+        get_notes(self.request)
+
+    def test_expired_not_required(self):
+        self.request.session['notes_ref'] = 'gone'
+        eq_(get_notes(self.request, required=False), {})
+
+    @mock.patch('webpay.pay.notes.cache')
+    def test_read_keeps_notes(self, cache):
+        cache.get.return_value = {'issuer_key': 'k'}
+        self.request.session['notes_ref'] = 'trans'
+        get_notes(self.request)
+        cache.set.assert_called_with('pay_notes:trans', {'issuer_key': 'k'},
+                                     60)
+
+
+class TaskNotesTest(TestCase):
+
+    def setUp(self):
+        super(TaskNotesTest, self).setUp()
+        cache.clear()
+        self.notes = {'issuer_key': 'k', 'pay_request': {'request': {}}}
+
+    def test_inline(self):
+        eq_(notes_ref(self.notes, 'trans'), self.notes)
+        eq_(resolve_notes(self.notes), self.notes)
+
+    @override_settings(PAY_NOTES_STORE={'enabled': True, 'timeout': 60,
+                                        'task_timeout': 600})
+    def test_ref(self):
+        ref = notes_ref(self.notes, 'trans')
+        eq_(sorted(ref.keys()), ['notes_hash', 'notes_ref'])
+        # Later changes to the notes don't change what the task gets.
+        self.notes['network'] = {'mcc': '334'}
+        eq_(resolve_notes(ref),
+            {'issuer_key': 'k', 'pay_request': {'request': {}}})
+
+    @override_settings(PAY_NOTES_STORE={'enabled': True, 'timeout': 60,
+                                        'task_timeout': 600})
+    @mock.patch('webpay.pay.notes.cache')
+    def test_task_timeout(self, cache):
+        notes_ref(self.notes, 'trans')
+        eq_(cache.set.call_args[0][2], 600)
+
+    @raises(NotesMissing)
+    def test_missing(self):
+        resolve_notes({'notes_ref': 'trans', 'notes_hash': 'gone'})
+
+    @mock.patch('webpay.pay.notes.statsd')
+    def test_delay(self, statsd):
+        task = mock.Mock()
+        task.name = 'start_pay'
+        delay(task, 'trans', self.notes)
+        task.delay.assert_called_with('trans', self.notes)
+        eq_(statsd.gauge.call_args[0][0], 'celery.payload.start_pay')
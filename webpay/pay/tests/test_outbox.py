@@ -0,0 +1,154 @@
+from contextlib import closing
+import os
+import shutil
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, ok_, raises
+
+from webpay.base.tests import TestCase
+from webpay.pay import outbox
+from webpay.pay.constants import NOT_SIMULATED
+
+
+class TestSQLiteOutbox(TestCase):
+
+    def setUp(self):
+        super(TestSQLiteOutbox, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.outbox = outbox.SQLiteOutbox(
+            path=os.path.join(self.dir, 'notices.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TestSQLiteOutbox, self).tearDown()
+
+    def add(self, trans_id='some:uuid', notice_type='postback',
+            url='https://App.com/postback', attempt=1):
+        self.outbox.add(trans_id, notice_type, url, 'signed', NOT_SIMULATED,
+                        attempt)
+
+    def test_undelivered(self):
+        self.add()
+        record, = self.outbox.undelivered()
+        eq_(record.trans_id, 'some:uuid')
+        eq_(record.type, 'postback')
+        eq_(record.host, 'app.com')
+        eq_(record.notice, 'signed')
+        eq_(record.attempts, 1)
+
+    def test_delivered(self):
+        self.add()
+        self.outbox.update('some:uuid', 'postback', delivered=True)
+        eq_(self.outbox.undelivered(), [])
+
+    def test_retried(self):
+        self.add()
+        self.outbox.update('some:uuid', 'postback', error='Timeout')
+        eq_(self.outbox.undelivered()[0].last_error, 'Timeout')
+        self.add(attempt=2)
+        record, = self.outbox.undelivered()
+        eq_(record.attempts, 2)
+
+    def test_filters(self):
+        self.add()
+        self.add(trans_id='other:uuid', url='https://other.com/postback')
+        self.add(notice_type='chargeback')
+        eq_([r.trans_id for r in self.outbox.undelivered(host='other.com')],
+            ['other:uuid'])
+        eq_(len(self.outbox.undelivered(notice_type='chargeback')), 1)
+        eq_(self.outbox.undelivered(older_than=0), [])
+        eq_(len(self.outbox.undelivered(newer_than=0, limit=2)), 2)
+
+    @mock.patch('webpay.pay.outbox.time.time')
+    def test_prune(self, now):
+        now.return_value = 100
+        self.add()
+        self.add(trans_id='other:uuid')
+        self.add(trans_id='new:uuid')
+        self.outbox.update('some:uuid', 'postback', delivered=True)
+        now.return_value = 200
+        self.outbox.update('new:uuid', 'postback', delivered=True)
+        self.outbox.prune(150)
+        with closing(self.outbox.connect()) as db:
+            eq_(sorted(row[0] for row in
+                       db.execute('SELECT trans_id FROM notices')),
+                ['new:uuid', 'other:uuid'])
+
+
+@mock.patch('webpay.pay.outbox.get_outbox')
+class TestWrite(TestCase):
+
+    def test_write(self, get_outbox):
+        outbox.write('some:uuid', 'postback', 'https://app.com/postback',
+                     'signed', NOT_SIMULATED, 1)
+        get_outbox.return_value.add.assert_called_with(
+            'some:uuid', 'postback', 'https://app.com/postback', 'signed',
+            NOT_SIMULATED, 1)
+
+    @mock.patch('webpay.pay.outbox.statsd')
+    def test_errors_not_raised(self, statsd, get_outbox):
+        get_outbox.return_value.update.side_effect = IOError
+        outbox.sent('some:uuid', 'postback', True)
+        statsd.incr.assert_called_with('purchase.outbox.error')
+
+    def test_disabled(self, get_outbox):
+        get_outbox.return_value = None
+        outbox.sent('some:uuid', 'postback', True)
+
+    @override_settings(POSTBACK_OUTBOX={'enabled': True, 'keep': 60})
+    @mock.patch('webpay.pay.outbox._pruned', 0)
+    @mock.patch('webpay.pay.outbox.time.time')
+    def test_pruned(self, now, get_outbox):
+        now.return_value = outbox.PRUNE_INTERVAL
+        outbox.sent('some:uuid', 'postback', False)
+        ok_(not get_outbox.return_value.prune.called)
+        outbox.sent('some:uuid', 'postback', True)
+        outbox.sent('other:uuid', 'postback', True)
+        get_outbox.return_value.prune.assert_called_once_with(
+            outbox.PRUNE_INTERVAL - 60)
+
+
+class TestGetOutbox(TestCase):
+
+    def test_disabled(self):
+        ok_(outbox.get_outbox() is None)
+
+    @raises(ImproperlyConfigured)
+    def test_no_path(self):
+        outbox.SQLiteOutbox(path=None)
+
+    @override_settings(POSTBACK_OUTBOX={
+        'enabled': True, 'backend': 'webpay.pay.outbox.SQLiteOutbox',
+        'options': {'path': ':memory:'}})
+    @mock.patch('webpay.pay.outbox._outbox', None)
+    def test_backend(self):
+        ok_(isinstance(outbox.get_outbox(), outbox.SQLiteOutbox))
+
+
+@override_settings(POSTBACK_RETRY={
+    'attempts': 5, 'base': 0, 'cap': 0, 'budget': 3600,
+    'types': {'chargeback': {'budget': 7200}}})
+@mock.patch('webpay.pay.management.commands.replay_notices.time.time',
+            lambda: 10000)
+@mock.patch('webpay.pay.outbox.get_outbox')
+class TestReplayAge(TestCase):
+
+    def undelivered(self, get_outbox, **options):
+        get_outbox.return_value.undelivered.return_value = []
+        options.setdefault('dry_run', True)
+        call_command('replay_notices', **options)
+        return dict((kw['notice_type'], kw['older_than']) for _, kw in
+                    get_outbox.return_value.undelivered.call_args_list)
+
+    def test_retry_budget(self, get_outbox):
+        eq_(self.undelivered(get_outbox),
+            {'postback': 10000 - 3600, 'chargeback': 10000 - 7200})
+
+    def test_min_age(self, get_outbox):
+        eq_(self.undelivered(get_outbox, type='chargeback', min_age=10),
+            {'chargeback': 10000 - 600})
@@ -0,0 +1,312 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+
+import mock
+from mock import ANY
+from nose.tools import eq_, ok_, raises
+from requests.exceptions import RequestException
+
+from lib import deadline
+from lib.solitude.constants import TYPE_PAYMENT
+from webpay.base.tests import TestCase
+from webpay.pay import postback
+from webpay.pay.constants import NOT_SIMULATED, SIMULATED_POSTBACK
+
+
+@override_settings(POSTBACK_WORKERS=2,
+                   POSTBACK_OUTBOX={'enabled': True},
+                   POSTBACK_RETRY={'attempts': 3, 'base': 0, 'cap': 0,
+                                   'budget': 60})
+@mock.patch('webpay.pay.outbox._outbox', mock.Mock())
+@mock.patch('webpay.pay.postback.get_session')
+class TestDispatch(TestCase):
+
+    def setUp(self):
+        super(TestDispatch, self).setUp()
+        # Forget the failures of other tests.
+        postback.get_scheduler().health.clear()
+        self.task = mock.Mock()
+        self.task.request.retries = 0
+        self.task.request.kwargs = {}
+
+    def dispatch(self, **kw):
+        return postback.dispatch('https://app/postback', TYPE_PAYMENT,
+                                 'signed', 'some:uuid', self.task,
+                                 ['issuer', 'payload'], **kw).get()
+
+    def test_sent(self, get_session):
+        post = get_session.return_value.post
+        post.return_value.text = 'some:uuid'
+        eq_(self.dispatch(), (True, ''))
+        post.assert_called_with('https://app/postback', {'notice': 'signed'},
+                                timeout=5)
+        get_session.assert_called_with('https://app/postback')
+        ok_(not self.task.apply_async.called)
+
+    def test_retried(self, get_session):
+        get_session.return_value.post.side_effect = RequestException('500')
+        self.task.request.retries = 1
+        ok_(not self.dispatch()[0])
+        self.task.apply_async.assert_called_with(args=['issuer', 'payload'],
+                                                 kwargs=ANY, countdown=0,
+                                                 retries=2)
+
+    @mock.patch('webpay.pay.postback.notify_failure')
+    def test_failure_notifies(self, notify_failure, get_session):
+        get_session.return_value.post.side_effect = RequestException('500')
+        self.task.request.retries = 2
+        ok_(not self.dispatch()[0])
+        ok_(not self.task.apply_async.called)
+        notify_failure.assert_called_with('https://app/postback', 'some:uuid',
+                                          3)
+
+    @mock.patch('webpay.pay.postback.notify_failure')
+    def test_simulated_failure(self, notify_failure, get_session):
+        get_session.return_value.post.side_effect = RequestException('500')
+        self.task.request.retries = 2
+        self.dispatch(simulated=SIMULATED_POSTBACK)
+        ok_(not notify_failure.called)
+
+    @mock.patch('webpay.pay.postback.outbox.write')
+    @mock.patch('webpay.pay.postback.get_scheduler')
+    def test_outbox_written_when_queued(self, get_scheduler, write,
+                                        get_session):
+        scheduler = postback.Scheduler(0, 2)
+        get_scheduler.return_value = scheduler
+        postback.dispatch('https://app/postback', TYPE_PAYMENT, 'signed',
+                          'some:uuid', self.task, [])
+        write.assert_called_with('some:uuid', 'postback',
+                                 'https://app/postback', 'signed',
+                                 NOT_SIMULATED, 1)
+        # Sending the same attempt doesn't write it again.
+        get_session.return_value.post.return_value.text = 'some:uuid'
+        postback.send(scheduler.take())
+        eq_(write.call_count, 1)
+
+    @override_settings(POSTBACK_WORKERS=0)
+    @mock.patch('webpay.pay.utils.requests.post')
+    def test_synchronous(self, post, get_session):
+        post.return_value.text = 'some:uuid'
+        eq_(self.dispatch(), (True, ''))
+        ok_(not get_session.called)
+
+
+class SchedulerTest(TestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        # No threads, notices are taken by the test.
+        self.scheduler = postback.Scheduler(0, 2)
+        self.task = mock.Mock()
+
+    def put(self, url, trans_id='some:uuid', attempt=1):
+        notice = postback.Notice(url, TYPE_PAYMENT, 'signed', trans_id,
+                                 self.task, [trans_id], attempt=attempt)
+        self.scheduler.put(notice)
+        return notice
+
+    def taken(self):
+        notice = self.scheduler.take()
+        return notice and (notice.host, notice.trans_id)
+
+
+class TestScheduler(SchedulerTest):
+
+    def test_takes_turns(self):
+        for number in range(3):
+            self.put('https://big/postback', trans_id=str(number))
+        self.put('https://small/postback', trans_id='0')
+        eq_(self.taken(), ('https://big', '0'))
+        eq_(self.taken(), ('https://small', '0'))
+        eq_(self.taken(), ('https://big', '1'))
+
+    def test_host_limit(self):
+        for number in range(3):
+            self.put('https://big/postback', trans_id=str(number))
+        first = self.scheduler.take()
+        self.taken()
+        eq_(self.taken(), None)
+        self.scheduler.done(first, True)
+        eq_(self.taken(), ('https://big', '2'))
+
+    @mock.patch('webpay.pay.postback.retry_later')
+    def test_failure_retried(self, retry_later):
+        notice = self.put('https://app/postback')
+        self.scheduler.done(self.scheduler.take(), False)
+        retry_later.assert_called_with(notice, ANY)
+
+    @mock.patch('webpay.pay.postback.retry_later')
+    @mock.patch('webpay.pay.postback.send')
+    def test_send_raises(self, send, retry_later):
+        send.side_effect = ValueError('bug')
+        notice = self.put('https://app/postback')
+        # Stop the worker after one notice.
+        taken = [self.scheduler.take(), StopIteration]
+        with mock.patch.object(self.scheduler, 'take', side_effect=taken):
+            with self.assertRaises(StopIteration):
+                self.scheduler.work()
+        retry_later.assert_called_with(notice, ANY)
+        eq_(notice.result.get(0), (False, 'ValueError: bug'))
+        eq_(self.scheduler.health['https://app'].failures, 1)
+
+    @mock.patch('webpay.pay.postback.give_up')
+    def test_out_of_attempts(self, give_up):
+        notice = self.put('https://app/postback', attempt=3)
+        self.scheduler.done(self.scheduler.take(), False)
+        give_up.assert_called_with(notice)
+
+
+@override_settings(POSTBACK_BACKOFF={'failures': 2, 'base': 10, 'cap': 15},
+                   POSTBACK_RETRY={'attempts': 3, 'base': 1, 'cap': 1,
+                                   'budget': 60})
+@mock.patch('webpay.pay.postback.give_up')
+@mock.patch('webpay.pay.postback.retry_later')
+@mock.patch('webpay.pay.postback.time.time')
+class TestBackoff(SchedulerTest):
+
+    def fail(self, count):
+        for number in range(count):
+            self.put('https://dead/postback', trans_id='fail-%s' % number)
+            self.scheduler.done(self.scheduler.take(), False)
+
+    def test_backs_off(self, now, retry_later, give_up):
+        now.return_value = 100
+        self.fail(2)
+        eq_(retry_later.call_count, 1)
+        parked = self.scheduler.queues['https://dead']
+        eq_([notice.trans_id for notice in parked], ['fail-1'])
+        eq_(parked[0].attempt, 2)
+        eq_(parked[0].scheduled, 110)
+        # New notices wait too, notices to other hosts don't.
+        self.put('https://dead/postback')
+        self.put('https://app/postback')
+        eq_(self.taken(), ('https://app', 'some:uuid'))
+        eq_(self.taken(), None)
+        eq_(self.scheduler.wait_time(), 10)
+
+    def test_probe_works(self, now, retry_later, give_up):
+        now.return_value = 100
+        self.fail(2)
+        self.put('https://dead/postback')
+        now.return_value = 110
+        probe = self.scheduler.take()
+        # Only one probe at a time.
+        eq_(self.taken(), None)
+        self.scheduler.done(probe, True)
+        eq_(self.taken(), ('https://dead', 'some:uuid'))
+        ok_('https://dead' not in self.scheduler.health)
+
+    def test_no_wait_while_probing(self, now, retry_later, give_up):
+        now.return_value = 100
+        self.fail(2)
+        self.put('https://dead/postback')
+        now.return_value = 110
+        probe = self.scheduler.take()
+        # Waiting for the probe, not polling until it is done.
+        eq_(self.scheduler.wait_time(), None)
+        self.scheduler.done(probe, False)
+        eq_(self.scheduler.wait_time(), 15)
+
+    def test_probe_fails(self, now, retry_later, give_up):
+        now.return_value = 100
+        self.fail(2)
+        new = self.put('https://dead/postback')
+        now.return_value = 110
+        probe = self.scheduler.take()
+        self.scheduler.done(probe, False)
+        health = self.scheduler.health['https://dead']
+        eq_(health.until, 125)
+        # The parked notice counted the probe as an attempt.
+        eq_(new.attempt, 2)
+        eq_(probe.attempt, 3)
+        ok_(not give_up.called)
+        # The first is out of attempts after the next probe.
+        now.return_value = 125
+        self.scheduler.done(self.scheduler.take(), False)
+        give_up.assert_called_with(probe)
+        eq_(list(self.scheduler.queues['https://dead']), [new])
+
+
+@override_settings(POSTBACK_BACKOFF={'failures': 1, 'base': 60, 'cap': 60},
+                   POSTBACK_RETRY={'attempts': 2, 'base': 1, 'cap': 1,
+                                   'budget': 600})
+@mock.patch('webpay.pay.postback.notify_failure')
+class TestSideEffects(SchedulerTest):
+
+    def fail_probe(self, now):
+        now.return_value = 100
+        self.put('https://dead/postback', trans_id='first')
+        self.scheduler.done(self.scheduler.take(), False)
+        parked = self.put('https://dead/postback', trans_id='parked',
+                          attempt=2)
+        now.return_value = 160
+        probe = self.scheduler.take()
+        self.scheduler.done(probe, False, 'Timeout')
+        return probe, parked
+
+    @mock.patch('webpay.pay.postback.time.time')
+    @mock.patch('webpay.pay.postback.statsd')
+    def test_notify_failure_raises(self, statsd, now, notify_failure):
+        notify_failure.side_effect = ValueError('marketplace is down')
+        probe, parked = self.fail_probe(now)
+        # Every notice given up on was tried and got its result.
+        eq_(notify_failure.call_count, 2)
+        eq_(probe.result.get(0), (False, 'Timeout'))
+        eq_(parked.result.get(0), (False, 'Timeout'))
+        statsd.incr.assert_any_call('purchase.postback.give_up.error')
+
+    @mock.patch('webpay.pay.postback.time.time')
+    def test_stale_deadline(self, now, notify_failure):
+        remaining = []
+        notify_failure.side_effect = (
+            lambda *args: remaining.append(deadline.remaining()))
+        # The deadline of the task that queued the notices, which has passed
+        # by the time the probe fails.
+        now.return_value = 100
+        deadline.set_deadline(60)
+        try:
+            self.fail_probe(now)
+        finally:
+            deadline.clear_deadline()
+        eq_(remaining, [None, None])
+
+
+@mock.patch('webpay.pay.postback.notify_failure')
+class TestGiveUp(TestCase):
+
+    def notice(self, **kw):
+        return postback.Notice('https://app/postback', TYPE_PAYMENT,
+                               'signed', 'some:uuid', mock.Mock(), [], **kw)
+
+    def test_notifies(self, notify_failure):
+        postback.give_up(self.notice(attempt=4))
+        notify_failure.assert_called_with('https://app/postback', 'some:uuid',
+                                          4)
+
+    def test_simulated(self, notify_failure):
+        postback.give_up(self.notice(simulated=SIMULATED_POSTBACK))
+        ok_(not notify_failure.called)
+
+
+class TestGetScheduler(TestCase):
+
+    @override_settings(POSTBACK_WORKERS=2, POSTBACK_OUTBOX={'enabled': False})
+    @mock.patch('webpay.pay.postback._scheduler', None)
+    @raises(ImproperlyConfigured)
+    def test_needs_outbox(self):
+        postback.get_scheduler()
+
+
+class TestHost(TestCase):
+
+    def test_host(self):
+        eq_(postback.host('https://App.com:8443/postback?x=1'),
+            'https://app.com:8443')
+
+    @override_settings(POSTBACK_HOST_CONCURRENCY=3)
+    def test_session(self):
+        session = postback.get_session('https://app.com/postback')
+        eq_(postback.get_session('https://app.com/chargeback'), session)
+        ok_(postback.get_session('https://other.com/postback') is not session)
+        adapter = session.get_adapter('https://app.com/postback')
+        eq_(adapter._pool_maxsize, 3)
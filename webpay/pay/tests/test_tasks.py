@@ -3,8 +3,10 @@ import urllib2
 from urllib import urlencode
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import RequestFactory
+from django.test.utils import override_settings
 
 import fudge
 from fudge.inspector import arg
@@ -390,7 +392,8 @@ class TestSimulatedNotifications(NotifyTest):
         assert post.called, 'notification was sent'
         assert retry.called, 'task should be retried after error'
         retry.assert_called_with(args=[self.payment_issuer, payload],
-                                 max_retries=ANY, eta=ANY, exc=ANY)
+                                 kwargs=ANY, max_retries=ANY, eta=ANY,
+                                 exc=ANY)
 
     @mock.patch('webpay.pay.utils.requests.post')
     @mock.patch('webpay.pay.utils.notify_failure')
@@ -1087,6 +1090,12 @@ class TestLocalizePayRequest(test_utils.TestCase):
         eq_(req['name'], 'British Virtual Sword')
         eq_(req['description'], 'A fancy sword')
 
+    def test_already_localized(self):
+        self.request.locale = 'en'
+        self.request.session['notes']['locale'] = 'en'
+        ok_(not tasks._localize_pay_request(self.request))
+        eq_(self._get_pay_request_details()['name'], 'Virtual Sword')
+
     def test_lang_and_unlocalized_region(self):
         self.request.locale = 'en-US'
         tasks._localize_pay_request(self.request)
@@ -1156,6 +1165,42 @@ class TestGetIconURL(test_utils.TestCase):
                                size='48', ext_size='48')
 
 
+@override_settings(ICON_CACHE={'timeout': 60, 'pending_timeout': 60})
+class TestIconCache(test_utils.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        p = mock.patch('lib.marketplace.api.client.api')
+        self.icon = p.start().webpay.product.icon
+        self.addCleanup(p.stop)
+        self.request = {'icons': {'64': 'http://app/icon.png'}}
+
+    def get_icon_url(self):
+        return tasks.get_icon_url(self.request)
+
+    def test_cached(self):
+        self.icon.get_object.return_value = {'url': 'http://mkt/icon.png'}
+        eq_(self.get_icon_url(), 'http://mkt/icon.png')
+        eq_(self.get_icon_url(), 'http://mkt/icon.png')
+        eq_(self.icon.get_object.call_count, 1)
+
+    def test_pending(self):
+        self.icon.get_object.side_effect = ObjectDoesNotExist()
+        eq_(self.get_icon_url(), None)
+        eq_(self.get_icon_url(), None)
+        eq_(self.icon.get_object.call_count, 1)
+        eq_(self.icon.post.call_count, 1)
+
+    def test_one_fetch(self):
+        self.icon.get_object.side_effect = ObjectDoesNotExist()
+        self.get_icon_url()
+        # Another worker missed at the same time.
+        with mock.patch('webpay.pay.tasks.cache.get') as get:
+            get.return_value = None
+            self.get_icon_url()
+        eq_(self.icon.post.call_count, 1)
+
+
 class TestConfigureTrans(TestCase):
 
     @mock.patch('lib.solitude.api.client.get_transaction')
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+import mock
+from mozpay.exc import InvalidJWT, RequestExpired
+from nose.tools import eq_, raises
+
+from webpay.base.utils import gmtime
+from webpay.pay.tokens import cache_verified, get_verified, ParsedJWT
+
+from . import Base
+
+
+class TestParsedJWT(Base):
+
+    def parse(self, **kw):
+        return ParsedJWT(self.request(**kw))
+
+    def test_payload(self):
+        parsed = self.parse()
+        eq_(parsed.issuer, settings.KEY)
+        eq_(parsed.payload['request']['pricePoint'], 1)
+
+    @raises(InvalidJWT)
+    def test_broken(self):
+        ParsedJWT('foo')
+
+    def test_verify(self):
+        parsed = self.parse()
+        eq_(parsed.verify(settings.DOMAIN, settings.SECRET),
+            parsed.payload)
+
+    @raises(InvalidJWT)
+    def test_wrong_secret(self):
+        self.parse().verify(settings.DOMAIN, 'not-the-secret')
+
+    @raises(InvalidJWT)
+    def test_wrong_audience(self):
+        self.parse().verify('some.other.domain', settings.SECRET)
+
+    @raises(RequestExpired)
+    def test_expired(self):
+        iat = gmtime() - 7200
+        self.parse(iat=iat, exp=iat + 3600).verify(settings.DOMAIN,
+                                                   settings.SECRET)
+
+    @raises(InvalidJWT)
+    def test_non_ascii(self):
+        ParsedJWT(self.request() + u'\u2603').verify_sig(settings.SECRET,
+                                                         settings.DOMAIN)
+
+    @raises(InvalidJWT)
+    def test_required_keys(self):
+        self.parse().verify(settings.DOMAIN, settings.SECRET,
+                            required_keys=('request.nope',))
+
+    def test_verified_once(self):
+        parsed = self.parse()
+        with mock.patch('webpay.pay.tokens._pyjwt._verify_signature') as sig:
+            parsed.verify_sig(settings.SECRET, settings.DOMAIN)
+            parsed.verify_sig(settings.SECRET, settings.DOMAIN)
+            eq_(sig.call_count, 1)
+            # A different secret must be checked again.
+            parsed.verify_sig('another-secret', settings.DOMAIN)
+            eq_(sig.call_count, 2)
+
+
+@override_settings(JWT_CACHE={'timeout': 60})
+class TestVerifiedCache(Base):
+
+    def setUp(self):
+        super(TestVerifiedCache, self).setUp()
+        cache.clear()
+
+    def test_cached(self):
+        parsed = ParsedJWT(self.request())
+        cache_verified('pay', parsed, parsed.payload, access=1)
+        cached = get_verified('pay', parsed.raw)
+        eq_(cached['payload'], parsed.payload)
+        eq_(cached['access'], 1)
+
+    def test_purpose(self):
+        parsed = ParsedJWT(self.request())
+        cache_verified('sig_check', parsed, parsed.payload)
+        eq_(get_verified('pay', parsed.raw), None)
+
+    def test_expired(self):
+        iat = gmtime() - 3600
+        parsed = ParsedJWT(self.request(iat=iat, exp=iat + 60))
+        cache_verified('pay', parsed, parsed.payload)
+        eq_(get_verified('pay', parsed.raw), None)
+
+    def test_disabled(self):
+        parsed = ParsedJWT(self.request())
+        with self.settings(JWT_CACHE={'timeout': 0}):
+            cache_verified('pay', parsed, parsed.payload)
+        eq_(get_verified('pay', parsed.raw), None)
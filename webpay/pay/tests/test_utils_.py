@@ -1,9 +1,15 @@
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.test.utils import override_settings
 
-from nose.tools import raises
+import mock
+from nose.tools import eq_, raises
 
+from lib.solitude.constants import TYPE_PAYMENT, TYPE_REFUND
 from webpay.base.tests import TestCase
-from webpay.pay.utils import verify_urls
+from webpay.pay.utils import (fresh_secret, get_issuer, invalidate_issuer,
+                              lookup_issuer, notice_attempt, NoticeRetry,
+                              record_attempt, UnknownIssuer, verify_urls)
 
 
 @override_settings(ALLOWED_CALLBACK_SCHEMES=['http', 'https'])
@@ -24,3 +30,111 @@ class TestVerifyURLs(TestCase):
     def test_https_only(self):
         with self.settings(ALLOWED_CALLBACK_SCHEMES=['https']):
             verify_urls('http://foo.com')
+
+
+@override_settings(ISSUER_CACHE={'timeout': 60, 'negative_timeout': 60,
+                                 'refresh': 60})
+class TestIssuerCache(TestCase):
+
+    def setUp(self):
+        super(TestIssuerCache, self).setUp()
+        cache.clear()
+        p = mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
+        self.get_active_product = p.start()
+        self.addCleanup(p.stop)
+        self.get_active_product.return_value = {
+            'secret': 'some-secret', 'access': 1, 'seller': '/seller/1/'}
+
+    def test_cached(self):
+        eq_(get_issuer('public-id'), {'secret': 'some-secret', 'access': 1})
+        eq_(get_issuer('public-id')['secret'], 'some-secret')
+        eq_(self.get_active_product.call_count, 1)
+
+    def test_lookup_issuer(self):
+        secret, product = lookup_issuer('public-id')
+        eq_(secret, 'some-secret')
+        eq_(product['access'], 1)
+
+    def test_unknown_cached(self):
+        self.get_active_product.side_effect = ObjectDoesNotExist
+        for x in range(2):
+            with self.assertRaises(UnknownIssuer):
+                get_issuer('junk')
+        eq_(self.get_active_product.call_count, 1)
+
+    def test_unsafe_key(self):
+        eq_(get_issuer(u'some junk \u2603 ' * 50)['secret'], 'some-secret')
+
+    def test_invalidate(self):
+        get_issuer('public-id')
+        invalidate_issuer('public-id')
+        get_issuer('public-id')
+        eq_(self.get_active_product.call_count, 2)
+
+    def test_fresh_secret(self):
+        get_issuer('public-id')
+        self.get_active_product.return_value = {'secret': 'new-secret'}
+        eq_(fresh_secret('public-id', 'some-secret'), 'new-secret')
+        eq_(get_issuer('public-id')['secret'], 'new-secret')
+
+    def test_fresh_secret_unchanged(self):
+        eq_(fresh_secret('public-id', 'some-secret'), None)
+
+    def test_fresh_secret_limited(self):
+        fresh_secret('public-id', 'some-secret')
+        fresh_secret('public-id', 'some-secret')
+        eq_(self.get_active_product.call_count, 1)
+
+    def test_disabled(self):
+        with self.settings(ISSUER_CACHE={'timeout': 0,
+                                         'negative_timeout': 0}):
+            get_issuer('public-id')
+            get_issuer('public-id')
+        eq_(self.get_active_product.call_count, 2)
+
+
+@override_settings(POSTBACK_RETRY={
+    'attempts': 4, 'base': 10, 'cap': 30, 'budget': 100,
+    'types': {'chargeback': {'attempts': 6}}})
+@mock.patch('webpay.pay.utils.time.time')
+@mock.patch('lib.retry.random.uniform')
+class TestNoticeRetry(TestCase):
+
+    def setUp(self):
+        self.policy = NoticeRetry(TYPE_PAYMENT)
+
+    def test_backoff(self, uniform, now):
+        uniform.side_effect = lambda low, high: high
+        now.return_value = 0
+        eq_([self.policy.next_delay(attempt, 0) for attempt in range(1, 5)],
+            [10, 20, 30, None])
+
+    def test_budget(self, uniform, now):
+        uniform.return_value = 30
+        now.return_value = 80
+        eq_(self.policy.next_delay(1, 0), None)
+        eq_(self.policy.next_delay(1, 70), 30)
+
+    def test_type(self, uniform, now):
+        eq_(self.policy.name, 'postback')
+        eq_(NoticeRetry(TYPE_REFUND).config()['attempts'], 6)
+        eq_(self.policy.config()['attempts'], 4)
+
+    def test_attempt(self, uniform, now):
+        now.return_value = 100
+        task = mock.Mock()
+        task.request.retries = 0
+        task.request.kwargs = {}
+        eq_(notice_attempt(task), (1, 100, None))
+        task.request.retries = 2
+        task.request.kwargs = {'notice_started': 10, 'notice_scheduled': 90}
+        eq_(notice_attempt(task), (3, 10, 90))
+
+    @mock.patch('webpay.pay.utils.statsd')
+    def test_record(self, statsd, uniform, now):
+        now.return_value = 100
+        record_attempt(self.policy, 3, scheduled=98)
+        statsd.incr.assert_called_with(
+            'purchase.send_pay_notice.postback.attempt.3')
+        statsd.timing.assert_called_with(
+            'purchase.send_pay_notice.postback.lag', 2000)
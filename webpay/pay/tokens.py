@@ -0,0 +1,131 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+import jwt
+from django_statsd.clients import statsd
+from mozpay.exc import InvalidJWT, RequestExpired
+from mozpay.verify import verify_claims, verify_keys
+
+from webpay.base.logger import getLogger
+from webpay.base.utils import gmtime
+
+log = getLogger('w.pay')
+
+# PyJWT 1.0 only offers decoding and verifying in one go. Use the two halves
+# so that a token is only decoded once.
+_pyjwt = jwt.PyJWT()
+
+
+class ParsedJWT(object):
+    """
+    A JWT that is decoded once, when it comes in, and then passed around.
+
+    This does the same checks as mozpay.verify.verify_jwt but the base64
+    and JSON decoding is only done once, however many times the payload is
+    looked at, and the signature is only checked once.
+
+    Raises InvalidJWT if the token can't be decoded.
+
+    :param raw: the JWT as sent by the client.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        token = raw
+        if isinstance(raw, unicode):
+            token = raw.encode('ascii', 'ignore')
+        # Non-ascii characters are dropped when decoding but the signature
+        # is never valid.
+        self.non_ascii = len(token) != len(raw)
+        self.verified_with = None
+        try:
+            (self.payload, self._signing_input,
+             self.header, self._signature) = _pyjwt._load(token)
+        except jwt.InvalidTokenError, exc:
+            raise InvalidJWT('Invalid JWT: {0}'.format(exc))
+
+    @property
+    def issuer(self):
+        return self.payload.get('iss')
+
+    def verify_sig(self, secret, audience, algorithms=None):
+        """
+        Verify the signature, audience and expiry of the JWT.
+
+        Returns the payload.
+        """
+        key = (secret, audience, tuple(algorithms or ()))
+        if self.verified_with == key:
+            return self.payload
+        if self.non_ascii:
+            raise InvalidJWT('Non-ascii payment JWT', issuer=self.issuer)
+        try:
+            _pyjwt._verify_signature(self.payload, self._signing_input,
+                                     self.header, self._signature,
+                                     key=secret, algorithms=algorithms,
+                                     audience=audience)
+        except jwt.ExpiredSignatureError, exc:
+            raise RequestExpired(str(exc), issuer=self.issuer)
+        except jwt.InvalidTokenError, exc:
+            raise InvalidJWT('Signature verification failed: {0}'
+                             .format(exc), issuer=self.issuer)
+        self.verified_with = key
+        return self.payload
+
+    def verify(self, audience, secret, algorithms=None, required_keys=()):
+        """
+        Verify the JWT like mozpay.verify.verify_jwt and return the payload.
+
+        Raises InvalidJWT or RequestExpired.
+        """
+        if not self.issuer:
+            raise InvalidJWT('Payment JWT is missing iss (issuer)')
+        self.verify_sig(secret, audience,
+                        algorithms=algorithms or ['HS256'])
+        verify_claims(self.payload, issuer=self.issuer)
+        verify_keys(self.payload, required_keys, issuer=self.issuer)
+        return self.payload
+
+
+def _verified_key(purpose, raw):
+    if isinstance(raw, unicode):
+        raw = raw.encode('utf8')
+    return 'jwt:{0}:{1}'.format(purpose, hashlib.sha256(raw).hexdigest())
+
+
+def get_verified(purpose, raw):
+    """
+    Returns what was cached by :func:`cache_verified` for a JWT, or None.
+
+    :param purpose: what the JWT was verified for, such as ``pay``. A JWT
+                    verified with fewer required keys for one purpose is not
+                    trusted for another.
+    :param raw: the JWT as sent by the client.
+    """
+    verified = cache.get(_verified_key(purpose, raw))
+    statsd.incr('pay.jwt_cache.{0}.{1}'.format(
+        purpose, 'miss' if verified is None else 'hit'))
+    return verified
+
+
+def cache_verified(purpose, parsed, payload, **meta):
+    """
+    Remember that a JWT was verified, until it expires.
+
+    :param parsed: the verified ParsedJWT.
+    :param payload: the verified payload.
+    :param meta: anything else to return with the payload, such as the
+                 access flag of the issuer.
+
+    See settings.JWT_CACHE.
+    """
+    timeout = settings.JWT_CACHE['timeout']
+    exp = payload.get('exp')
+    if isinstance(exp, (int, long, float)):
+        timeout = min(timeout, int(exp - gmtime()))
+    # A timeout of 0 means don't cache, not the cache default.
+    if timeout > 0:
+        meta['payload'] = payload
+        cache.set(_verified_key(purpose, parsed.raw), meta, timeout)
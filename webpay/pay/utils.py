@@ -1,11 +1,14 @@
 from datetime import datetime, timedelta
+import hashlib
 import logging
+import time
 from urllib2 import HTTPError
 from urlparse import urlparse
 import uuid
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 
 from celery.exceptions import RetryTaskError
@@ -14,8 +17,11 @@ import requests
 from requests.exceptions import ConnectionError, RequestException
 
 from lib.marketplace.api import client
+from lib.retry import RetryPolicy
+from lib.solitude import constants
 from lib.solitude.api import client as solitude
 
+from . import outbox
 from .constants import NOT_SIMULATED
 
 log = logging.getLogger('w.pay.utils')
@@ -58,33 +64,29 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
         String to indicate the last exception message in the case of failure.
     """
     log.info('about to notify %s of notice type %s' % (url, notice_type))
+    policy = NoticeRetry(notice_type)
+    attempt, started, scheduled = notice_attempt(notifier_task)
+    record_attempt(policy, attempt, scheduled)
+    outbox.write(trans_id, policy.name, url, signed_notice, simulated,
+                 attempt)
     exception = None
     success = False
     try:
-        with statsd.timer('purchase.send_pay_notice'):
-            res = requests.post(url, {'notice': signed_notice}, timeout=5)
-        res.raise_for_status()  # raise exception for non-200s
-        res_content = res.text.strip()
-
-        # Raise an exception if the content didn't match.
-        if res_content != str(trans_id):
-            response_hint = res_content[:len(trans_id) * 2]
-            log.error('URL {u} did not respond with transaction {t} '
-                      'for notification; response: {r}'
-                      .format(u=url, t=trans_id, r=repr(response_hint)))
-            raise ValueError('Incorrect notification response '
-                             'from: {0}'.format(url))
-
-    except (ConnectionError, HTTPError,
-            RequestException, ValueError), exception:
+        post_notice(url, signed_notice, trans_id)
+    except NOTICE_ERRORS, exception:
         log.error('Notice for transaction %s raised exception in URL %s'
                   % (trans_id, url), exc_info=True)
+        outbox.sent(trans_id, policy.name, False,
+                    format_exception(exception))
+        delay = policy.next_delay(attempt, started)
         try:
+            if delay is None:
+                raise exception
             notifier_task.retry(
                 args=task_args,
-                eta=(datetime.now() +
-                     timedelta(seconds=settings.POSTBACK_DELAY)),
-                max_retries=settings.POSTBACK_ATTEMPTS,
+                kwargs=retry_kwargs(started, delay),
+                eta=datetime.now() + timedelta(seconds=delay),
+                max_retries=attempt,
                 exc=exception)
 
         # Retry actually raises an exception, so let that through.
@@ -92,10 +94,10 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
             statsd.incr('purchase.send_pay_notice.retry')
             raise
 
-        # If it's the last retry it will re-throw the original exception.
+        # Out of attempts, or the retry could not be sent.
         except Exception, final_exception:
             if simulated == NOT_SIMULATED:
-                notify_failure(url, trans_id)
+                notify_failure(url, trans_id, attempt)
             else:
                 # TODO(Kumar): Fix the API for this in bug 847537
                 log.info('Not notifying anyone about simulated failure '
@@ -104,6 +106,7 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
 
     else:
         success = True
+        outbox.sent(trans_id, policy.name, True)
         log.debug('URL %s responded OK for transaction %s '
                   'notification' % (url, trans_id))
 
@@ -115,10 +118,113 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
     return success, last_error
 
 
-def notify_failure(url, trans_id):
+# The ways that sending a notice can fail.
+NOTICE_ERRORS = (ConnectionError, HTTPError, RequestException, ValueError)
+
+# The names of the types of notice, for settings.POSTBACK_RETRY and statsd.
+NOTICE_NAMES = {
+    constants.TYPE_PAYMENT: 'postback',
+    constants.TYPE_REFUND: 'chargeback',
+}
+
+
+class NoticeRetry(RetryPolicy):
+    """
+    The retry schedule of one type of notice, see
+    ``settings.POSTBACK_RETRY``.
+
+    A failed notice is retried by sending its notify task again after
+    :meth:`next_delay` seconds. The task is given the time of the first
+    attempt and the time it was scheduled for in its keyword arguments.
+    """
+    setting = 'POSTBACK_RETRY'
+
+    def __init__(self, notice_type=None, name=None):
+        super(NoticeRetry, self).__init__(
+            name or NOTICE_NAMES.get(notice_type, 'postback'))
+
+    def config(self):
+        config = super(NoticeRetry, self).config()
+        config.update(config.pop('types', {}).get(self.name, {}))
+        return config
+
+    def next_delay(self, attempt, started):
+        """
+        Returns the seconds to wait before retrying a notice after attempt
+        number `attempt` failed, or None if it should not be retried.
+
+        :param started: the time of the first attempt.
+        """
+        config = self.config()
+        if attempt >= config['attempts']:
+            return None
+        delay = self.backoff(attempt, config)
+        if time.time() - started + delay > config['budget']:
+            return None
+        return delay
+
+
+def notice_attempt(notifier_task):
+    """
+    Returns the attempt number of the notice the task is sending, the time
+    of its first attempt and the time it was scheduled for. The last is None
+    for the first attempt.
+    """
+    kwargs = notifier_task.request.kwargs or {}
+    return (notifier_task.request.retries + 1,
+            kwargs.get('notice_started') or time.time(),
+            kwargs.get('notice_scheduled'))
+
+
+def retry_kwargs(started, delay):
+    """
+    Returns the keyword arguments for the notify task that retries a
+    notice in `delay` seconds, see :func:`notice_attempt`.
+    """
+    return {'notice_started': started,
+            'notice_scheduled': time.time() + delay}
+
+
+def record_attempt(policy, attempt, scheduled=None):
+    """
+    Send the attempt number of a notice, and how late it is, to statsd.
+    """
+    stat = 'purchase.send_pay_notice.{0}'.format(policy.name)
+    statsd.incr('{0}.attempt.{1}'.format(stat, attempt))
+    if scheduled:
+        statsd.timing('{0}.lag'.format(stat),
+                      max(int((time.time() - scheduled) * 1000), 0))
+
+
+def post_notice(url, signed_notice, trans_id, session=None):
+    """
+    POST a signed notice to an app server.
+
+    :param session: the requests session to post with, if any.
+
+    Raises one of NOTICE_ERRORS if it fails or if the app does not respond
+    with the transaction ID.
+    """
+    with statsd.timer('purchase.send_pay_notice'):
+        res = (session or requests).post(url, {'notice': signed_notice},
+                                         timeout=5)
+    res.raise_for_status()  # raise exception for non-200s
+    res_content = res.text.strip()
+
+    # Raise an exception if the content didn't match.
+    if res_content != str(trans_id):
+        response_hint = res_content[:len(trans_id) * 2]
+        log.error('URL {u} did not respond with transaction {t} '
+                  'for notification; response: {r}'
+                  .format(u=url, t=trans_id, r=repr(response_hint)))
+        raise ValueError('Incorrect notification response '
+                         'from: {0}'.format(url))
+
+
+def notify_failure(url, trans_id, attempts):
     statsd.incr('purchase.send_pay_notice.failure')
     client.api.webpay.failure(trans_id).patch({
-        'attempts': settings.POSTBACK_ATTEMPTS,
+        'attempts': attempts,
         'url': url})
     log.exception('Retries failed to %s: %s:' % (url, trans_id))
 
@@ -139,6 +245,52 @@ def verify_urls(*urls, **kw):
                              (settings.ALLOWED_CALLBACK_SCHEMES, url))
 
 
+def prune_locales(pay_req, locale):
+    """
+    Drop the localizations in a pay request that won't be used.
+
+    Only those for the locale, its language and the default locale are
+    kept. This stops the size of the session, the celery task arguments
+    and the transaction notes depending on how many locales an app has.
+    """
+    req = pay_req['request']
+    if not req.get('locales'):
+        return
+    keep = (locale, locale.split('-')[0], req.get('defaultLocale'))
+    req['locales'] = dict((slug, loc) for slug, loc in req['locales'].items()
+                          if slug in keep)
+
+
+def localize_pay_request(pay_req, locale, trans_id=None):
+    """
+    Use the name and description for the locale, or its language, in a pay
+    request.
+
+    Returns True if a localization was found.
+    """
+    req = pay_req['request']
+    locales = req.get('locales')
+    if not locales:
+        return False
+
+    fallback = locale.split('-')[0]
+    if locale in locales:
+        loc = locales[locale]
+    elif fallback in locales:
+        log.info('Fell back from {0} to {1} (iss: {2}, trans_id: {3})'
+                 .format(locale, fallback, pay_req.get('iss'), trans_id))
+        loc = locales[fallback]
+    else:
+        log.info(('No localization found for {0} (iss: {1}, '
+                  'trans_id: {2})').format(locale, pay_req.get('iss'),
+                                           trans_id))
+        return False
+
+    req['name'] = loc.get('name') or req['name']
+    req['description'] = loc.get('description') or req['description']
+    return True
+
+
 def trans_id():
     """
     Generate a unique transaction ID.
@@ -159,21 +311,100 @@ def lookup_issuer(issuer):
     """
     Lookup a JWT issuer and return the secret and associated product object.
 
-    Returns a tuple of (issuer_secret, product_object)
+    Returns a tuple of (issuer_secret, product_object). For in-app issuers
+    the product object is the cached dict from :func:`get_issuer`.
     """
     if issuer == settings.KEY:
         # This is a Marketplace app purchase because it matches the settings.
         active_product = None
         secret = settings.SECRET
     else:
+        # Assuming that the issuer is also going to be the public_id.
+        active_product = get_issuer(issuer)
+        secret = active_product['secret']
+
+    return secret, active_product
+
+
+def _issuer_cache_key(public_id):
+    # The public_id comes straight from unverified JWTs so it could be
+    # anything. Hash it to get a key that is always safe for memcache.
+    if isinstance(public_id, unicode):
+        public_id = public_id.encode('utf8')
+    return 'issuer:{0}'.format(hashlib.md5(public_id).hexdigest())
+
+
+def get_issuer(public_id):
+    """
+    Returns a dict of the secret and access flag for an in-app issuer.
+
+    Issuers are cached by public_id for the web heads and celery workers,
+    see settings.ISSUER_CACHE. Unknown issuers are cached too so that junk
+    JWTs don't each cost a Solitude lookup.
+
+    Raises UnknownIssuer if there is no active product for the public_id.
+    """
+    key = _issuer_cache_key(public_id)
+    issuer = cache.get(key)
+    if issuer is None:
+        statsd.incr('pay.issuer_cache.miss')
         try:
-            # Assuming that the issuer is also going to be the public_id.
-            active_product = solitude.get_active_product(issuer)
+            product = solitude.get_active_product(public_id)
         except ObjectDoesNotExist, err:
             log.info('get_active_product({0}) '
-                     'raised {1.__class__.__name__}: {1}'.format(issuer, err))
+                     'raised {1.__class__.__name__}: {1}'
+                     .format(public_id, err))
+            _cache_issuer(key, {}, settings.ISSUER_CACHE['negative_timeout'])
             raise UnknownIssuer('{0.__class__.__name__}: {0}'.format(err))
+        issuer = {'secret': product['secret'],
+                  'access': product.get('access')}
+        _cache_issuer(key, issuer, settings.ISSUER_CACHE['timeout'])
+    else:
+        statsd.incr('pay.issuer_cache.hit')
 
-        secret = active_product['secret']
+    if not issuer:
+        raise UnknownIssuer('Issuer {0!r} is not known (cached)'
+                            .format(public_id))
+    return issuer
 
-    return secret, active_product
+
+def _cache_issuer(key, issuer, timeout):
+    # A timeout of 0 means don't cache, not the cache default.
+    if timeout:
+        cache.set(key, issuer, timeout)
+
+
+def invalidate_issuer(public_id):
+    """
+    Forget a cached issuer, for example after its secret was changed or
+    its product was activated.
+    """
+    cache.delete(_issuer_cache_key(public_id))
+
+
+def fresh_secret(issuer, secret):
+    """
+    Look an in-app issuer up again after a JWT it signed with `secret`
+    failed verification, in case its secret was changed since it was
+    cached. Returns the new secret, or None if it has not changed.
+
+    An issuer is looked up again at most once every
+    ``settings.ISSUER_CACHE['refresh']`` seconds, so that bad JWTs don't
+    each cost a Solitude lookup.
+    """
+    if not issuer or issuer == settings.KEY:
+        return None
+    timeout = settings.ISSUER_CACHE.get('refresh')
+    if timeout and not cache.add(_issuer_cache_key(issuer) + ':refresh',
+                                 True, timeout):
+        return None
+    invalidate_issuer(issuer)
+    try:
+        new = get_issuer(issuer)['secret']
+    except UnknownIssuer:
+        return None
+    if new == secret:
+        return None
+    log.info('the secret of issuer {0!r} has changed'.format(issuer))
+    statsd.incr('pay.issuer_cache.changed')
+    return new
@@ -5,7 +5,6 @@ from django.conf import settings
 from django.views.decorators.http import require_POST
 
 from mozpay.exc import InvalidJWT, RequestExpired
-from mozpay.verify import verify_jwt
 from tower import ugettext as _
 
 from webpay.base import dev_messages as msg
@@ -17,7 +16,10 @@ from lib.marketplace.api import client as marketplace, UnknownPricePoint
 
 from . import tasks
 from .forms import VerifyForm, NetCodeForm
-from .utils import trans_id, verify_urls
+from .notes import delay, get_notes, notes_ref, NotesMissing, set_notes
+from .tokens import cache_verified
+from .utils import (fresh_secret, localize_pay_request, prune_locales,
+                    trans_id, verify_urls)
 
 log = getLogger('w.pay')
 
@@ -42,28 +44,32 @@ def process_pay_req(request, data=None):
                             code=msg.PAY_DISABLED, status=503)
 
     exc = er = None
-    try:
-        pay_req = verify_jwt(
-            form.cleaned_data['req'],
-            settings.DOMAIN,  # JWT audience.
-            form.secret,
-            algorithms=settings.SUPPORTED_JWT_ALGORITHMS,
-            required_keys=('request.id',
-                           'request.pricePoint',  # A price tier we'll look up.
-                           'request.name',
-                           'request.description',
-                           'request.postbackURL',
-                           'request.chargebackURL'))
-    except RequestExpired, exc:
-        log.debug('exception in mozpay.verify_jwt(): {e}'.format(e=exc))
-        er = msg.EXPIRED_JWT
-    except InvalidJWT, exc:
-        log.debug('exception in mozpay.verify_jwt(): {e}'.format(e=exc))
-        er = msg.INVALID_JWT
-
-    if exc:
-        log.exception('calling verify_jwt')
-        return app_error(request, code=er)
+    pay_req = form.verified
+    if not pay_req:
+        try:
+            try:
+                pay_req = _verify(form)
+            except RequestExpired:
+                raise
+            except InvalidJWT:
+                # The JWT may be signed with a secret that was changed since
+                # the issuer was cached.
+                secret = fresh_secret(form.key, form.secret)
+                if secret is None:
+                    raise
+                form.secret = secret
+                pay_req = _verify(form)
+        except RequestExpired, exc:
+            log.debug('exception verifying JWT: {e}'.format(e=exc))
+            er = msg.EXPIRED_JWT
+        except InvalidJWT, exc:
+            log.debug('exception verifying JWT: {e}'.format(e=exc))
+            er = msg.INVALID_JWT
+
+        if exc:
+            log.exception('verifying JWT')
+            return app_error(request, code=er)
+        cache_verified('pay', form.parsed, pay_req, access=form.access)
 
     icon_urls = []
     if pay_req['request'].get('icons'):
@@ -87,6 +93,11 @@ def process_pay_req(request, data=None):
         log.exception('UnknownPricePoint calling get price_price()')
         return app_error(request, code=msg.BAD_PRICE_POINT)
 
+    # Only keep the localizations that could be used and localize once,
+    # now, rather than storing every locale of the app.
+    locale = getattr(request, 'locale', settings.LANGUAGE_CODE)
+    prune_locales(pay_req, locale)
+    localize_pay_request(pay_req, locale)
     _trim_pay_request(pay_req)
 
     # All validation passed, save state to the session.
@@ -94,14 +105,16 @@ def process_pay_req(request, data=None):
     # This is an ephemeral session value, do not rely on it.
     # It gets saved to the solitude transaction so you can access it there.
     # Otherwise it is used for simulations and fake payments.
-    notes = request.session.get('notes', {})
+    notes = get_notes(request, required=False)
     notes['pay_request'] = pay_req
     # The issuer key points to the app that issued the payment request.
     notes['issuer_key'] = form.key
-    request.session['notes'] = notes
+    # The locale the pay request was localized for.
+    notes['locale'] = locale
     tx = trans_id()
     log.info('Generated new transaction ID: {tx}'.format(tx=tx))
     request.session['trans_id'] = tx
+    set_notes(request, notes, ref=tx)
 
 
 @require_POST
@@ -138,7 +151,10 @@ def configure_transaction(request, data=None):
                     .format(mcc=mcc, mnc=mnc))
 
     is_simulation = request.session.get('is_simulation', False)
-    pay_req = request.session.get('notes', {}).get('pay_request')
+    try:
+        pay_req = get_notes(request).get('pay_request')
+    except NotesMissing:
+        return system_error(request, code=msg.TRANS_EXPIRED)
     payment_required = (
         pay_req['request']['pricePoint'] != '0' if pay_req else True)
 
@@ -156,7 +172,9 @@ def configure_transaction(request, data=None):
         log.info('Notifying for free in-app trans_id={t}; with '
                  'solitude_buyer_uuid={u}'.format(
                      t=request.session['trans_id'], u=solitude_buyer_uuid))
-        tasks.free_notify.delay(request.session['notes'], solitude_buyer_uuid)
+        delay(tasks.free_notify,
+              notes_ref(get_notes(request), request.session['trans_id']),
+              solitude_buyer_uuid)
 
     sim = pay_req['request']['simulate'] if is_simulation else None
     client_trans_id = 'client-trans:{u}'.format(u=uuid.uuid4())
@@ -168,6 +186,19 @@ def configure_transaction(request, data=None):
             'payment_required': payment_required}
 
 
+def _verify(form):
+    return form.parsed.verify(
+        settings.DOMAIN,  # JWT audience.
+        form.secret,
+        algorithms=settings.SUPPORTED_JWT_ALGORITHMS,
+        required_keys=('request.id',
+                       'request.pricePoint',  # A price tier.
+                       'request.name',
+                       'request.description',
+                       'request.postbackURL',
+                       'request.chargebackURL'))
+
+
 def _trim_pay_request(req):
 
     def _trim(st):
@@ -1,50 +1,112 @@
+from collections import defaultdict
+
 from django import forms
 from django.conf import settings
 
-import jwt
 from django_paranoia.forms import ParanoidForm
 
 from mozpay.exc import InvalidJWT
-from mozpay.verify import verify_jwt
 from webpay.base.logger import getLogger
-from webpay.pay.utils import lookup_issuer, UnknownIssuer
+from webpay.pay.tokens import cache_verified, get_verified, ParsedJWT
+from webpay.pay.utils import fresh_secret, lookup_issuer, UnknownIssuer
 
 log = getLogger('w.services')
 
 
+INVALID = 'INVALID_JWT_OR_UNKNOWN_ISSUER'
+
+
+def _invalid(exc):
+    log.info('caught sig_check exc: {0.__class__.__name__}: {0}'.format(exc))
+    return forms.ValidationError(INVALID)
+
+
+def _parse(enc_jwt):
+    try:
+        return ParsedJWT(enc_jwt)
+    except InvalidJWT, exc:
+        raise _invalid(exc)
+
+
+def _verify(parsed, secret):
+    try:
+        try:
+            clean_jwt = parsed.verify(settings.DOMAIN,  # JWT audience.
+                                      secret,
+                                      required_keys=[])
+        except InvalidJWT:
+            # The JWT may be signed with a secret that was changed since the
+            # issuer was cached.
+            secret = fresh_secret(parsed.issuer, secret)
+            if secret is None:
+                raise
+            clean_jwt = parsed.verify(settings.DOMAIN, secret,
+                                      required_keys=[])
+    except InvalidJWT, exc:
+        raise _invalid(exc)
+    cache_verified('sig_check', parsed, clean_jwt)
+    return clean_jwt
+
+
+def _check_typ(clean_jwt):
+    if clean_jwt.get('typ', '') != settings.SIG_CHECK_TYP:
+        raise forms.ValidationError('INCORRECT_JWT_TYP')
+    return clean_jwt
+
+
 class SigCheckForm(ParanoidForm):
     sig_check_jwt = forms.CharField()
 
     def clean_sig_check_jwt(self):
         enc_jwt = self.cleaned_data['sig_check_jwt'].encode('ascii', 'ignore')
-        try:
-            jwt_data = jwt.decode(enc_jwt, verify=False)
-        except jwt.DecodeError, exc:
-            log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
-                     .format(exc))
-            raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
+        cached = get_verified('sig_check', enc_jwt)
+        if cached:
+            return _check_typ(cached['payload'])
 
+        parsed = _parse(enc_jwt)
         try:
-            secret, active_product = lookup_issuer(jwt_data.get('iss', ''))
+            secret, active_product = lookup_issuer(parsed.issuer or '')
         except UnknownIssuer, exc:
-            log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
-                     .format(exc))
-            raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
+            raise _invalid(exc)
+        return _check_typ(_verify(parsed, secret))
+
+
+def check_sig_batch(jwts):
+    """
+    Check the signatures of many sig_check JWTs at once.
 
+    The JWTs are grouped by issuer so that each issuer is looked up once.
+    Returns a list of the validation error codes of each JWT, in order. The
+    list for a good JWT is empty.
+    """
+    errors = [[] for enc_jwt in jwts]
+    by_issuer = defaultdict(list)
+    for i, enc_jwt in enumerate(jwts):
+        enc_jwt = enc_jwt.encode('ascii', 'ignore')
         try:
-            clean_jwt = verify_jwt(enc_jwt,
-                                   settings.DOMAIN,  # JWT audience.
-                                   secret,
-                                   required_keys=[])
-        except InvalidJWT, exc:
-            log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
-                     .format(exc))
-            raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
-
-        if clean_jwt.get('typ', '') != settings.SIG_CHECK_TYP:
-            raise forms.ValidationError('INCORRECT_JWT_TYP')
-
-        return clean_jwt
+            cached = get_verified('sig_check', enc_jwt)
+            if cached:
+                _check_typ(cached['payload'])
+            else:
+                parsed = _parse(enc_jwt)
+                by_issuer[parsed.issuer or ''].append((i, parsed))
+        except forms.ValidationError, exc:
+            errors[i] = exc.messages
+
+    for issuer, parsed_jwts in by_issuer.items():
+        try:
+            secret, active_product = lookup_issuer(issuer)
+        except UnknownIssuer, exc:
+            for i, parsed in parsed_jwts:
+                errors[i] = _invalid(exc).messages
+            continue
+        for i, parsed in parsed_jwts:
+            try:
+                _check_typ(_verify(parsed, secret))
+            except forms.ValidationError, exc:
+                errors[i] = exc.messages
+
+    return errors
 
 
 class ErrorLegendForm(ParanoidForm):
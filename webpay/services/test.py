@@ -1,6 +1,7 @@
 import json
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse
 from django.test import TestCase
@@ -8,8 +9,9 @@ from django.test import TestCase
 import jwt
 import mock
 from curling.lib import HttpClientError
-from nose.tools import eq_, raises
+from nose.tools import eq_, ok_, raises
 
+from lib.circuit import CircuitOpen
 from lib.marketplace.api import client as marketplace
 from lib.solitude.api import client as solitude
 from webpay.base.dev_messages import BAD_ICON_KEY
@@ -51,9 +53,18 @@ class TestMonitor(TestCase):
                                                          {'webpay': True}}
         res = self.client.get(self.url)
         eq_(res.status_code, 200)
+        ok_('circuits' in json.loads(res.content))
 
+    def test_circuit_open(self, sol, mkt):
+        sol.services.request.get.side_effect = CircuitOpen('open')
+        mkt.account.permissions.mine.get.return_value = {'permissions':
+                                                         {'webpay': True}}
+        res = self.client.get(self.url)
+        eq_(res.status_code, 500)
+        eq_(json.loads(res.content)['solitude'], 'open')
 
-class TestSigCheck(TestCase):
+
+class SigCheckTester(TestCase):
 
     def patch_issuer(self):
         p = mock.patch('lib.solitude.api.client.get_active_product')
@@ -78,6 +89,9 @@ class TestSigCheck(TestCase):
         }
         return jwt.encode(req, secret)
 
+
+class TestSigCheck(SigCheckTester):
+
     def test_good_mkt_check(self):
         key = 'marketplace'
         secret = 'anything'
@@ -141,6 +155,15 @@ class TestSigCheck(TestCase):
         eq_(data['errors'],
             {'sig_check_jwt': ['INVALID_JWT_OR_UNKNOWN_ISSUER']})
 
+    def test_changed_issuer_secret(self):
+        getter = self.patch_issuer()
+        getter.side_effect = [{'secret': 'old'}, {'secret': 'new'}]
+        res = self.client.post(
+            reverse('services.sig_check'),
+            {'sig_check_jwt': self.jwt(issuer='some-app', secret='new')})
+        eq_(res.status_code, 200)
+        eq_(json.loads(res.content)['result'], 'ok')
+
     def test_bad_jwt_typ(self):
         self.patch_issuer()
         res = self.client.post(
@@ -151,11 +174,66 @@ class TestSigCheck(TestCase):
         eq_(data['result'], 'error')
         eq_(data['errors'], {'sig_check_jwt': ['INCORRECT_JWT_TYP']})
 
+    @mock.patch('webpay.pay.tokens.ParsedJWT.verify')
+    def test_verified_cached(self, verify):
+        cache.clear()
+        token = self.jwt()
+        verify.return_value = jwt.decode(token, verify=False)
+        with self.settings(JWT_CACHE={'timeout': 60}):
+            for x in range(2):
+                res = self.client.post(reverse('services.sig_check'),
+                                       {'sig_check_jwt': token})
+                eq_(res.status_code, 200)
+        eq_(verify.call_count, 1)
+
     def test_require_post(self):
         res = self.client.get(reverse('services.sig_check'))
         eq_(res.status_code, 405)
 
 
+class TestSigCheckBatch(SigCheckTester):
+
+    def post(self, jwts):
+        res = self.client.post(reverse('services.sig_check_batch'),
+                               {'sig_check_jwt': jwts})
+        return res, json.loads(res.content)
+
+    def test_batch(self):
+        getter = self.patch_issuer()
+        getter.return_value = {'secret': 'app-secret', 'access': 1}
+        res, data = self.post([
+            self.jwt(issuer='some-app', secret='app-secret'),
+            self.jwt(issuer='some-app', secret='wrong-secret'),
+            self.jwt(typ='not a real typ'),
+            'not-a-jwt',
+            self.jwt(issuer='some-app', secret='app-secret'),
+        ])
+        eq_(res.status_code, 200)
+        eq_(data['result'], 'ok')
+        eq_([r['errors'].get('sig_check_jwt') for r in data['results']],
+            [None, ['INVALID_JWT_OR_UNKNOWN_ISSUER'], ['INCORRECT_JWT_TYP'],
+             ['INVALID_JWT_OR_UNKNOWN_ISSUER'], None])
+        # The issuer was looked up once, and once again in case its secret
+        # had changed when a JWT failed.
+        eq_(getter.call_count, 2)
+
+    def test_unknown_issuer(self):
+        self.patch_issuer().side_effect = UnknownIssuer
+        res, data = self.post([self.jwt(issuer='non-existant')] * 2)
+        eq_([r['result'] for r in data['results']], ['error', 'error'])
+
+    def test_empty(self):
+        res, data = self.post([])
+        eq_(res.status_code, 400)
+        eq_(data['result'], 'error')
+
+    def test_too_many(self):
+        with self.settings(SIG_CHECK_BATCH_SIZE=1):
+            res, data = self.post([self.jwt(), self.jwt()])
+        eq_(res.status_code, 400)
+        eq_(data['errors'], {'sig_check_jwt': ['TOO_MANY_JWTS']})
+
+
 @mock.patch('webpay.base.utils._log_cef')
 class TestCSP(TestCase):
 
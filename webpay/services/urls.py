@@ -6,6 +6,8 @@ urlpatterns = patterns(
     '',
     url(r'^monitor$', views.monitor, name='monitor'),
     url(r'^sig_check$', views.sig_check, name='services.sig_check'),
+    url(r'^sig_check/batch$', views.sig_check_batch,
+        name='services.sig_check_batch'),
     url(r'^csp/report$', views.csp_report, name='csp.report'),
     url(r'^error_legend$', views.error_legend, name='services.error_legend'),
     url(r'^exception/', views.APIException.as_view({'get': 'retrieve'}),
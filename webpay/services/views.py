@@ -1,6 +1,7 @@
 import json
 
 from django import http
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.utils import translation
@@ -8,6 +9,7 @@ from django.utils import translation
 from curling.lib import HttpClientError, HttpServerError
 from rest_framework import viewsets
 
+from lib import circuit
 from lib.marketplace.api import client as marketplace
 from lib.solitude.api import client as solitude
 from webpay.base.decorators import json_view
@@ -15,7 +17,7 @@ from webpay.base.dev_messages import legend
 from webpay.base.logger import getLogger
 from webpay.base.utils import log_cef_meta
 
-from .forms import ErrorLegendForm, SigCheckForm
+from .forms import check_sig_batch, ErrorLegendForm, SigCheckForm
 
 log = getLogger('z.services')
 
@@ -34,6 +36,9 @@ def monitor(request):
             err.response.status_code,
             err.response.content or 'empty')
             if err.response else 'Server error: no response')
+    except circuit.CircuitOpen, err:
+        all_good = False
+        msg = str(err)
     else:
         if not perms['permissions'].get('webpay', False):
             all_good = False
@@ -49,12 +54,18 @@ def monitor(request):
         all_good = False
         msg = ('Server error: status %s, content: %s' %
                (err.response.status_code, err.response.content or 'empty'))
+    except circuit.CircuitOpen, err:
+        all_good = False
+        msg = str(err)
     else:
         if not users['authenticated'] == 'webpay':
             all_good = False
             msg = 'Not the webpay user, got: %s' % users['authenticated']
 
     content['solitude'] = msg
+
+    # Report the upstream circuits that this process knows about.
+    content['circuits'] = circuit.states()
     return http.HttpResponse(content=json.dumps(content),
                              content_type='application/json',
                              status=200 if all_good else 500)
@@ -75,6 +86,32 @@ def sig_check(request):
                              status=200 if res['result'] == 'ok' else 400)
 
 
+@require_POST
+@csrf_exempt
+def sig_check_batch(request):
+    """
+    Like sig_check but for many JWTs, each posted as a sig_check_jwt.
+
+    The results are in the same order as the JWTs.
+    """
+    jwts = request.POST.getlist('sig_check_jwt')
+    res = {'result': 'ok', 'errors': {}, 'results': []}
+    if not jwts:
+        res['errors'] = {'sig_check_jwt': ['This field is required.']}
+    elif len(jwts) > settings.SIG_CHECK_BATCH_SIZE:
+        res['errors'] = {'sig_check_jwt': ['TOO_MANY_JWTS']}
+    else:
+        for errors in check_sig_batch(jwts):
+            res['results'].append({
+                'result': 'error' if errors else 'ok',
+                'errors': {'sig_check_jwt': errors} if errors else {}})
+    if res['errors']:
+        res['result'] = 'error'
+    return http.HttpResponse(content=json.dumps(res),
+                             content_type='application/json',
+                             status=200 if res['result'] == 'ok' else 400)
+
+
 @csrf_exempt
 @require_POST
 def csp_report(request):
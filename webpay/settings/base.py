@@ -134,6 +134,8 @@ MIDDLEWARE_CLASSES = (
     'webpay.base.middleware.CSPMiddleware',
     'django_statsd.middleware.GraphiteRequestTimingMiddleware',
     'django_statsd.middleware.GraphiteMiddleware',
+    'webpay.base.middleware.OutboundTimingMiddleware',
+    'webpay.base.middleware.DeadlineMiddleware',
     'webpay.base.middleware.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -141,6 +143,7 @@ MIDDLEWARE_CLASSES = (
     'session_csrf.CsrfMiddleware',  # Must be after auth middleware.
     'django.contrib.messages.middleware.MessageMiddleware',
     'commonware.middleware.FrameOptionsHeader',
+    'webpay.base.middleware.CircuitOpenMiddleware',
     'webpay.base.middleware.LogJSONerror',
     'webpay.base.middleware.CEFMiddleware',
     'django_paranoia.middleware.Middleware',
@@ -152,7 +155,9 @@ ROOT_URLCONF = 'webpay.urls'
 
 SECRET_KEY = 'please change this'
 
-SESSION_ENGINE = 'encrypted_cookies'
+# Encrypted cookie sessions that are only re-encrypted when they change. Use
+# ./manage.py bench_session to compare it with plain encrypted_cookies.
+SESSION_ENGINE = 'webpay.base.session'
 
 # Custom name of session cookie.
 # This must be a non-default so it doesn't collide with zamboni on the same
@@ -169,6 +174,20 @@ SESSION_COOKIE_AGE = 60 * 60
 
 SESSION_COOKIE_SECURE = False
 
+# Keep the notes about a transaction, such as the verified pay request, in
+# the cache instead of the session cookie. The cookie then only holds a
+# reference to them, which keeps it small. The cache must be shared by all
+# the web heads.
+PAY_NOTES_STORE = {
+    'enabled': False,
+    # Seconds to keep the notes, no less than the session.
+    'timeout': SESSION_COOKIE_AGE,
+    # Seconds to keep the copy of the notes given to a celery task. This
+    # must cover the time a task can wait in the queue and be retried for,
+    # see POSTBACK_RETRY.
+    'task_timeout': 2 * 24 * 3600,
+}
+
 # Needed to serve the media out for development servers.
 TEMPLATE_DEBUG = DEBUG
 
@@ -225,6 +244,22 @@ APP_PURCHASE_SECRET = SECRET = 'please change this'
 # We won't be persisting users in the DB.
 BROWSERID_CREATE_USER = False
 
+# Caching of solitude buyers. Buyers are read on login, on every PIN screen
+# and on every PIN check so they are kept in memcache and, for a shorter
+# time, in each process. Any change made through webpay clears the cache.
+BUYER_CACHE = {
+    # Seconds a buyer is served from memcache. 0 disables memcache caching.
+    'timeout': 30,
+    # Seconds a buyer is served from process memory. 0 disables it.
+    'local_timeout': 5,
+    # Number of buyers kept in the memory of each process.
+    'local_size': 1000,
+    # When True, a buyer older than local_timeout but younger than
+    # stale_timeout is served from memory and refreshed in the background.
+    'stale_while_revalidate': False,
+    'stale_timeout': 60,
+}
+
 BROWSERID_DOMAIN = 'login.persona.org'
 BROWSERID_AUDIENCES = [host.rstrip('/')]
 BROWSERID_VERIFICATION_URL = 'https://%s/verify' % BROWSERID_DOMAIN
@@ -239,6 +274,24 @@ CACHEBUST_IMGS = True
 # new PREFIX in the CACHE setttings. Overridden on all prod servers.
 CACHE_PREFIX = 'webpay'
 
+# Circuit breakers for the Solitude and Marketplace API clients. There is one
+# for each upstream host and endpoint class (such as generic.buyer). An open
+# circuit fails calls straight away instead of waiting on a broken upstream.
+CIRCUIT_BREAKER = {
+    'enabled': True,
+    # The number of recent calls to look at.
+    'window': 20,
+    # The least number of recent calls before the circuit can open.
+    'min_calls': 10,
+    # Open when this fraction of recent calls failed.
+    'error_rate': 0.5,
+    # Calls slower than this fraction of the timeout of their endpoint count
+    # as failed, see UPSTREAM_TIMEOUTS.
+    'slow': 0.5,
+    # Seconds to stay open before letting a probe call through.
+    'reset_timeout': 30,
+}
+
 # When True, compress session cookie data with zlib to improve network
 # performance and avoid maxing out HTTP header length.
 COMPRESS_ENCRYPTED_COOKIE = True
@@ -311,8 +364,41 @@ ENGAGE_ROBOTS = False
 # The issuer of the special marketplace app purchase JWTs.
 ISSUER = DOMAIN
 
+# Caching of in-app payment issuers. The secret and access flag of each issuer
+# is looked up in solitude by public_id and shared by the web heads and the
+# celery workers.
+ISSUER_CACHE = {
+    # Seconds to keep a known issuer. 0 disables caching.
+    'timeout': 300,
+    # Seconds to remember that an issuer is unknown. 0 disables caching.
+    'negative_timeout': 60,
+    # When a JWT fails verification its issuer is looked up again, in case
+    # its secret was changed, but at most once in this many seconds. Notices
+    # are signed with the cached secret, so they use a changed secret after
+    # at most 'timeout' seconds.
+    'refresh': 60,
+}
+
+# Caching of verified JWTs, so that a reloaded payment page or a repeated
+# sig_check does not look up the issuer or check the signature again. A JWT
+# is cached until it expires, or for at most this many seconds. Keep this
+# short: a cached JWT stays valid for this long after its issuer's secret is
+# changed. 0 disables caching.
+JWT_CACHE = {
+    'timeout': 300,
+}
+
 HAS_SYSLOG = not DEBUG
 
+# Caching of the marketplace URLs of resized product icons.
+ICON_CACHE = {
+    # Seconds to keep the URL of an icon. 0 disables caching.
+    'timeout': 60 * 60 * 24,
+    # Seconds to wait for the marketplace to fetch an icon before asking it
+    # again. Only one fetch is asked for in that time. 0 disables this.
+    'pending_timeout': 60,
+}
+
 # Temporary, this should be going into solitude.
 INAPP_KEY_PATHS = {}
 
@@ -391,6 +477,11 @@ NEWRELIC_INI = None
 # result in an error.
 ONLY_SIMULATIONS = False
 
+# Number of threads in each process used to make independent Solitude and
+# Marketplace calls at the same time, for example the buyer and seller lookups
+# when starting a transaction. Set to 0 to make the calls one after another.
+PARALLEL_WORKERS = 4
+
 # The pay URL is the starting page of the payment screen.
 # It will receive one substitution: the uid_pay value. For example, this is the
 # Billing Configuration ID in Bangoland.
@@ -424,11 +515,70 @@ PAYMENT_PROVIDERS = ('bango', 'boku', 'reference')
 # Disable PIN unlocking because of bug 1000877.
 PIN_UNLOCK_LENGTH = 0
 
-# Number of retries on a payment postback.
-POSTBACK_ATTEMPTS = 5
+# The retry schedule of the notices posted to app servers about payments
+# (postback) and refunds (chargeback), see webpay.pay.utils.NoticeRetry.
+POSTBACK_RETRY = {
+    # The most attempts, including the first one.
+    'attempts': 10,
+    # Seconds to wait after the first failure. This doubles after each
+    # failure and a random time up to it is used.
+    'base': 30,
+    # The most seconds to wait.
+    'cap': 3600,
+    # The most seconds from the first attempt to the last one.
+    'budget': 12 * 3600,
+    # Options that are different for each type of notice.
+    'types': {
+        'chargeback': {'attempts': 12, 'budget': 24 * 3600},
+    },
+}
+
+# Number of threads in each celery process that post payment notices to app
+# servers, so that the notify tasks don't wait for them, such as 100. Set to
+# 0 to post each notice in its task.
+#
+# A notice that is queued or parked on a thread is only kept in memory, so
+# the threads need POSTBACK_OUTBOX to be enabled: notices lost when a celery
+# process restarts can then be sent with `manage.py replay_notices`.
+POSTBACK_WORKERS = 0
+
+# The most notices each celery process sends to one app server at the same
+# time. This is also how many connections are kept open to each server.
+POSTBACK_HOST_CONCURRENCY = 4
+
+# When notices to an app server fail this many times in a row, the server
+# backs off: its notices wait until a single probe notice works. The back off
+# starts at `base` seconds and doubles after each failed probe, up to `cap`.
+# Each failed probe counts as an attempt for every waiting notice, see
+# POSTBACK_RETRY.
+POSTBACK_BACKOFF = {
+    'failures': 5,
+    'base': 60,
+    'cap': 600,
+}
+
+# Notices are written to this store before they are sent and marked when
+# they are delivered, so that notices that were lost can be sent again with
+# `manage.py replay_notices`. See webpay.pay.outbox.
+POSTBACK_OUTBOX = {
+    'enabled': False,
+    'backend': 'webpay.pay.outbox.SQLiteOutbox',
+    # The SQLite backend needs a path, such as
+    # /var/lib/webpay/notices.sqlite. It must be on a data disk outside of
+    # the code checkout, which each deploy replaces.
+    'options': {'path': None},
+    # Seconds to keep notices after they were delivered. Older ones are
+    # deleted, at most once an hour by each process.
+    'keep': 7 * 24 * 3600,
+}
 
-# Amount of seconds between each payment postback attempt.
-POSTBACK_DELAY = 300
+# An in-memory index of the price tiers of every payment provider, refreshed
+# from the marketplace in the background.
+PRICE_INDEX = {
+    'enabled': True,
+    # Seconds between refreshes.
+    'refresh': 5 * 60,
+}
 
 # In production, all locales must be whitelisted for use, regardless of the
 # existence of po files.
@@ -485,6 +635,10 @@ PRODUCT_ICON_SIZE = 64
 
 PROJECT_MODULE = 'webpay'
 
+# When True, the time spent calling upstream APIs is added to every response
+# in a Server-Timing header.
+SERVER_TIMING_HEADER = False
+
 # Maximum value for "short" fields in a product JWT. These are fields (like
 # 'name') that have an implied short length. Values that exceed the maximum
 # will trigger form errors.
@@ -494,6 +648,9 @@ SHORT_FIELD_MAX_LENGTH = 255
 # This is used to integrate with Marketplace and other apps.
 SIG_CHECK_TYP = 'mozilla/payments/sigcheck/v1'
 
+# The most JWTs that can be checked in one call to the batch signature check.
+SIG_CHECK_BATCH_SIZE = 100
+
 # When not None, this is a dict of mcc and mnc to simulate a specific mobile
 # network. This overrides the client side network detection.
 # Example: {'mcc': '123', 'mnc': '45'}
@@ -502,6 +659,25 @@ SIMULATED_NETWORK = None
 
 SITE_URL = host.rstrip('/')
 
+# Connection pooling for the Solitude and Marketplace API clients. Each
+# upstream host gets its own pool of keep-alive connections.
+SLUMBER_POOL = {
+    # The number of upstream hosts to keep a pool for.
+    'hosts': 10,
+    # The number of connections to keep alive for each host.
+    'connections': 10,
+    # When True, never open more than `connections` to one host. Callers
+    # wait for a free connection instead.
+    'block': True,
+    # Seconds to wait for a free connection when blocking. None is forever.
+    'timeout': 10,
+    # When False, connections are closed after each request.
+    'keep_alive': True,
+    # When True, identical GET requests made at the same time by different
+    # threads share one request to the upstream. Other methods never do.
+    'single_flight': True,
+}
+
 # This is the URL lib.solitude.api uses to connect to the pay server. If this
 # is none the solitude api tests don't run as we currently don't have a mock
 # server for it.
@@ -510,6 +686,32 @@ SOLITUDE_URL = os.environ.get('SOLITUDE_URL', 'http://localhost:2602')
 # The OAuth tokens for solitude.
 SOLITUDE_OAUTH = {'key': 'webpay', 'secret': 'please change this'}
 
+# Seconds to remember the resource_pk and resource_uri of solitude objects by
+# their uuid or public_id. Objects never move so this can be long. 0 disables
+# the index and every lookup searches solitude.
+SOLITUDE_INDEX_TIMEOUT = 60 * 60 * 24
+
+# Hedging of slow reads from solitude. When a GET to one of the endpoints has
+# not answered within a percentile of their recent latency, a second copy is
+# sent and whichever answers first is used.
+SOLITUDE_HEDGING = {
+    'enabled': False,
+    # Endpoint classes to hedge. Only GETs are ever hedged.
+    'endpoints': ('generic.transaction',),
+    # Hedge after this percentile of recent latency...
+    'percentile': 95,
+    # ...but never sooner than this many seconds.
+    'min_delay': 0.05,
+    # The number of recent latencies to keep for each endpoint.
+    'window': 200,
+    # Don't hedge until an endpoint has this many latencies.
+    'min_samples': 20,
+    # The share of requests that can be hedged.
+    'budget': 0.05,
+    # The most hedges that can be saved up during quiet periods.
+    'max_allowance': 5,
+}
+
 SPARTACUS_BUILD_ID_KEY = 'spartacus-build-id'
 SPARTACUS_STATIC = os.environ.get('SPARTACUS_STATIC', 'http://localhost:2604')
 
@@ -552,6 +754,38 @@ TEMPLATE_CONTEXT_PROCESSORS = list(TEMPLATE_CONTEXT_PROCESSORS) + [
     'webpay.base.context_processors.defaults',
 ]
 
+# Retries of reads from Solitude and the Marketplace that failed to connect
+# or timed out, see lib.retry.RetryPolicy.
+UPSTREAM_RETRY = {
+    # The most attempts, including the first one.
+    'attempts': 3,
+    # Seconds to back off after the first failure. This doubles after each
+    # failure and a random time up to it is used.
+    'base': 0.1,
+    # The most seconds to back off.
+    'cap': 2,
+    # The most seconds to spend on all the attempts.
+    'budget': 5,
+}
+
+# Timeouts in seconds for the calls made to Solitude and the Marketplace. The
+# calls made while handling a web request or a celery task share a deadline,
+# each call gets the time that is left or its endpoint timeout if shorter.
+UPSTREAM_TIMEOUTS = {
+    # The time allowed for all the calls made by one web request.
+    'request': 25,
+    # The time allowed for all the calls made by one celery task.
+    'task': 60,
+    # The timeout for a single call when its endpoint has no override.
+    'default': 10,
+    # Timeouts for endpoint classes, e.g. 'generic.buyer' or 'bango'. The
+    # most specific match wins.
+    'endpoints': {
+        # Creating a billing configuration waits on Bango.
+        'bango.billing': 20,
+    },
+}
+
 # When True, use the marketplace API to get product icons.
 USE_PRODUCT_ICONS = True
 
@@ -3,10 +3,11 @@ from django.conf import settings
 from django.shortcuts import render
 
 from django_paranoia.decorators import require_GET
-from mozpay.verify import InvalidJWT, _get_issuer, verify_sig
+from mozpay.exc import InvalidJWT
 from webpay.auth.utils import set_user
 from webpay.base.helpers import fxa_auth_info
 from webpay.base.logger import getLogger
+from webpay.pay.tokens import ParsedJWT
 log = getLogger('w.spa')
 
 
@@ -16,16 +17,20 @@ def index(request, view_name=None, start_view=None):
     ctx = {}
     ctx['fxa_state'], ctx['fxa_auth_url'] = fxa_auth_info(request)
     jwt = request.GET.get('req')
+    parsed = None
 
     if jwt:
         ctx['mkt_user'] = False
+        try:
+            parsed = ParsedJWT(jwt)
+        except InvalidJWT, exc:
+            log.debug('ignoring undecodable JWT: {e}'.format(e=exc))
 
     # If this is a Marketplace-issued JWT, verify its signature and skip login
     # for the purchaser named in it.
-    if jwt and _get_issuer(jwt) == settings.KEY:
+    if parsed and parsed.issuer == settings.KEY:
         try:
-            data = verify_sig(jwt, settings.SECRET,
-                              expected_aud=settings.DOMAIN)
+            data = parsed.verify_sig(settings.SECRET, settings.DOMAIN)
             data = data['request'].get('productData', '')
         except InvalidJWT, exc:
             log.debug('ignoring invalid Marketplace JWT error: {e}'